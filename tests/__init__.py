@@ -52,3 +52,11 @@ import virtconvtest
 import interface
 import xmlparse
 import support
+import diskio
+import mediacache
+import httppool
+import download
+import upload
+import cpio
+import domainwait
+import osdistro
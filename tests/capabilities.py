@@ -16,8 +16,12 @@
 
 import os.path
 import unittest
+
+import virtinst
 import virtinst.CapabilitiesParser as capabilities
 
+import utils
+
 def build_host_feature_dict(feature_list):
     fdict = {}
     for f in feature_list:
@@ -209,6 +213,22 @@ class TestCapabilities(unittest.TestCase):
         test_utils(rhel_kvm_caps, False, True, True, False, False)
         test_utils(new_caps_no_kvm, False, True, False, False, False)
 
+    def testCapsCache(self):
+        conn = utils.open_testdriver()
+        stats = capabilities.get_caps_cache_stats()
+
+        caps = capabilities.get_caps(conn)
+        self.assertTrue(caps is capabilities.get_caps(conn))
+
+        newstats = capabilities.get_caps_cache_stats()
+        self.assertEquals(newstats["misses"], stats["misses"] + 1)
+        self.assertEquals(newstats["hits"], stats["hits"] + 1)
+
+        self.assertTrue(caps is virtinst.Guest(conn=conn)._get_caps())
+
+        capabilities.invalidate_caps(conn)
+        self.assertFalse(caps is capabilities.get_caps(conn))
+
     def testCPUMap(self):
         caps = self._buildCaps("libvirt-0.7.6-qemu-caps.xml")
         cpu_64 = caps.get_cpu_values("x86_64")
@@ -258,6 +258,9 @@ args_dict = {
         "--disk /dev/hda",
         # Building 'default' pool
         "--disk pool=default,size=.00001",
+        # Nonsparse file with explicit preallocation strategies
+        "--disk %(NEWIMG1)s,sparse=fallocate,size=.0000001",
+        "--disk %(NEWIMG1)s,sparse=write,size=.0000001",
       ],
 
       "invalid": [
@@ -273,10 +276,16 @@ args_dict = {
         "--file-size .0001",
         # Specify a nonexistent pool
         "--disk pool=foopool,size=.0001",
+        # Unknown sparse/preallocation value
+        "--disk %(NEWIMG1)s,sparse=foo,size=.0001",
         # Specify a nonexistent volume
         "--disk vol=%(POOL)s/foovol",
         # Specify a pool with no size
         "--disk pool=%(POOL)s",
+        # Upload a nonexistent image
+        "--disk pool=%(POOL)s,size=.0001,upload=/foo/bar/image.img",
+        # Upload into an existing volume
+        "--disk vol=%(POOL)s/%(VOL)s,upload=%(EXISTIMG1)s",
         # Unknown cache type
         "--disk path=%(EXISTIMG1)s,perms=ro,size=.0001,cache=FOOBAR",
         # Unmanaged file using non-raw format
@@ -314,6 +323,8 @@ args_dict = {
         "--hvm --location %(TREEDIR)s",
         # initrd-inject
         "--hvm --location %(TREEDIR)s --initrd-inject virt-install --extra-args ks=file:/virt-install",
+        # Directory tree URL install with media cache size
+        "--hvm --location %(TREEDIR)s --media-cache-size 1024",
         # Directory tree URL install with extra-args
         "--hvm --location %(TREEDIR)s --extra-args console=ttyS0",
         # Directory tree CDROM install
@@ -355,6 +366,8 @@ args_dict = {
         "--hvm --cdrom %(EXISTIMG1)s --extra-args console=ttyS0",
         # initrd-inject with manual kernel/initrd
         "--hvm --boot kernel=%(TREEDIR)s/pxeboot/vmlinuz,initrd=%(TREEDIR)s/pxeboot/initrd.img --initrd-inject virt-install",
+        # Negative media cache size
+        "--hvm --location %(TREEDIR)s --media-cache-size -1",
       ],
      }, # category "install"
 
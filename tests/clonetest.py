@@ -216,6 +216,110 @@ class TestClone(unittest.TestCase):
 
         raise AssertionError("Expected exception, but none raised.")
 
+    def testCloneConcurrentRollback(self):
+        """
+        Clone two local disks concurrently, with one source vanishing
+        underneath us, and verify created storage is rolled back
+        """
+        from virtinst import VirtualDisk
+        import urlgrabber.progress as progress
+
+        outfiles = ["/tmp/virtinst-clone-out1.img",
+                    "/tmp/virtinst-clone-out2.img"]
+        cloneobj = CloneDesign(conn=conn)
+        cloneobj.clone_jobs_per_device = 2
+
+        disks = []
+        for src, dst in zip(local_files, outfiles):
+            disk = VirtualDisk(dst, size=.001, conn=conn)
+            disk.clone_path = src
+            disks.append(disk)
+        cloneobj._clone_virtual_disks = disks
+        os.unlink(FILE2)
+
+        created = []
+        try:
+            try:
+                CloneManager._do_duplicate(cloneobj, progress.BaseMeter(),
+                                           created)
+                raise AssertionError("Expected clone failure")
+            except RuntimeError, e:
+                logging.debug("Received expected exception: %s", str(e))
+
+            self.assertEquals(len(created), 2)
+            CloneManager._remove_created_storage(created)
+            for f in outfiles:
+                self.assertFalse(os.path.exists(f))
+        finally:
+            os.system("touch %s" % FILE2)
+            for f in outfiles:
+                if os.path.exists(f):
+                    os.unlink(f)
+
+    def testCloneBatch(self):
+        """
+        Set up three clones at once, and check names, UUIDs, MACs and disk
+        paths are unique and the disks are copied from the single source
+        """
+        import urlgrabber.progress as progress
+
+        content = os.urandom(1024) * 1024
+        open(FILE1, "w").write(content)
+
+        infile = os.path.join(clonexml_dir, "general-cfg-in.xml")
+        cloneobj = CloneDesign(conn=conn)
+        cloneobj.original_xml = utils.read_file(infile)
+        cloneobj.skip_target = "hdb"
+
+        designs = CloneManager.setup_clone_batch(cloneobj, 3)
+        outfiles = [d.clone_devices[0] for d in designs]
+        try:
+            self.assertEquals([d.clone_name for d in designs],
+                              ["clone-orig-clone", "clone-orig-clone1",
+                               "clone-orig-clone2"])
+            self.assertEquals(len(set([d.clone_uuid for d in designs])), 3)
+            macs = []
+            for d in designs:
+                self.assertEquals(len(d.clone_mac), 2)
+                macs.extend(d.clone_mac)
+            self.assertEquals(len(set(macs)), 6)
+            self.assertEquals(len(set(outfiles)), 3)
+
+            created = []
+            CloneManager._do_duplicate_batch(designs, progress.BaseMeter(),
+                                             None, created)
+            self.assertEquals(len(created), 3)
+            for f in outfiles:
+                self.assertTrue(open(f).read() == content)
+        finally:
+            for f in outfiles:
+                if os.path.exists(f):
+                    os.unlink(f)
+
+    def testCloneLinked(self):
+        outfile = "/tmp/virtinst-linked.img"
+        infile = os.path.join(clonexml_dir, "general-cfg-in.xml")
+
+        cloneobj = CloneDesign(conn=conn)
+        cloneobj.original_xml = utils.read_file(infile)
+        cloneobj.skip_target = "hdb"
+        cloneobj.clone_linked = True
+        cloneobj.clone_name = CLONE_NAME
+        cloneobj.setup_original()
+        cloneobj.clone_devices = [outfile]
+        cloneobj.setup_clone()
+
+        disk = cloneobj.clone_virtual_disks[0]
+        self.assertEquals(disk.clone_path, FILE1)
+        self.assertEquals(disk.clone_backing_format, "raw")
+        self.assertEquals(cloneobj.linked_chain, [(outfile, FILE1)])
+
+        drvpath = "/domain/devices/disk[target/@dev='hda']/driver"
+        self.assertEquals(CloneManager._util.get_xml_path(
+                            cloneobj.clone_xml, drvpath + "/@type"), "qcow2")
+        self.assertEquals(CloneManager._util.get_xml_path(
+                            cloneobj.clone_xml, drvpath + "/@name"), "qemu")
+
     def testCloneManagedToUnmanaged(self):
         base = "managed-storage"
 
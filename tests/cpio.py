@@ -0,0 +1,116 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import unittest
+import os
+import shutil
+import stat
+import tempfile
+import zlib
+
+from virtinst import _cpio
+
+def parse_newc(data):
+    """
+    Return a list of (name, mode, content) for each archive member
+    """
+    ret = []
+    offset = 0
+    while True:
+        assert data[offset:offset + 6] == "070701"
+        fields = [int(data[offset + 6 + i * 8:offset + 14 + i * 8], 16)
+                  for i in range(13)]
+        mode, filesize, namesize = fields[1], fields[6], fields[11]
+
+        offset += 110
+        name = data[offset:offset + namesize - 1]
+        offset += namesize
+        offset += (4 - offset % 4) % 4
+
+        content = data[offset:offset + filesize]
+        offset += filesize
+        offset += (4 - offset % 4) % 4
+
+        if name == "TRAILER!!!":
+            return ret
+        ret.append((name, mode, content))
+
+class TestCpio(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="virtinst-cpio")
+        self.files = []
+        for name, content in [("ks.cfg", "install\ntext\n"),
+                              ("driver.rpm", "x" * 100001)]:
+            path = os.path.join(self.tmpdir, name)
+            open(path, "w").write(content)
+            os.chmod(path, 0640)
+            self.files.append(path)
+        self.initrd = os.path.join(self.tmpdir, "initrd.img")
+        # An odd length, like a real compressed initrd
+        open(self.initrd, "w").write("base1")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check_members(self, data):
+        members = parse_newc(data)
+        self.assertEquals([m[0] for m in members],
+                          [".", "ks.cfg", "driver.rpm"])
+        self.assertTrue(stat.S_ISDIR(members[0][1]))
+        self.assertEquals(members[1][1], stat.S_IFREG | 0640)
+        self.assertEquals(members[1][2], "install\ntext\n")
+        self.assertEquals(members[2][2], "x" * 100001)
+
+    def testAppendGzip(self):
+        _cpio.append_archive(self.initrd, self.files)
+        data = open(self.initrd).read()
+        self.assertEquals(data[:5], "base1")
+        self.assertEquals(data[5:7], "\x1f\x8b")
+        self._check_members(zlib.decompress(data[5:], 16 + zlib.MAX_WBITS))
+
+    def testAppendUncompressed(self):
+        _cpio.append_archive(self.initrd, self.files, 0)
+        data = open(self.initrd).read()
+        self.assertEquals(data[:8], "base1\0\0\0")
+        start = data.index("070701")
+        self.assertEquals(start % 4, 0)
+        self._check_members(data[start:])
+
+    def testStreamed(self):
+        orig = _cpio.MEMO_MAX_BYTES
+        _cpio.MEMO_MAX_BYTES = 0
+        try:
+            _cpio.append_archive(self.initrd, self.files, 1)
+        finally:
+            _cpio.MEMO_MAX_BYTES = orig
+        data = open(self.initrd).read()
+        self._check_members(zlib.decompress(data[5:], 16 + zlib.MAX_WBITS))
+
+    def testMemo(self):
+        first = _cpio.build_archive(self.files)
+        self.assertTrue(_cpio.build_archive(self.files) is first)
+
+        open(self.files[0], "a").write("reboot\n")
+        self.assertFalse(_cpio.build_archive(self.files) is first)
+
+    def testFailure(self):
+        self.assertRaises(OSError, _cpio.append_archive, self.initrd,
+                          self.files + ["/idontexist"])
+        self.assertEquals(open(self.initrd).read(), "base1")
+
+if __name__ == "__main__":
+    unittest.main()
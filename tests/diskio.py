@@ -0,0 +1,203 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import unittest
+import os
+import struct
+import threading
+
+import urlgrabber.progress as progress
+
+from virtinst import _diskio
+
+SRC = "/tmp/virtinst-diskio-src.img"
+DST = "/tmp/virtinst-diskio-dst.img"
+
+MB = 1024 * 1024
+SIZE = 20 * MB
+
+class TestDiskIO(unittest.TestCase):
+
+    def setUp(self):
+        f = open(SRC, "w")
+        f.truncate(SIZE)
+        f.seek(3 * MB)
+        f.write(os.urandom(MB) + ("\0" * 8192) + os.urandom(5000))
+        f.seek(15 * MB + 17)
+        f.write("foobar")
+        f.close()
+
+    def tearDown(self):
+        for f in [SRC, DST] + getattr(self, "dsts", []):
+            if os.path.exists(f):
+                os.unlink(f)
+
+    def _compare(self):
+        self.assertEquals(os.path.getsize(SRC), os.path.getsize(DST))
+        self.assertTrue(open(SRC).read() == open(DST).read())
+
+    def _meter(self):
+        meter = progress.BaseMeter()
+        meter.start(size=SIZE, text="testing")
+        return meter
+
+    def _engine(self, backends=None):
+        return _diskio.CloneEngine(blocksize=MB, workers=3,
+                                   chunksize=2 * MB, backends=backends)
+
+    def testExtents(self):
+        fd = os.open(SRC, os.O_RDONLY)
+        try:
+            extents = _diskio.get_extents(fd, SIZE)
+        finally:
+            os.close(fd)
+
+        # Whatever the filesystem reports, all data must be covered
+        for start, length in extents:
+            self.assertTrue(length > 0)
+            self.assertTrue(start + length <= SIZE)
+        self.assertTrue(extents[0][0] <= 3 * MB)
+        self.assertTrue(extents[-1][0] + extents[-1][1] >= 15 * MB + 23)
+
+    def testCloneSparse(self):
+        job = self._engine().clone(SRC, DST, SIZE, True, self._meter())
+        self._compare()
+        self.assertTrue(job.written < SIZE)
+        self.assertEquals(job.done, SIZE)
+
+    def testCloneNonSparse(self):
+        job = self._engine().clone(SRC, DST, SIZE, False, self._meter())
+        self._compare()
+        self.assertEquals(job.written, SIZE)
+        self.assertEquals(job.done, SIZE)
+
+    def testCloneExistingDest(self):
+        f = open(DST, "w")
+        f.write("\xff" * SIZE)
+        f.close()
+
+        self._engine().clone(SRC, DST, SIZE, False, self._meter())
+        self._compare()
+
+    def testCloneBackends(self):
+        # Every backend must produce an identical copy, or be skipped
+        # in favour of read/write
+        for backend in _diskio.default_backends():
+            if os.path.exists(DST):
+                os.unlink(DST)
+
+            engine = self._engine(backends=[backend])
+            job = engine.clone(SRC, DST, SIZE, True, self._meter())
+            self._compare()
+            self.assertTrue(job.backend.name in [backend.name, "readwrite"])
+
+    def testCloneBackendsNonSparse(self):
+        for backend in _diskio.default_backends():
+            if backend.whole_file:
+                continue
+            if os.path.exists(DST):
+                os.unlink(DST)
+
+            engine = self._engine(backends=[backend])
+            job = engine.clone(SRC, DST, SIZE, False, self._meter())
+            self._compare()
+            self.assertEquals(job.written, SIZE)
+
+    def testCloneSparseZeros(self):
+        # A template full of written zeros must still clone sparse,
+        # whichever range backend is preferred
+        f = open(SRC, "w")
+        f.write("\0" * SIZE)
+        f.close()
+
+        for backend in _diskio.default_backends():
+            if backend.whole_file:
+                continue
+            if os.path.exists(DST):
+                os.unlink(DST)
+
+            engine = self._engine(backends=[backend])
+            job = engine.clone(SRC, DST, SIZE, True, self._meter())
+            self._compare()
+            self.assertEquals(job.backend.name, "readwrite")
+            self.assertEquals(job.written, 0)
+
+    def testCloneAbort(self):
+        abort = threading.Event()
+        abort.set()
+
+        engine = self._engine(backends=[_diskio.ReadWriteBackend()])
+        self.assertRaises(IOError, engine.clone, SRC, DST, SIZE, True,
+                          None, abort)
+
+        self.dsts = [DST + ".2", DST + ".3"]
+        self.assertRaises(IOError, engine.clone_many, SRC, self.dsts, SIZE,
+                          False, None, abort)
+
+    def testCloneMany(self):
+        dsts = [DST, DST + ".2", DST + ".3"]
+        self.dsts = dsts
+
+        # An existing destination must be fully overwritten
+        f = open(dsts[2], "w")
+        f.write("\xff" * SIZE)
+        f.close()
+
+        backends = [_diskio.ReadWriteBackend()]
+        jobs = self._engine(backends).clone_many(SRC, dsts, SIZE, True,
+                                                 [self._meter() for d in dsts])
+        for dst, job in zip(dsts, jobs):
+            self.assertEquals(os.path.getsize(dst), SIZE)
+            self.assertTrue(open(SRC).read() == open(dst).read())
+            self.assertEquals(job.done, SIZE)
+        self.assertTrue(jobs[0].written < SIZE)
+        self.assertFalse(jobs[2].sparse)
+        self.assertEquals(jobs[2].written, SIZE)
+
+    def testCloneManyBackends(self):
+        dsts = [DST, DST + ".2"]
+        self.dsts = dsts
+
+        jobs = self._engine().clone_many(SRC, dsts, SIZE, True)
+        for dst, job in zip(dsts, jobs):
+            self.assertTrue(open(SRC).read() == open(dst).read())
+            self.assertTrue(job.backend.name in ["reflink", "readwrite"])
+
+    def testBackingFile(self):
+        self.dsts = [DST + ".qcow2"]
+        backing = "virtinst-diskio-src.img"
+
+        # Minimal qcow2 v2 header, with the backing file name after it
+        header = (_diskio.QCOW2_MAGIC + struct.pack(">I", 2) +
+                  struct.pack(">Q", 72) + struct.pack(">I", len(backing)))
+        f = open(self.dsts[0], "wb")
+        f.write(header + "\0" * (72 - len(header)) + backing)
+        f.close()
+
+        self.assertEquals(_diskio.get_backing_file(self.dsts[0]), SRC)
+        self.assertEquals(_diskio.get_backing_file(SRC), None)
+
+    def testImageFormat(self):
+        self.dsts = [DST + ".qcow2"]
+        f = open(self.dsts[0], "wb")
+        f.write(_diskio.QCOW2_MAGIC + struct.pack(">I", 3) + "\0" * 64)
+        f.close()
+
+        self.assertEquals(_diskio.get_image_format(self.dsts[0]), "qcow2")
+        self.assertEquals(_diskio.get_image_format(SRC), "raw")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import unittest
+import threading
+import time
+
+from virtinst import _domainwait
+
+class FakeDomain(object):
+    def __init__(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+class FakeConn(object):
+    """
+    Records the registered lifecycle callback so tests can fire events
+    """
+    def __init__(self):
+        self.callback = None
+
+    def domainEventRegisterAny(self, dom, eventid, cb, opaque):
+        ignore = dom, eventid, opaque
+        self.callback = cb
+        return 1
+
+    def domainEventDeregisterAny(self, callbackid):
+        ignore = callbackid
+        self.callback = None
+
+    def fire(self, name):
+        if self.callback:
+            self.callback(self, FakeDomain(name), 5, 0, None)
+
+class TestDomainWait(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConn()
+        self.state = {"done": False, "checks": 0}
+
+    def tearDown(self):
+        _domainwait.set_poll_interval(_domainwait.DEFAULT_MIN_POLL,
+                                      _domainwait.DEFAULT_MAX_POLL)
+
+    def _check(self):
+        self.state["checks"] += 1
+        return self.state["done"]
+
+    def _finish_later(self, name):
+        def finish():
+            time.sleep(0.2)
+            self.conn.fire("someothervm")
+            self.state["done"] = True
+            self.conn.fire(name)
+        t = threading.Thread(target=finish)
+        t.start()
+        return t
+
+    def testEvents(self):
+        waiter = _domainwait.DomainWaiter(self.conn, "testvm",
+                                          use_events=True)
+        self.assertTrue(waiter.has_events())
+
+        start = time.time()
+        t = self._finish_later("testvm")
+        try:
+            self.assertTrue(waiter.wait(self._check, 30))
+        finally:
+            t.join()
+            waiter.close()
+
+        # Woken by the event, well before the periodic recheck
+        self.assertTrue(time.time() - start < _domainwait.EVENT_RECHECK)
+        self.assertTrue(self.state["checks"] <= 3)
+        self.assertEquals(self.conn.callback, None)
+
+    def testPolling(self):
+        _domainwait.set_poll_interval(0.01, 0.05)
+        waiter = _domainwait.DomainWaiter(self.conn, "testvm",
+                                          use_events=False)
+        self.assertFalse(waiter.has_events())
+
+        t = self._finish_later("testvm")
+        try:
+            self.assertTrue(waiter.wait(self._check, 30))
+        finally:
+            t.join()
+        self.assertTrue(self.state["checks"] > 1)
+
+    def testTimeout(self):
+        _domainwait.set_poll_interval(0.01, 0.05)
+        start = time.time()
+        self.assertFalse(_domainwait.wait_for(self.conn, "testvm",
+                                              self._check, 0.2))
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEquals(self.state["checks"] >= 2, True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import unittest
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from virtinst import _download
+from virtinst import _httppool
+
+# 1 MiB of data that differs in every segment
+CONTENT = "".join([chr(i % 251) for i in range(1024 * 1024)])
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        data = CONTENT
+        start = 0
+        end = len(data)
+
+        rangehdr = self.headers.getheader("Range")
+        if rangehdr and self.server.ranges:
+            start, end = rangehdr.split("=")[1].split("-")
+            start = int(start)
+            end = int(end) + 1
+
+        body = data[start:end]
+        drop = self.server.drop_after
+        if drop and len(body) > drop:
+            # Simulate the connection dying part way
+            self.server.drop_after = None
+            self.send_response(rangehdr and 206 or 200)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end - 1, len(data)))
+            self.end_headers()
+            self.wfile.write(body[:drop])
+            self.close_connection = 1
+            return
+
+        self.send_response(rangehdr and self.server.ranges and 206 or 200)
+        self.send_header("Content-Length", str(len(body)))
+        if rangehdr and self.server.ranges:
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end - 1, len(data)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        ignore = args
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    ranges = True
+    drop_after = None
+
+    def handle_error(self, request, client_address):
+        ignore = request
+        ignore = client_address
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="virtinst-download")
+        self.path = os.path.join(self.tmpdir, "file")
+        self.statepath = self.path + ".state"
+
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/boot.iso" % self.server.server_port
+
+        self._segment_size = _download.SEGMENT_SIZE
+        self._max_retries = _download.MAX_RETRIES
+        _download.SEGMENT_SIZE = 256 * 1024
+        _download.MAX_RETRIES = 1
+
+    def tearDown(self):
+        _download.SEGMENT_SIZE = self._segment_size
+        _download.MAX_RETRIES = self._max_retries
+        _httppool.get_pool().close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _download(self):
+        return _download.RangeDownload(self.url, self.path, len(CONTENT),
+                                       validator="\"v1\"", algos=["md5"],
+                                       statepath=self.statepath).run()
+
+    def _check(self, digests):
+        self.assertEquals(open(self.path, "rb").read(), CONTENT)
+        self.assertEquals(digests["sha256"],
+                          hashlib.sha256(CONTENT).hexdigest())
+        self.assertEquals(digests["md5"], hashlib.md5(CONTENT).hexdigest())
+        self.assertFalse(os.path.exists(self.statepath))
+
+    def testParallel(self):
+        self._check(self._download())
+
+    def testRetry(self):
+        self.server.drop_after = 1000
+        self._check(self._download())
+
+    def testResume(self):
+        # Leave a partial download, as an interrupted run would
+        dl = _download.RangeDownload(self.url, self.path, len(CONTENT),
+                                     validator="\"v1\"",
+                                     statepath=self.statepath)
+        dl._segments = dl._plan()
+        f = open(self.path, "wb")
+        f.truncate(len(CONTENT))
+        for seg in dl._segments:
+            seg.pos = seg.start + 1000
+            f.seek(seg.start)
+            f.write(CONTENT[seg.start:seg.pos])
+        f.close()
+        dl._save_state()
+
+        self._check(self._download())
+
+    def testStaleState(self):
+        open(self.path, "wb").write("x" * len(CONTENT))
+        open(self.statepath, "w").write(
+            '{"url": "%s", "size": %d, "validator": "\\"v0\\"", '
+            '"segments": [[0, %d, %d]]}' % (self.url, len(CONTENT),
+                                           len(CONTENT), len(CONTENT)))
+        self._check(self._download())
+
+    def testNoRanges(self):
+        self.server.ranges = False
+        self.assertRaises(_download.RangeError, self._download)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import unittest
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+from virtinst import _httppool
+
+class _Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def translate_path(self, path):
+        path = path.split("?")[0]
+        return os.path.join(self.server.rootdir, path.lstrip("/"))
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/tree/.treeinfo")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path == "/redirect-file":
+            # Stands in for a redirect to https, which the pool can't
+            # follow itself
+            self.send_response(302)
+            self.send_header("Location", "file://" + os.path.join(
+                             self.server.rootdir, "tree", ".treeinfo"))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path == "/stall":
+            # Never answer while the test is waiting on us
+            self.server.unstall.wait(10)
+            return
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def log_message(self, *args):
+        ignore = args
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is expected
+        ignore = request
+        ignore = client_address
+
+class TestHTTPPool(unittest.TestCase):
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="virtinst-httppool")
+        os.makedirs(os.path.join(self.rootdir, "tree", "images"))
+        for name, content in [(".treeinfo", "[general]\n"),
+                              ("images/vmlinuz", "kernel" * 1000)]:
+            f = open(os.path.join(self.rootdir, "tree", name), "w")
+            f.write(content)
+            f.close()
+
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.server.rootdir = self.rootdir
+        self.server.unstall = threading.Event()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        self.base = "http://127.0.0.1:%d" % self.server.server_port
+        self.pool = _httppool.ConnectionPool()
+
+    def tearDown(self):
+        self.server.unstall.set()
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.rootdir)
+
+    def _get(self, path):
+        response = self.pool.request("GET", self.base + path)
+        try:
+            return response.status, response.read()
+        finally:
+            response.close()
+
+    def testKeepAlive(self):
+        for ignore in range(5):
+            status, content = self._get("/tree/.treeinfo")
+            self.assertEquals(status, 200)
+            self.assertEquals(content, "[general]\n")
+
+        response = self.pool.request("HEAD", self.base + "/tree/missing")
+        response.read()
+        response.close()
+        self.assertEquals(response.status, 404)
+
+        self.assertEquals(self.pool.get_stats(),
+                          {"requests": 6, "connections": 1})
+
+    def testRedirect(self):
+        status, content = self._get("/redirect")
+        self.assertEquals(status, 200)
+        self.assertEquals(content, "[general]\n")
+        self.assertEquals(self.pool.get_stats()["connections"], 1)
+
+    def testRedirectOtherScheme(self):
+        response = self.pool.request("GET", self.base + "/redirect-file")
+        try:
+            self.assertEquals(response.status, 200)
+            self.assertTrue(response.url.startswith("file://"))
+            self.assertEquals(response.getheader("Content-Length"), "10")
+            self.assertEquals(response.read(), "[general]\n")
+        finally:
+            response.close()
+
+    def testTimeout(self):
+        pool = _httppool.ConnectionPool(timeout=0.5)
+        try:
+            self.assertRaises(socket.timeout, pool.request, "GET",
+                              self.base + "/stall")
+        finally:
+            pool.close()
+
+    def testReadline(self):
+        response = self.pool.request("GET", self.base + "/tree/.treeinfo")
+        self.assertEquals(response.readline(), "[general]\n")
+        self.assertEquals(response.readline(), "")
+        response.close()
+
+    def testPartialRead(self):
+        # Abandoning a response part way must not reuse its connection
+        response = self.pool.request("GET",
+                                     self.base + "/tree/images/vmlinuz")
+        self.assertEquals(response.read(6), "kernel")
+        response.close()
+
+        status, ignore = self._get("/tree/.treeinfo")
+        self.assertEquals(status, 200)
+        self.assertEquals(self.pool.get_stats()["connections"], 2)
+
+    def testListing(self):
+        status, content = self._get("/tree/")
+        self.assertEquals(status, 200)
+        self.assertEquals(_httppool.parse_listing(content),
+                          set([".treeinfo", "images"]))
+
+        self.assertEquals(_httppool.parse_listing("<html>hi</html>"), None)
+        apache = ('<html><head><title>Index of /tree</title></head><body>'
+                  '<a href="?C=N;O=D">Name</a><a href="/">Parent</a>'
+                  '<a href="images/">images/</a>'
+                  '<a href="Fedora%20Server/">Fedora Server/</a></body>')
+        self.assertEquals(_httppool.parse_listing(apache),
+                          set(["images", "Fedora Server"]))
+
+        self.assertTrue(_httppool.listing_may_hide(".treeinfo"))
+        self.assertFalse(_httppool.listing_may_hide("images"))
+
+if __name__ == "__main__":
+    unittest.main()
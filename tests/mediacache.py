@@ -0,0 +1,124 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import unittest
+import os
+import shutil
+import hashlib
+import StringIO
+
+from virtinst import _download
+from virtinst import _mediacache
+
+SCRATCH = "/tmp/virtinst-mediacache-test"
+
+class FakeFetcher(object):
+    """
+    Serves files from a dict, counting downloads
+    """
+    def __init__(self, files):
+        self.scratchdir = SCRATCH
+        self.files = files
+        self.validators = {}
+        self.downloads = 0
+
+    def _make_path(self, filename):
+        return "http://example.com/tree/" + filename
+
+    def getValidators(self, filename):
+        return self.validators.get(filename)
+
+    def downloadFile(self, filename, path, progresscb=None, algos=None,
+                     statepath=None):
+        ignore = progresscb
+        ignore = statepath
+        self.downloads += 1
+
+        hasher = _download.Hasher(algos)
+        dst = open(path, "wb")
+        try:
+            _download.copy_stream(StringIO.StringIO(self.files[filename]),
+                                  dst, hasher)
+        finally:
+            dst.close()
+        return hasher.hexdigests()
+
+class TestMediaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = _mediacache.MediaCache(
+                            os.path.join(SCRATCH, "cache"), 1024 * 1024)
+        self.fetcher = FakeFetcher({"vmlinuz": "kernel" * 1000,
+                                    "initrd.img": "initrd" * 1000})
+        self.fetcher.validators = {
+            "vmlinuz": {"etag": "abc", "last_modified": None, "size": 6000},
+            "initrd.img": {"etag": "def", "last_modified": None,
+                           "size": 6000},
+        }
+
+    def tearDown(self):
+        if os.path.exists(SCRATCH):
+            shutil.rmtree(SCRATCH)
+
+    def _acquire(self, filename, checksum=None):
+        path = self.cache.acquire(self.fetcher, filename, None, checksum)
+        self.assertEquals(open(path).read(), self.fetcher.files[filename])
+        os.unlink(path)
+
+    def testCacheHit(self):
+        self._acquire("vmlinuz")
+        self._acquire("vmlinuz")
+        self._acquire("initrd.img")
+        self.assertEquals(self.fetcher.downloads, 2)
+
+    def testHandOffCopy(self):
+        # Handed out files must not share the cache's inode
+        path = self.cache.acquire(self.fetcher, "vmlinuz", None)
+        try:
+            self.assertEquals(os.stat(path).st_nlink, 1)
+        finally:
+            os.unlink(path)
+
+    def testValidatorChange(self):
+        self._acquire("vmlinuz")
+        self.fetcher.files["vmlinuz"] = "newkernel"
+        self.fetcher.validators["vmlinuz"]["etag"] = "xyz"
+        self._acquire("vmlinuz")
+        self.assertEquals(self.fetcher.downloads, 2)
+
+    def testNoValidators(self):
+        self.fetcher.validators = {}
+        self.assertEquals(self.cache.acquire(self.fetcher, "vmlinuz", None),
+                          None)
+
+    def testChecksum(self):
+        digest = hashlib.sha1(self.fetcher.files["vmlinuz"]).hexdigest()
+        self._acquire("vmlinuz", ("sha1", digest))
+        self._acquire("vmlinuz", ("sha1", digest))
+        self.assertEquals(self.fetcher.downloads, 1)
+
+        self.assertRaises(ValueError, self.cache.acquire, self.fetcher,
+                          "initrd.img", None, ("sha1", digest))
+
+    def testEviction(self):
+        self.cache.max_bytes = 8000
+        self._acquire("vmlinuz")
+        self._acquire("initrd.img")
+        self._acquire("vmlinuz")
+        self.assertEquals(self.fetcher.downloads, 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+
+from virtinst import OSDistro
+from virtinst.ImageFetcher import DirectImageFetcher
+
+TREEINFO = """[general]
+family = Fedora
+version = 16
+arch = x86_64
+
+[images-x86_64]
+kernel = images/pxeboot/vmlinuz
+initrd = images/pxeboot/initrd.img
+boot.iso = images/boot.iso
+
+[checksums]
+images/pxeboot/vmlinuz = sha256:%s
+""" % ("0" * 64)
+
+class CountingFetcher(DirectImageFetcher):
+    """
+    Counts the files opened, by name
+    """
+    def __init__(self, location, scratchdir):
+        DirectImageFetcher.__init__(self, location, scratchdir)
+        self.opened = {}
+
+    def openFile(self, filename, progresscb=None):
+        self.opened[filename] = self.opened.get(filename, 0) + 1
+        return DirectImageFetcher.openFile(self, filename, progresscb)
+
+class TestOSDistro(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = tempfile.mkdtemp(prefix="virtinst-tree")
+        os.makedirs(os.path.join(self.tree, "images/pxeboot"))
+        for name, content in [(".treeinfo", TREEINFO),
+                              ("images/pxeboot/vmlinuz", "kernel"),
+                              ("images/pxeboot/initrd.img", "initrd"),
+                              ("images/boot.iso", "iso")]:
+            open(os.path.join(self.tree, name), "w").write(content)
+
+        self.fetcher = CountingFetcher(self.tree, self.tree)
+        self.fetcher.prepareLocation()
+
+    def tearDown(self):
+        shutil.rmtree(self.tree)
+
+    def testTreeinfoFetchedOnce(self):
+        store = OSDistro._storeForDistro(self.fetcher, self.tree, "hvm",
+                                         None, "x86_64")
+        self.assertTrue(isinstance(store, OSDistro.FedoraDistro))
+
+        # Every treeinfo capable distro probing the same location
+        # concurrently shares the one fetch
+        threads = []
+        for dclass in [OSDistro.FedoraDistro, OSDistro.RHELDistro,
+                       OSDistro.CentOSDistro, OSDistro.SLDistro]:
+            dist = dclass(self.tree, "x86_64", "hvm")
+            t = threading.Thread(target=dist.isValidStore,
+                                 args=(self.fetcher, None))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        self.assertEquals(self.fetcher.opened.get(".treeinfo"), 1)
+        self.assertEquals(
+            self.fetcher.checksums["images/pxeboot/vmlinuz"],
+            ("sha256", "0" * 64))
+
+    def testOpenSerialized(self):
+        # Files opened through urlgrabber must not overlap, it shares one
+        # curl handle between callers
+        first = self.fetcher.openFile(".treeinfo")
+        opened = threading.Event()
+
+        def open_second():
+            f = self.fetcher.openFile("images/boot.iso")
+            opened.set()
+            f.close()
+        t = threading.Thread(target=open_second)
+        t.start()
+
+        opened.wait(0.5)
+        self.assertFalse(opened.isSet())
+        first.close()
+        t.join()
+        self.assertTrue(opened.isSet())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -18,6 +18,7 @@ import os
 import unittest
 
 import virtinst.Storage
+from virtinst import _storageindex
 from virtinst.Storage import StoragePool, StorageVolume
 import utils
 
@@ -89,7 +90,8 @@ def poolCompare(pool_inst):
 
     return pool_inst.install(build=True, meter=None, create=True)
 
-def createVol(poolobj, volname=None, input_vol=None, clone_vol=None):
+def createVol(poolobj, volname=None, input_vol=None, clone_vol=None,
+              overlay_vol=None):
     volclass = StorageVolume.get_volume_for_pool(pool_object=poolobj)
 
     if volname == None:
@@ -97,8 +99,13 @@ def createVol(poolobj, volname=None, input_vol=None, clone_vol=None):
 
     alloc = 5 * 1024 * 1024 * 1024
     cap = 10 * 1024 * 1024 * 1024
-    vol_inst = volclass(name=volname, capacity=cap, allocation=alloc,
-                        pool=poolobj)
+    if overlay_vol:
+        vol_inst = virtinst.Storage.OverlayVolume(volname, cap,
+                                                  overlay_vol.path(),
+                                                  pool=poolobj)
+    else:
+        vol_inst = volclass(name=volname, capacity=cap, allocation=alloc,
+                            pool=poolobj)
 
     perms = {}
     perms["mode"] = 0700
@@ -132,6 +139,7 @@ class TestStorage(unittest.TestCase):
         invol = createVol(poolobj)
         createVol(poolobj, volname=invol.name() + "input", input_vol=invol)
         createVol(poolobj, volname=invol.name() + "clone", clone_vol=invol)
+        createVol(poolobj, volname=invol.name() + "overlay", overlay_vol=invol)
 
     def testFSPool(self):
         poolobj = createPool(self.conn, StoragePool.TYPE_FS, "pool-fs")
@@ -200,6 +208,43 @@ class TestStorage(unittest.TestCase):
             pool.uuid = generate_uuid_from_string(pool.name)
             poolCompare(pool)
 
+    def testPoolIndex(self):
+        index = _storageindex.get_index(self.conn)
+        target = "/some/index/target/path"
+        self.assertEquals(index.lookup_pool_by_path(target), None)
+
+        poolname = _findFreePoolName(self.conn, "pool-index")
+        pool_inst = virtinst.Storage.DirectoryPool(conn=self.conn,
+                                                   name=poolname,
+                                                   target_path=target)
+        poolobj = pool_inst.install(create=True)
+        self.assertEquals(index.lookup_pool_by_path(target + "/").name(),
+                          poolname)
+        self.assertTrue(index.is_pool_active(poolobj))
+
+        volname = poolname + "-vol"
+        self.assertEquals(index.lookup_volume(poolobj, volname), None)
+        vol_inst = virtinst.Storage.FileVolume(name=volname, capacity=1024,
+                                               pool=poolobj)
+        vol_inst.install(meter=False)
+        self.assertEquals(index.lookup_volume(poolobj, volname).name(),
+                          volname)
+
+        # Created by another client, without telling the index
+        othername = poolname + "-othervol"
+        other_inst = virtinst.Storage.FileVolume(name=othername,
+                                                 capacity=1024,
+                                                 pool=poolobj)
+        poolobj.createXML(other_inst.get_xml_config(), 0)
+        self.assertEquals(index.lookup_volume(poolobj, othername).name(),
+                          othername)
+
+        poolobj.destroy()
+        self.assertFalse(index.lookup_pool_by_path(target) is None)
+        self.assertFalse(index.is_pool_active(poolobj))
+        poolobj.undefine()
+        self.assertEquals(index.lookup_pool_by_path(target), None)
+
     def testEnumerateLogical(self):
         name = "pool-logical-list"
 
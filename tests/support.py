@@ -46,5 +46,31 @@ class TestSupport(unittest.TestCase):
 
             valdict[supportname] = checkval
 
+    def testSupportCache(self):
+        """
+        Verify version lookups are cached per connection
+        """
+        testconn = utils.open_plainkvm()
+        calls = []
+        origver = testconn.getVersion
+        def getVersion():
+            calls.append(1)
+            return origver()
+        testconn.getVersion = getVersion
+
+        for ignore in range(3):
+            for hv in ["kvm", "qemu"]:
+                support.check_conn_hv_support(testconn,
+                                        support.SUPPORT_CONN_HV_VIRTIO, hv)
+            support.check_conn_support(testconn,
+                                       support.SUPPORT_CONN_DOMAIN_VIDEO)
+        self.assertEquals(len(calls), 1)
+
+        matrix = support.dump_support_matrix(testconn, hvs=["kvm"])
+        names = [name for name, ignore, ignore in matrix]
+        self.assertTrue("SUPPORT_CONN_STORAGE" in names)
+        self.assertTrue(("SUPPORT_CONN_HV_VIRTIO", "kvm", True) in matrix)
+        self.assertTrue(("SUPPORT_CONN_HV_VIRTIO", "qemu", True) in matrix)
+
 if __name__ == "__main__":
     unittest.main()
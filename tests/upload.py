@@ -0,0 +1,183 @@
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+import unittest
+import os
+import StringIO
+import tempfile
+
+import urlgrabber.progress as progress
+
+from virtinst import _upload
+
+class FakeStream(object):
+    """
+    Accepts at most maxsend bytes per send call, like a congested
+    stream would
+    """
+    def __init__(self, maxsend):
+        self.maxsend = maxsend
+        self.data = []
+        self.sends = 0
+        self.finished = False
+
+    def send(self, data):
+        self.sends += 1
+        count = min(len(data), self.maxsend)
+        self.data.append(data[:count])
+        return count
+
+    def finish(self):
+        self.finished = True
+
+    def sendHole(self, length, flags):
+        ignore = flags
+        self.data.append(("hole", length))
+
+    def upload(self, vol, offset, length, flags):
+        ignore = vol
+        self.upload_args = (offset, length, flags)
+
+class FakeConn(object):
+    def __init__(self):
+        self.streams = []
+
+    def newStream(self, flags):
+        ignore = flags
+        stream = FakeStream(1024 * 1024)
+        self.streams.append(stream)
+        return stream
+
+class FakeVol(object):
+    def __init__(self, voltype, fmt):
+        self.voltype = voltype
+        self.fmt = fmt
+
+    def info(self):
+        return [self.voltype, 0, 0]
+
+    def XMLDesc(self, flags):
+        ignore = flags
+        return ("<volume><target><format type='%s'/></target></volume>" %
+                self.fmt)
+
+class FailingFile(object):
+    def read(self, size):
+        ignore = size
+        raise IOError("disk on fire")
+
+class TestUpload(unittest.TestCase):
+
+    def _upload(self, content, maxsend, chunksize):
+        stream = FakeStream(maxsend)
+        total = _upload.upload(stream, StringIO.StringIO(content),
+                               len(content), progress.BaseMeter(), "test",
+                               chunksize)
+        self.assertEquals(total, len(content))
+        self.assertEquals("".join(stream.data), content)
+        self.assertTrue(stream.finished)
+        return stream
+
+    def testUpload(self):
+        content = "".join([chr(i % 256) for i in range(100000)])
+        stream = self._upload(content, 1024 * 1024, 8192)
+        self.assertEquals(stream.sends, 13)
+
+    def testPartialSends(self):
+        content = "".join([chr(i % 256) for i in range(100000)])
+        stream = self._upload(content, 3000, 8192)
+        # 12 full chunks need 3 sends each, the short last one needs 1
+        self.assertEquals(stream.sends, 12 * 3 + 1)
+
+    def testEmpty(self):
+        self._upload("", 1024, 8192)
+
+    def testReadError(self):
+        stream = FakeStream(1024)
+        self.assertRaises(IOError, _upload.upload, stream, FailingFile(),
+                          100, progress.BaseMeter(), "test")
+        self.assertFalse(stream.finished)
+
+class TestSparseUpload(unittest.TestCase):
+
+    MB = 1024 * 1024
+
+    def setUp(self):
+        # 16M image with data at 0, a zero filled run, data at 8M and a
+        # trailing hole
+        fd, self.path = tempfile.mkstemp(prefix="virtinst-upload")
+        f = os.fdopen(fd, "wb")
+        f.write("a" * self.MB)
+        f.write("\0" * 3 * self.MB)
+        f.seek(8 * self.MB)
+        f.write("b" * self.MB)
+        f.truncate(16 * self.MB)
+        f.close()
+        self.fileobj = open(self.path, "rb")
+
+    def tearDown(self):
+        self.fileobj.close()
+        os.unlink(self.path)
+
+    def _progress(self):
+        return _upload._Progress(progress.BaseMeter(), 16 * self.MB, "test")
+
+    def testRegions(self):
+        regions = _upload.get_data_regions(self.fileobj, 16 * self.MB)
+        self.assertEquals(regions, [(0, self.MB), (8 * self.MB, self.MB)])
+
+    def testSparseStream(self):
+        conn = FakeConn()
+        regions = [(0, self.MB), (8 * self.MB, self.MB)]
+        prog = self._progress()
+        _upload._upload_sparse_stream(conn, None, self.fileobj,
+                                      16 * self.MB, regions, None, prog)
+
+        stream = conn.streams[0]
+        self.assertEquals(stream.upload_args,
+                          (0, 16 * self.MB,
+                           _upload.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM))
+        self.assertEquals([d[0] == "hole" and d or len(d)
+                           for d in stream.data],
+                          [self.MB, ("hole", 7 * self.MB), self.MB,
+                           ("hole", 7 * self.MB)])
+        self.assertEquals((prog.done, prog.sent),
+                          (16 * self.MB, 2 * self.MB))
+
+    def testExtents(self):
+        conn = FakeConn()
+        regions = [(0, self.MB), (8 * self.MB, self.MB)]
+        prog = self._progress()
+        _upload._upload_extents(conn, None, self.fileobj, 16 * self.MB,
+                                regions, None, prog)
+
+        self.assertEquals([s.upload_args for s in conn.streams],
+                          [(0, self.MB, 0), (8 * self.MB, self.MB, 0)])
+        self.assertEquals("".join(conn.streams[1].data), "b" * self.MB)
+        self.assertEquals((prog.done, prog.sent),
+                          (16 * self.MB, 2 * self.MB))
+
+    def testExtentsRawOnly(self):
+        filetype = _upload.VIR_STORAGE_VOL_FILE
+        self.assertTrue(_upload._can_upload_extents(FakeVol(filetype,
+                                                            "raw")))
+        self.assertFalse(_upload._can_upload_extents(FakeVol(filetype,
+                                                             "qcow2")))
+        self.assertFalse(_upload._can_upload_extents(FakeVol(filetype + 1,
+                                                             "raw")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -30,6 +30,7 @@ from virtinst import VirtualCharDevice
 from virtinst import VirtualVideoDevice
 from virtinst import VirtualController
 from virtinst import VirtualWatchdog
+from virtinst import _domcache
 from virtinst import VirtualInputDevice
 import utils
 
@@ -395,6 +396,38 @@ class TestXMLConfig(unittest.TestCase):
         g.disks.append(utils.get_filedisk())
         self._compare(g, "install-paravirt-import", False)
 
+    def testInstallBatch(self):
+        guests = []
+        for idx in range(3):
+            i = utils.make_import_installer()
+            g = utils.get_basic_fullyvirt_guest(installer=i)
+            g.name = "TestBatch%d" % idx
+            g.uuid = "12345678-1234-1234-1234-12345678901%d" % idx
+            g.disks.append(utils.get_blkdisk())
+
+            def new_getxml(install=True, disk_boot=False,
+                           old_getxml=g.get_config_xml):
+                xml = old_getxml(install, disk_boot)
+                return utils.sanitize_xml_for_define(xml)
+            g.get_xml_config = new_getxml
+            guests.append(g)
+
+        # Collides with the first guest, and must fail on its own
+        guests[2].name = "TestBatch0"
+
+        results = virtinst.Provisioner.start_install_batch(guests, jobs=2,
+                                                           noboot=True)
+        try:
+            self.assertEquals([r.success for r in results],
+                              [True, True, False])
+            self.assertEquals([r.domain and r.domain.name()
+                               for r in results],
+                              ["TestBatch0", "TestBatch1", None])
+        finally:
+            for r in results:
+                if r.domain:
+                    r.domain.undefine()
+
     def testQEMUDriverName(self):
         utils.set_conn(_plainkvm)
         g = utils.get_basic_fullyvirt_guest()
@@ -944,6 +977,94 @@ class TestXMLConfig(unittest.TestCase):
             if util and origfunc:
                 util.default_bridge2 = origfunc
 
+    def testPathAndMACInUse(self):
+        conn = utils.open_testdriver()
+
+        self.assertEquals(VirtualDisk.path_in_use_by(conn,
+                                                     "/disk-pool/diskvol1"),
+                          ["test-for-clone"])
+        self.assertEquals(VirtualDisk.path_in_use_by(conn,
+                                            "/default-pool/sharevol.img",
+                                            check_conflict=True), [])
+        self.assertEquals(VirtualDisk.path_in_use_by(conn, "/nonexistent"),
+                          [])
+
+        snapshot = _domcache.get_snapshot(conn)
+        active, inactive = snapshot.mac_in_use_by("11:22:33:12:34:ab")
+        self.assertEquals(active + inactive, ["test-for-clone"])
+
+        # Undefining a guest must be picked up by the cached lookups
+        vm = conn.lookupByName("test-for-clone")
+        vm.destroy()
+        vm.undefine()
+        self.assertEquals(VirtualDisk.path_in_use_by(conn,
+                                                     "/disk-pool/diskvol1"),
+                          [])
+
+    def testFetchAllGuests(self):
+        conn = utils.open_testdriver()
+        util = getattr(virtinst, "_util")
+
+        def names(vms):
+            return sorted([vm.name() for vm in vms])
+
+        active, inactive = util.fetch_all_guests(conn)
+        loopactive, loopinactive = util._fetch_all_guests_loop(conn)
+        self.assertEquals(names(active), names(loopactive))
+        self.assertEquals(names(inactive), names(loopinactive))
+
+        xmlactive, xmlinactive = util.fetch_all_guest_xml(conn)
+        self.assertEquals(names([vm for vm, ignore in xmlactive]),
+                          names(active))
+        self.assertEquals(names([vm for vm, ignore in xmlinactive]),
+                          names(inactive))
+        for vm, xml in xmlactive + xmlinactive:
+            self.assertTrue(("<name>%s</name>" % vm.name()) in xml)
+
+    def testBuildXMLFragments(self):
+        utils.set_conn(_plainkvm)
+
+        i = utils.make_distro_installer(gtype="kvm")
+        g = utils.get_basic_fullyvirt_guest("kvm", installer=i)
+        g.disks.append(utils.get_filedisk())
+        g.nics.append(utils.get_virtual_network())
+
+        calls = []
+        disk = g.get_devices("disk")[0]
+        origxml = disk.get_xml_config
+        def get_xml_config(*args, **kwargs):
+            calls.append(1)
+            return origxml(*args, **kwargs)
+        disk.get_xml_config = get_xml_config
+
+        g._prepare_install(progress.BaseMeter())
+        try:
+            start_xml, final_xml = g._build_xml(True)
+            self.assertEquals(len(calls), 1)
+            self.assertEquals(start_xml, g.get_config_xml(install=True))
+            self.assertEquals(final_xml, g.get_config_xml(install=False))
+            self.assertTrue(g._xml_fragments is None)
+        finally:
+            g._cleanup_install()
+
+    def testGenerateNames(self):
+        existing = ["web-clone", "web-clone1", "web-clone3"]
+        self.assertEquals(
+            virtinst._util.generate_names("web-clone", existing, 3, sep=""),
+            ["web-clone2", "web-clone4", "web-clone5"])
+        self.assertEquals(
+            virtinst._util.generate_names("vol", ["vol.img"], suffix=".img"),
+            ["vol-1.img"])
+        self.assertEquals(
+            virtinst._util.generate_names("br", [], sep="", force_num=True),
+            ["br0"])
+
+        conn = utils.get_conn()
+        names = virtinst._util.list_guest_names(conn)
+        self.assertTrue("test" in names)
+        self.assertEquals(virtinst._util.generate_names("test", names, 2),
+                          ["test-1", "test-2"])
+
     def testCpustrToTuple(self):
         conn = utils.get_conn()
         base = [False] * 16
@@ -15,10 +15,12 @@
 # MA 02110-1301 USA.
 
 import unittest
+import gc
 import glob
 import traceback
 
 import virtinst
+from virtinst import XMLBuilderDomain
 
 import utils
 
@@ -726,6 +728,69 @@ class XMLParseTest(unittest.TestCase):
 
         self._alter_compare(guest.get_config_xml(), outfile)
 
+    def testCachedLookups(self):
+        """
+        Make sure cached xpath results don't outlive structural edits
+        """
+        infile  = "tests/xmlparse-xml/add-devices-in.xml"
+        guest = virtinst.Guest(conn=conn,
+                               parsexml=file(infile).read())
+
+        disks = guest.get_devices("disk")
+        self.assertEquals(disks[1].path, "/tmp/test.img")
+        self.assertEquals(disks[3].driver_cache, None)
+
+        guest.remove_device(disks[0])
+        self.assertEquals(disks[1].path, "/tmp/test.img")
+        self.assertEquals(disks[2].path, "/dev/loop0")
+
+        check = self._make_checker(disks[3])
+        check("driver_cache", None, "none", "writeback")
+        check("target", "hdc", "hdd")
+        self.assertEquals(disks[2].driver_cache, None)
+
+        xml = guest.get_config_xml()
+        self.assertFalse("testvol1.img" in xml)
+        self.assertTrue("<driver cache=\"writeback\"/>" in xml)
+
+    def testDocRegistry(self):
+        gc.collect()
+        orig = XMLBuilderDomain.get_doc_registry_stats()
+
+        infile  = "tests/xmlparse-xml/add-devices-in.xml"
+        guest = virtinst.Guest(conn=conn,
+                               parsexml=file(infile).read())
+        guest.add_device(virtinst.VirtualWatchdog(conn))
+        stats = XMLBuilderDomain.get_doc_registry_stats()
+        self.assertEquals(stats["docs"], orig["docs"] + 2)
+        self.assertEquals(stats["owners"], stats["contexts"])
+
+        del(guest)
+        gc.collect()
+        self.assertEquals(XMLBuilderDomain.get_doc_registry_stats(), orig)
+
+    def testIndexedLookups(self):
+        infile  = "tests/xmlparse-xml/add-devices-in.xml"
+        guest = virtinst.Guest(conn=conn,
+                               parsexml=file(infile).read())
+        contexts = XMLBuilderDomain.get_doc_registry_stats()["contexts"]
+
+        # Simple lookups are answered from the index built while parsing
+        disks = guest.get_devices("disk")
+        self.assertEquals(disks[1].path, "/tmp/test.img")
+        self.assertEquals(disks[2].path, "/dev/loop0")
+        self.assertEquals(disks[2].target, "vdb")
+        self.assertEquals(guest.emulator, "/usr/lib/xen/bin/qemu-dm")
+        self.assertEquals(XMLBuilderDomain.get_doc_registry_stats()["contexts"],
+                          contexts)
+
+        # Edits drop the index, and lookups still see the new XML
+        guest.remove_device(disks[1])
+        check = self._make_checker(disks[2])
+        check("driver_cache", None, "none")
+        self.assertEquals(disks[2].path, "/dev/loop0")
+        self.assertEquals(disks[0].target, "fda")
+
     def testChangeKVMMedia(self):
         infile  = "tests/xmlparse-xml/change-media-in.xml"
         outfile = "tests/xmlparse-xml/change-media-out.xml"
@@ -27,6 +27,7 @@ import re
 import logging
 
 from virtconv import _gettext as _
+from virtinst import _diskio
 
 DISK_FORMAT_NONE = 0
 DISK_FORMAT_RAW = 1
@@ -139,7 +140,17 @@ class disk(object):
         """Copy an individual file."""
         self.clean += [ outfile ]
         ensuredirs(outfile)
-        shutil.copy(infile, outfile)
+        if os.path.isdir(outfile):
+            outfile = os.path.join(outfile, os.path.basename(infile))
+        if os.path.exists(outfile):
+            os.unlink(outfile)
+
+        # Use reflink/in kernel copies where possible
+        size = os.path.getsize(infile)
+        job = _diskio.CloneEngine().clone(infile, outfile, size, True)
+        shutil.copymode(infile, outfile)
+        logging.debug("Copied %s to %s using %s", infile, outfile,
+                      job.backend.name)
 
     def out_file(self, out_format):
         """Return the relative path of the output file."""
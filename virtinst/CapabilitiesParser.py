@@ -20,6 +20,8 @@
 # MA 02110-1301 USA.
 
 import re
+import threading
+import weakref
 
 from virtinst import _gettext as _
 import _util
@@ -678,6 +680,69 @@ def parse(xml):
                                    Capabilities,
                                    CapabilitiesParserException)
 
+# Parsed capabilities shared between all users of a connection
+_caps_cache = weakref.WeakKeyDictionary()
+_caps_cache_lock = threading.Lock()
+_caps_cache_stats = {"hits": 0, "misses": 0}
+
+def get_caps(conn):
+    """
+    Return the Capabilities for the passed connection. The XML is
+    fetched and parsed once per connection, and the same instance is
+    handed to every caller, so it must be treated as read only.
+
+    @param conn: virConnect instance
+    @type conn: libvirt.virConnect
+
+    @returns: L{Capabilities} instance
+    """
+    _caps_cache_lock.acquire()
+    try:
+        try:
+            caps = _caps_cache.get(conn)
+        except TypeError:
+            # Connection object doesn't support weak references
+            caps = None
+
+        if caps:
+            _caps_cache_stats["hits"] += 1
+            return caps
+
+        _caps_cache_stats["misses"] += 1
+        caps = parse(conn.getCapabilities())
+        try:
+            _caps_cache[conn] = caps
+        except TypeError:
+            pass
+        return caps
+    finally:
+        _caps_cache_lock.release()
+
+def invalidate_caps(conn):
+    """
+    Drop the cached Capabilities for the passed connection, e.g. after
+    the host configuration changed
+    """
+    _caps_cache_lock.acquire()
+    try:
+        try:
+            if conn in _caps_cache:
+                del(_caps_cache[conn])
+        except TypeError:
+            pass
+    finally:
+        _caps_cache_lock.release()
+
+def get_caps_cache_stats():
+    """
+    Return a dict with the 'hits' and 'misses' counts of get_caps
+    """
+    _caps_cache_lock.acquire()
+    try:
+        return _caps_cache_stats.copy()
+    finally:
+        _caps_cache_lock.release()
+
 def guest_lookup(conn, caps=None, os_type=None, arch=None, type=None,
                  accelerated=False, machine=None):
     """
@@ -716,7 +781,7 @@ def guest_lookup(conn, caps=None, os_type=None, arch=None, type=None,
     """
 
     if not caps:
-        caps = parse(conn.getCapabilities())
+        caps = get_caps(conn)
 
     guest = caps.guestForOSType(type=os_type, arch=arch)
     if not guest:
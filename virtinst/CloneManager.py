@@ -30,11 +30,19 @@ General workflow for cloning:
     - Run 'setup' from the CloneDesign instance to prep for cloning
 
     - Run 'CloneManager.start_duplicate', passing the CloneDesign instance
+
+To make several clones of the same original in one go, set up a single
+CloneDesign with the original guest and cloning options, pass it to
+'CloneManager.setup_clone_batch', and pass the returned designs to
+'CloneManager.start_duplicate_batch'.
 """
 
+import copy
 import logging
 import re
 import os
+import stat
+import threading
 
 import libxml2
 import urlgrabber.progress as progress
@@ -44,8 +52,11 @@ import Guest
 from VirtualNetworkInterface import VirtualNetworkInterface
 from VirtualDisk import VirtualDisk
 from virtinst import Storage
+from virtinst import support
 from virtinst import _gettext as _
 import _util
+import _diskio
+import _domcache
 
 def _listify(val):
     """
@@ -56,7 +67,8 @@ def _listify(val):
     else:
         return False, [val]
 
-def generate_clone_disk_path(origpath, design, newname=None):
+def generate_clone_disk_path(origpath, design, newname=None,
+                             collidelist=None):
     origname = design.original_guest
     newname = newname or design.clone_name
     path = origpath
@@ -84,9 +96,16 @@ def generate_clone_disk_path(origpath, design, newname=None):
                     clonebase,
                     lambda p: VirtualDisk.path_exists(design.original_conn, p),
                     suffix,
-                    lib_collision=False)
+                    lib_collision=False,
+                    collidelist=collidelist)
 
 def generate_clone_name(design):
+    return generate_clone_names(design, 1)[0]
+
+def generate_clone_names(design, count):
+    """
+    Return a list of count unused names for clones of the original guest
+    """
     # If the orig name is "foo-clone", we don't want the clone to be
     # "foo-clone-clone", we want "foo-clone1"
     basename = design.original_guest
@@ -100,11 +119,53 @@ def generate_clone_name(design):
         basename = basename.replace(match.group(), "")
 
     basename = basename + "-clone"
-    return _util.generate_name(basename,
-                               design.original_conn.lookupByName,
-                               sep="", start_num=start_num)
+    return _util.generate_names(basename,
+                                _util.list_guest_names(design.original_conn),
+                                count, sep="", start_num=start_num)
 
 
+# Longest backing chain get_linked_clones follows, which also stops it
+# going around in circles on a broken chain
+_MAX_CHAIN_DEPTH = 16
+
+def _get_backing_chain(path):
+    ret = []
+    while len(ret) < _MAX_CHAIN_DEPTH:
+        try:
+            path = _diskio.get_backing_file(path)
+        except (IOError, OSError):
+            break
+        if not path or path in ret:
+            break
+        ret.append(path)
+    return ret
+
+def get_linked_clones(conn, path):
+    """
+    Return the names of guests with a disk that is a qcow2 overlay of
+    path, directly or further down its backing chain. Storage at path
+    must not be removed, or its guest replaced, while any are left.
+
+    Only local disks can be inspected: for remote connections the list
+    is always empty.
+    """
+    if _util.is_uri_remote(conn.getURI()):
+        return []
+
+    path = os.path.abspath(path)
+    snapshot = _domcache.get_snapshot(conn)
+
+    names = []
+    for diskpath in snapshot.disk_paths():
+        if diskpath == path or not os.path.isfile(diskpath):
+            continue
+        if path not in _get_backing_chain(diskpath):
+            continue
+        for name in snapshot.path_in_use_by(diskpath):
+            if name not in names:
+                names.append(name)
+    return names
+
 #
 # This class is the design paper for a clone virtual machine.
 #
@@ -133,10 +194,14 @@ class CloneDesign(object):
         self._clone_devices      = []
         self._clone_virtual_disks = []
         self._clone_bs           = 1024 * 1024 * 10
+        self._clone_jobs         = 4
+        self._clone_jobs_per_device = 1
         self._clone_mac          = []
         self._clone_uuid         = None
         self._clone_sparse       = True
+        self._clone_linked       = False
         self._clone_xml          = None
+        self._linked_chain       = []
 
         self._force_target       = []
         self._skip_target        = []
@@ -270,6 +335,28 @@ class CloneDesign(object):
     clone_bs = property(get_clone_bs, set_clone_bs,
                         doc="Block size to use when cloning guest storage.")
 
+    def get_clone_jobs(self):
+        return self._clone_jobs
+    def set_clone_jobs(self, val):
+        if type(val) not in [int, long] or val < 1:
+            raise ValueError(_("Clone jobs must be a positive integer."))
+        self._clone_jobs = val
+    clone_jobs = property(get_clone_jobs, set_clone_jobs,
+                          doc="Maximum number of disks to clone "
+                              "concurrently.")
+
+    def get_clone_jobs_per_device(self):
+        return self._clone_jobs_per_device
+    def set_clone_jobs_per_device(self, val):
+        if type(val) not in [int, long] or val < 1:
+            raise ValueError(_("Clone jobs must be a positive integer."))
+        self._clone_jobs_per_device = val
+    clone_jobs_per_device = property(get_clone_jobs_per_device,
+                                     set_clone_jobs_per_device,
+                                     doc="Maximum number of disks to clone "
+                                         "concurrently from the same source "
+                                         "device, filesystem or pool.")
+
     def get_original_devices_size(self):
         ret = []
         for disk in self.original_virtual_disks:
@@ -326,6 +413,22 @@ class CloneDesign(object):
                             doc="Whether to attempt sparse allocation during "
                                 "cloning.")
 
+    def get_clone_linked(self):
+        return self._clone_linked
+    def set_clone_linked(self, val):
+        self._clone_linked = bool(val)
+    clone_linked = property(get_clone_linked, set_clone_linked,
+                            doc="If enabled, don't copy the original disks: "
+                                "create qcow2 overlays that use them as "
+                                "their backing files instead. The original "
+                                "must be shut off, or the disks readonly.")
+
+    def get_linked_chain(self):
+        return self._linked_chain
+    linked_chain = property(get_linked_chain,
+                            doc="List of (clone path, backing path) for "
+                                "each disk set up as a linked clone.")
+
     def get_preserve(self):
         return self._preserve
     def set_preserve(self, flg):
@@ -421,6 +524,9 @@ class CloneDesign(object):
                 raise RuntimeError(_("Domain with devices to clone must be "
                                      "paused or shutoff."))
 
+        if self.clone_linked:
+            self._check_linked_original()
+
 
     def setup_clone(self):
         """
@@ -438,6 +544,11 @@ class CloneDesign(object):
         doc = libxml2.parseDoc(self._clone_xml)
         ctx = doc.xpathNewContext()
 
+        if self.clone_linked and self._clone_name == self.original_guest:
+            raise ValueError(_("A linked clone can not replace the original "
+                               "guest it is backed by."))
+        self._linked_chain = []
+
         # changing name
         node = ctx.xpathEval("/domain/name")
         node[0].setContent(self._clone_name)
@@ -491,7 +602,10 @@ class CloneDesign(object):
                 clone_disk.size = orig_disk.size
 
             # Setup proper cloning inputs for the new virtual disks
-            if orig_disk.vol_object and clone_disk.vol_install:
+            if self.clone_linked and orig_disk.path:
+                self._setup_linked_disk(ctx, orig_disk, clone_disk)
+
+            elif orig_disk.vol_object and clone_disk.vol_install:
 
                 # Source and dest are managed. If they share the same pool,
                 # replace vol_install with a CloneVolume instance, otherwise
@@ -528,8 +642,137 @@ class CloneDesign(object):
     def remove_original_vm(self, force=None):
         return self._valid_guest.remove_original_vm(force=force)
 
+    def _copy_for_batch(self, name, uuid, macs):
+        """
+        Return a copy of this design, sharing the already set up original
+        guest info and cloning options, for a clone with the passed name,
+        uuid and MAC addresses. These have already been checked against
+        the whole batch, so they are not validated again.
+        """
+        ret = copy.copy(self)
+
+        # Each clone needs its own validation guest, which
+        # remove_original_vm looks up the clone name of
+        ret._valid_guest = copy.copy(self._valid_guest)
+        ret._valid_guest._name = name
+
+        ret._clone_name = name
+        ret._clone_uuid = uuid
+        ret._clone_mac = macs
+        ret._clone_devices = []
+        ret._clone_virtual_disks = []
+        ret._clone_xml = None
+        ret._linked_chain = []
+        return ret
+
     # Private helper functions
 
+    def _check_linked_original(self):
+        """
+        Linked clones read the original disks as their backing files, so
+        those must not change: each disk has to be readonly, or the
+        original guest shut off.
+        """
+        hvtype = _util.get_xml_path(self.original_xml, "/domain/@type")
+        if hvtype not in ["qemu", "kvm"]:
+            raise ValueError(_("Linked clones are only supported for QEMU "
+                               "and KVM guests."))
+        if self.preserve_dest_disks:
+            raise ValueError(_("Linked clones require cloning storage."))
+
+        dom = self._original_dom
+        if not dom and self.original_guest:
+            try:
+                dom = self._hyper_conn.lookupByName(self.original_guest)
+            except libvirt.libvirtError:
+                # Cloning from XML of a guest that isn't defined
+                pass
+        if not dom or dom.info()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
+            return
+
+        for disk in self.original_virtual_disks:
+            ro = _util.get_xml_path(self.original_xml,
+                    "count(/domain/devices/disk[target/@dev='%s']/readonly)" %
+                    disk.target)
+            if disk.path and not ro:
+                raise RuntimeError(_("Domain must be shut off to make a "
+                                     "linked clone of its writable disk "
+                                     "'%s'.") % disk.target)
+
+    def _detect_backing_format(self, orig_disk):
+        """
+        Find the image format of orig_disk, whose XML doesn't name one,
+        from its storage volume or the image header. Guessing wrong would
+        have the overlay misread its backing image, so refuse otherwise.
+        """
+        fmt = None
+        if orig_disk.vol_object:
+            fmt = _util.get_xml_path(orig_disk.vol_object.XMLDesc(0),
+                                     "/volume/target/format/@type")
+        elif not _util.is_uri_remote(self.original_conn.getURI()):
+            try:
+                fmt = _diskio.get_image_format(orig_disk.path)
+            except (OSError, IOError), e:
+                logging.debug("Couldn't read the header of '%s': %s",
+                              orig_disk.path, str(e))
+
+        if not fmt:
+            raise ValueError(_("Couldn't determine the image format of "
+                               "'%s' for a linked clone. Set the driver "
+                               "type of its disk.") % orig_disk.path)
+        logging.debug("Detected format %s for linked clone source %s",
+                      fmt, orig_disk.path)
+        return fmt
+
+    def _setup_linked_disk(self, ctx, orig_disk, clone_disk):
+        """
+        Set up clone_disk as a qcow2 overlay backed by orig_disk, and
+        switch the clone's XML for the disk to qcow2
+        """
+        if clone_disk.type != VirtualDisk.TYPE_FILE:
+            raise ValueError(_("Linked clone disk '%s' must be a file.") %
+                             clone_disk.path)
+        if (clone_disk.vol_object or
+            (not clone_disk.vol_install and
+             os.path.exists(clone_disk.path))):
+            raise ValueError(_("Linked clone disk '%s' already exists.") %
+                             clone_disk.path)
+
+        base_path = ("/domain/devices/disk[target/@dev='%s']" %
+                     orig_disk.target)
+        driver = ctx.xpathEval(base_path + "/driver")
+        driver = driver and driver[0] or None
+        backing_format = driver and driver.prop("type") or None
+        if not backing_format:
+            backing_format = self._detect_backing_format(orig_disk)
+
+        if clone_disk.vol_install:
+            if not isinstance(clone_disk.vol_install, Storage.FileVolume):
+                raise ValueError(_("Linked clone disk '%s' must be in a "
+                                   "file based storage pool.") %
+                                 clone_disk.path)
+
+            if orig_disk.vol_object:
+                capacity = orig_disk.vol_object.info()[1]
+            else:
+                capacity = long(orig_disk.size * 1024L * 1024L * 1024L)
+            clone_disk.vol_install = Storage.OverlayVolume(
+                                        clone_disk.vol_install.name,
+                                        capacity, orig_disk.path,
+                                        backing_format,
+                                        pool=clone_disk.vol_install.pool)
+        else:
+            clone_disk.clone_path = orig_disk.path
+            clone_disk.clone_backing_format = backing_format
+
+        if not driver:
+            driver = ctx.xpathEval(base_path)[0].newChild(None, "driver",
+                                                          None)
+            driver.setProp("name", "qemu")
+        driver.setProp("type", "qcow2")
+
+        self._linked_chain.append((clone_disk.path, orig_disk.path))
+
     # Check if new mac address is valid
     def _check_mac(self, mac):
         nic = VirtualNetworkInterface(macaddr=mac, conn=self.original_conn)
@@ -660,6 +903,153 @@ class CloneDesign(object):
             raise ValueError(_("Domain '%s' was not found.") % str(name))
 
 
+# Random values to try per UUID or MAC address needed, before assuming
+# the generator is stuck
+_GENERATE_TRIES = 100
+
+def _generate_clone_uuids(conn, count):
+    existing = set(_util.list_guest_uuids(conn))
+    ret = []
+    tries = count * _GENERATE_TRIES
+    while len(ret) < count:
+        if not tries:
+            raise RuntimeError(_("Failed to generate %d unique UUIDs.") %
+                               count)
+        tries -= 1
+
+        uuid = _util.uuidToString(_util.randomUUID())
+        if uuid not in existing:
+            existing.add(uuid)
+            ret.append(uuid)
+    return ret
+
+def _generate_clone_macs(design, count):
+    hvtype = design.original_conn.getType().lower()
+    used = set()
+    ret = []
+    tries = count * _GENERATE_TRIES
+    while len(ret) < count:
+        if not tries:
+            raise RuntimeError(_("Failed to generate %d unique MAC "
+                                 "addresses.") % count)
+        tries -= 1
+
+        mac = _util.randomMAC(hvtype)
+        if mac in used or design._check_mac(mac)[1] is not None:
+            continue
+        used.add(mac)
+        ret.append(mac)
+    return ret
+
+def setup_clone_batch(design, count, names=None):
+    """
+    Set up count clones of the original guest of design, which must have
+    its original guest or xml and any cloning options set. The original is
+    looked up and its storage validated once for the whole batch.
+
+    Clone names default to generate_clone_names, and are otherwise taken
+    from the passed list. UUIDs and MAC addresses are allocated in bulk
+    and are unique across the batch. Cloned disks get the paths
+    generate_clone_disk_path picks for each clone's name.
+
+    @returns: List of set up CloneDesign instances, one per clone, to pass
+              to start_duplicate_batch
+    """
+    if type(count) not in [int, long] or count < 1:
+        raise ValueError(_("Clone count must be a positive integer."))
+    if names is not None and len(names) != count:
+        raise ValueError(_("%(count)d clone names needed, %(passed)d "
+                           "passed.") % {"count" : count,
+                                         "passed" : len(names)})
+
+    design.setup_original()
+    logging.debug("Original guest xml is\n%s", design.original_xml)
+    conn = design.original_conn
+
+    if names is None:
+        names = generate_clone_names(design, count)
+    else:
+        existing = []
+        if not design.replace:
+            existing = _util.list_guest_names(conn)
+        for name in names:
+            try:
+                _util.validate_name(_("Guest"), name, lencheck=True)
+            except ValueError, e:
+                raise ValueError(_("Invalid name for new guest: %s") % e)
+            if name in existing or names.count(name) > 1:
+                raise ValueError(_("Guest name '%s' is already in use.") %
+                                 name)
+
+    nics = int(_util.get_xml_path(design.original_xml,
+                                  "count(/domain/devices/interface)"))
+    uuids = _generate_clone_uuids(conn, count)
+    macs = _generate_clone_macs(design, count * nics)
+
+    designs = []
+    reserved = []
+    for idx in range(count):
+        clone = design._copy_for_batch(names[idx], uuids[idx],
+                                       macs[idx * nics:(idx + 1) * nics])
+
+        paths = []
+        for origpath in design.original_devices:
+            path = None
+            if origpath:
+                path = generate_clone_disk_path(origpath, clone,
+                                                collidelist=reserved)
+                reserved.append(path)
+            paths.append(path)
+        clone.clone_devices = paths
+
+        clone.setup_clone()
+        logging.debug("Clone guest xml is\n%s", clone.clone_xml)
+        designs.append(clone)
+
+    return designs
+
+def start_duplicate_batch(designs, meter=None, meters=None):
+    """
+    Define every clone returned by setup_clone_batch and clone their
+    storage. Each disk of the original is read once for all the clones
+    where that's possible, see VirtualDisk.setup_clones. If any clone
+    fails, all of them are undefined and their new storage removed.
+
+    @param meter: Meter to report the progress of the whole batch to
+    @param meters: Optional list of meters, one for each clone, to report
+                   per clone progress to instead
+    """
+    logging.debug("Starting duplicate of %d clones.", len(designs))
+
+    if not meter:
+        meter = progress.BaseMeter()
+    conn = designs[0].original_conn
+
+    doms = []
+    created = []
+    try:
+        for design in designs:
+            design.remove_original_vm()
+            doms.append(conn.defineXML(design.clone_xml))
+        _domcache.invalidate(conn)
+
+        if designs[0].preserve == True:
+            _do_duplicate_batch(designs, meter, meters, created)
+
+    except Exception, e:
+        logging.debug("Batch duplicate failed: %s", str(e))
+        for dom in doms:
+            try:
+                dom.undefine()
+            except libvirt.libvirtError, undef_e:
+                logging.debug("Failed to undefine clone: %s", str(undef_e))
+        if doms:
+            _domcache.invalidate(conn)
+        _remove_created_storage(created)
+        raise
+
+    logging.debug("Duplicating finished.")
+
 def start_duplicate(design, meter=None):
     """
     Actually perform the duplication: cloning disks if needed and defining
@@ -672,29 +1062,147 @@ def start_duplicate(design, meter=None):
         meter = progress.BaseMeter()
 
     dom = None
+    created = []
     try:
         # Replace orig VM if required
         design.remove_original_vm()
 
         # Define domain early to catch any xml errors before duping storage
         dom = design.original_conn.defineXML(design.clone_xml)
+        _domcache.invalidate(design.original_conn)
 
         if design.preserve == True:
-            _do_duplicate(design, meter)
+            _do_duplicate(design, meter, created)
 
     except Exception, e:
         logging.debug("Duplicate failed: %s", str(e))
         if dom:
             dom.undefine()
+            _domcache.invalidate(design.original_conn)
+        _remove_created_storage(created)
         raise
 
     logging.debug("Duplicating finished.")
 
-# Iterate over the list of disks, and clone them using the appropriate
-# clone method
-def _do_duplicate(design, meter):
+def _remove_created_storage(disks):
+    """
+    Roll back a failed clone by removing any storage we created
+    """
+    for disk in disks:
+        try:
+            if disk.vol_install:
+                vol = disk.vol_object
+                if not vol:
+                    pool = disk.vol_install.pool
+                    vol = pool.storageVolLookupByName(disk.vol_install.name)
+                logging.debug("Removing volume '%s'", vol.path())
+                vol.delete(0)
+            elif disk.path and os.path.exists(disk.path):
+                users = disk.conn and get_linked_clones(disk.conn, disk.path)
+                if users:
+                    logging.debug("Not removing '%s', it backs linked "
+                                  "clones %s", disk.path, users)
+                    continue
+                logging.debug("Removing '%s'", disk.path)
+                os.unlink(disk.path)
+        except Exception, e:
+            logging.debug("Failed to remove clone storage '%s': %s",
+                          disk.path, str(e))
+
+def _clone_source_key(disk):
+    """
+    Return a key identifying the device, filesystem or pool a clone
+    reads from, so concurrent clones can be limited per spindle
+    """
+    if disk.vol_install and disk.vol_install.input_vol:
+        vol = disk.vol_install.input_vol
+        return "pool:%s" % vol.storagePoolLookupByVolume().name()
 
-    # Now actually do the cloning
+    path = disk.clone_path
+    try:
+        statinfo = os.stat(path)
+    except OSError:
+        return "path:%s" % path
+
+    if not stat.S_ISBLK(statinfo.st_mode):
+        return "dev:%d" % statinfo.st_dev
+
+    # Map partitions back to their parent disk
+    sysdir = "/sys/dev/block/%d:%d" % (os.major(statinfo.st_rdev),
+                                       os.minor(statinfo.st_rdev))
+    try:
+        if os.path.exists(os.path.join(sysdir, "partition")):
+            devfile = os.path.join(os.path.realpath(sysdir), "..", "dev")
+            return "blk:%s" % open(devfile).read().strip()
+    except Exception, e:
+        logging.debug("Couldn't lookup parent of '%s': %s", path, str(e))
+    return "blk:%d" % statinfo.st_rdev
+
+def _clone_thread(errors, name, func, *args):
+    try:
+        func(*args)
+    except Exception, e:
+        _util.log_exception("Error cloning '%s'" % name)
+        errors.append(e)
+
+def _track_created(created, disk):
+    if disk.vol_install or not os.path.exists(disk.path):
+        created.append(disk)
+
+def _run_clone_threads(pending, maxjobs, jobs_per_device, meters, created):
+    """
+    Run the (key, disks, func, args) items of pending, each calling
+    func(*args) to clone its disks in a thread. At most maxjobs items run
+    at once, and at most jobs_per_device of them with the same source
+    key. The aggregate meters are updated while we wait, and any storage
+    we start creating is appended to created. After the first error no
+    more items are started, and local copies still running are aborted.
+    """
+    running = []
+    errors = []
+
+    while pending or running:
+        running = [r for r in running if r[0].isAlive()]
+        if errors:
+            pending = []
+            for r in running:
+                r[2].set()
+
+        for item in pending[:]:
+            key, disks, func, args = item
+            if len(running) >= maxjobs:
+                break
+            if len([r for r in running if r[1] == key]) >= jobs_per_device:
+                continue
+
+            pending.remove(item)
+            abort = threading.Event()
+            for disk in disks:
+                _track_created(created, disk)
+                disk.clone_abort = abort
+            logging.debug("Starting clone of %s (source %s)",
+                          [d.path for d in disks], key)
+
+            t = threading.Thread(target=_clone_thread,
+                                 name="Cloning %s" % disks[0].path,
+                                 args=(errors, disks[0].path, func) + args)
+            t.setDaemon(True)
+            t.start()
+            running.append((t, key, abort))
+
+        if running:
+            running[0][0].join(0.25)
+        for meter in meters:
+            meter.update()
+
+    if errors:
+        raise errors[0]
+
+def _get_clone_todo(design, engine):
+    """
+    Return the clone disks of design that need their storage copied
+    """
+    todo = []
     for dst_dev in design.clone_virtual_disks:
         if dst_dev.clone_path == "/dev/null":
             # Not really sure why this check was here, but keeping for compat
@@ -704,5 +1212,128 @@ def _do_duplicate(design, meter):
             logging.debug("Source and destination are the same. Skipping.")
             continue
 
-        # VirtualDisk.setup handles everything
-        dst_dev.setup(meter)
+        if not dst_dev.clone_engine:
+            dst_dev.clone_engine = engine
+        todo.append(dst_dev)
+    return todo
+
+def _get_max_clone_jobs(design):
+    if not support.support_threading():
+        return 1
+    return design.clone_jobs
+
+def _disk_bytes(disk):
+    return long((disk.size or 0) * 1024L * 1024L * 1024L)
+
+# Iterate over the list of disks, and clone them using the appropriate
+# clone method. Disks are cloned concurrently, up to design.clone_jobs at
+# once and design.clone_jobs_per_device for each source device. Any
+# storage we start creating is appended to 'created'
+def _do_duplicate(design, meter, created=None):
+    if created is None:
+        created = []
+
+    maxjobs = _get_max_clone_jobs(design)
+
+    # Share one engine, and its buffers, between all the local clones
+    engine = _diskio.CloneEngine(blocksize=design.clone_bs)
+    engine.set_concurrency(maxjobs)
+
+    # Now actually do the cloning
+    todo = _get_clone_todo(design, engine)
+
+    if maxjobs == 1 or len(todo) <= 1:
+        for dst_dev in todo:
+            _track_created(created, dst_dev)
+            dst_dev.setup(meter)
+        return
+
+    sizes = [_disk_bytes(d) for d in todo]
+    aggmeter = _util.AggregateMeter(meter, sum(sizes),
+                                    text=_("Cloning %d disks") % len(todo))
+
+    pending = [(_clone_source_key(d), [d], d.setup,
+                (aggmeter.new_child(size),))
+               for d, size in zip(todo, sizes)]
+    _run_clone_threads(pending, maxjobs, design.clone_jobs_per_device,
+                       [aggmeter], created)
+    aggmeter.end()
+
+def _can_fan_out(disk):
+    """
+    Whether disk is a plain local copy, which VirtualDisk.setup_clones can
+    make alongside the other clones of the same source
+    """
+    return bool(disk.clone_path and not disk.vol_install and
+                not disk.clone_backing_format and
+                not _util.is_vdisk(disk.clone_path) and
+                not (os.path.exists(disk.path) and _util.is_vdisk(disk.path)))
+
+# Clone the storage of every design of a batch. The clones of each
+# original disk that are plain local copies are made together, reading the
+# source once; anything else, like managed volumes, is cloned per disk.
+# Each clone reports its progress to its own aggregate meter.
+def _do_duplicate_batch(designs, meter, meters, created):
+    first = designs[0]
+    maxjobs = _get_max_clone_jobs(first)
+
+    engine = _diskio.CloneEngine(blocksize=first.clone_bs)
+    engine.set_concurrency(maxjobs)
+
+    todos = [_get_clone_todo(design, engine) for design in designs]
+    sizes = [sum([_disk_bytes(d) for d in todo]) for todo in todos]
+
+    aggmeters = []
+    if meters:
+        parents = meters
+    else:
+        topmeter = _util.AggregateMeter(meter, sum(sizes),
+                                        text=_("Cloning %d guests") %
+                                        len(designs))
+        aggmeters.append(topmeter)
+        parents = [topmeter.new_child(size) for size in sizes]
+
+    # Child meters of each clone's disks, keyed by id() of the disk
+    diskmeters = {}
+    clonemeters = []
+    for design, todo, size, parent in zip(designs, todos, sizes, parents):
+        clonemeter = _util.AggregateMeter(parent, size,
+                                          text=_("Cloning %s") %
+                                          design.clone_name)
+        clonemeters.append(clonemeter)
+        for disk in todo:
+            diskmeters[id(disk)] = clonemeter.new_child(_disk_bytes(disk))
+    aggmeters = clonemeters + aggmeters
+
+    # Group the local clones of the same original disk
+    groups = {}
+    order = []
+    singles = []
+    for todo in todos:
+        for disk in todo:
+            if not _can_fan_out(disk):
+                singles.append(disk)
+                continue
+            if disk.clone_path not in groups:
+                groups[disk.clone_path] = []
+                order.append(disk.clone_path)
+            groups[disk.clone_path].append(disk)
+
+    pending = []
+    for clone_path in order:
+        disks = groups[clone_path]
+        if len(disks) == 1:
+            singles.append(disks[0])
+            continue
+        pending.append((_clone_source_key(disks[0]), disks,
+                        VirtualDisk.setup_clones,
+                        (disks, [diskmeters[id(d)] for d in disks])))
+
+    for disk in singles:
+        pending.append((_clone_source_key(disk), [disk], disk.setup,
+                        (diskmeters[id(disk)],)))
+
+    _run_clone_threads(pending, maxjobs, first.clone_jobs_per_device,
+                       aggmeters, created)
+    for aggmeter in aggmeters:
+        aggmeter.end()
@@ -19,14 +19,13 @@
 
 import logging
 import os
-import sys
-import shutil
-import subprocess
-import tempfile
 
 import Storage
 import support
 import _util
+import _cpio
+import _storageindex
+import _upload
 import Installer
 from VirtualDisk import VirtualDisk
 from User import User
@@ -67,14 +66,14 @@ def _sanitize_url(url):
     return url
 
 def _build_pool(conn, meter, path):
-    pool = _util.lookup_pool_by_path(conn, path)
+    pool = _storageindex.lookup_pool_by_path(conn, path)
     if pool:
         logging.debug("Existing pool '%s' found for %s", pool.name(), path)
         pool.refresh(0)
         return pool
 
-    name = _util.generate_name("boot-scratch",
-                               conn.storagePoolLookupByName)
+    name = _util.generate_names("boot-scratch",
+                                _util.list_pool_names(conn))[0]
     logging.debug("Building storage pool: path=%s name=%s", path, name)
     poolbuild = Storage.DirectoryPool(conn=conn, name=name,
                                       target_path=path)
@@ -85,16 +84,7 @@ def _build_pool(conn, meter, path):
                              autostart=True)
 
 
-def _upload_file(conn, meter, destpool, src):
-    # Build stream object
-    stream = conn.newStream(0)
-    def safe_send(data):
-        while True:
-            ret = stream.send(data)
-            if ret == 0 or ret == len(data):
-                break
-            data = data[ret:]
-
+def _upload_file(conn, meter, destpool, src, chunksize=None, sparse=False):
     # Build placeholder volume
     size = os.path.getsize(src)
     basename = os.path.basename(src)
@@ -115,33 +105,9 @@ def _upload_file(conn, meter, destpool, src):
         raise RuntimeError(_("Failed to lookup scratch media volume"))
 
     try:
-        # Register upload
-        offset = 0
-        length = size
-        flags = 0
-        stream.upload(vol, offset, length, flags)
-
-        # Open source file
-        fileobj = file(src, "r")
-
-        # Start transfer
-        total = 0
-        meter.start(size=size,
-                    text=_("Transferring %s") % os.path.basename(src))
-        while True:
-            #blocksize = (1024 ** 2)
-            blocksize = 1024
-            data = fileobj.read(blocksize)
-            if not data:
-                break
-
-            safe_send(data)
-            total += len(data)
-            meter.update(total)
-
-        # Cleanup
-        stream.finish()
-        meter.end(size)
+        _upload.upload_volume(conn, vol, src, meter,
+                              _("Transferring %s") % os.path.basename(src),
+                              chunksize, sparse)
     except:
         if vol:
             vol.delete(0)
@@ -276,29 +242,14 @@ class DistroInstaller(Installer.Installer):
         """
         Insert files into the root directory of the initial ram disk
         """
-        tempdir = tempfile.mkdtemp(dir=self.scratchdir)
-        os.chmod(tempdir, 0775)
-
-        for filename in self._initrd_injections:
-            logging.debug("Copying %s to the initrd.", filename)
-            shutil.copy(filename, tempdir)
-
-        logging.debug("Appending to the initrd.")
-        find_proc = subprocess.Popen(['find', '.', '-print0'],
-                                     stdout=subprocess.PIPE,
-                                     stderr=sys.stderr, cwd=tempdir)
-        cpio_proc = subprocess.Popen(['cpio', '-o', '--null', '-Hnewc', '--quiet'],
-                                     stdin=find_proc.stdout,
-                                     stdout=subprocess.PIPE,
-                                     stderr=sys.stderr, cwd=tempdir)
-        f = open(initrd, 'ab')
-        gzip_proc = subprocess.Popen(['gzip'], stdin=cpio_proc.stdout,
-                                     stdout=f, stderr=sys.stderr)
-        cpio_proc.wait()
-        find_proc.wait()
-        gzip_proc.wait()
-        f.close()
-        shutil.rmtree(tempdir)
+        logging.debug("Appending %s to the initrd.",
+                      ", ".join(self._initrd_injections))
+        try:
+            _cpio.append_archive(initrd, self._initrd_injections,
+                                 self.initrd_compress_level)
+        except (OSError, IOError), e:
+            raise RuntimeError(_("Failed to inject files into the "
+                                 "initrd: %s") % str(e))
 
     def support_remote_url_install(self):
         if not self.conn:
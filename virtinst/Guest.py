@@ -29,6 +29,8 @@ import libvirt
 import libxml2
 
 import _util
+import _domcache
+import _domainwait
 import CapabilitiesParser
 import VirtualGraphics
 import support
@@ -127,7 +129,7 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         If host doesn't have a suitable NUMA configuration, a RuntimeError
         is thrown.
         """
-        caps = CapabilitiesParser.parse(conn.getCapabilities())
+        caps = CapabilitiesParser.get_caps(conn)
 
         if caps.host.topology is None:
             raise RuntimeError(_("No topology section in capabilities xml."))
@@ -228,6 +230,9 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         self._default_input_device = None
         self._default_console_device = None
 
+        # Device XML shared by the passes of _build_xml
+        self._xml_fragments = None
+
         caps = caps or (self._installer and self._installer._get_caps())
         XMLBuilderDomain.XMLBuilderDomain.__init__(self, conn, parsexml,
                                                    caps=caps)
@@ -785,25 +790,26 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
             "redirdev"   : virtinst.VirtualRedirDevice,
         }
 
+        # Walk the XML once, indexing the whole domain and each device,
+        # so parsed objects can answer most lookups without running xpath
+        devpaths = ["./devices/%s" % name for name in device_mappings]
+        index, devindexes = XMLBuilderDomain._index_xml_tree(self._xml_node,
+                                                             devpaths)
+        self._seed_xml_index(index)
+
         # Hand off all child element parsing to relevant classes
         caps = self._get_caps()
-        for node in self._xml_node.children:
-            if node.name != "devices":
-                continue
+        for devnode, devindex in devindexes:
+            objclass = device_mappings.get(devnode.name)
 
-            children = filter(lambda x: (x.name in device_mappings and
-                                         x.parent == node),
-                              node.children)
-            for devnode in children:
-                objclass = device_mappings.get(devnode.name)
-
-                if objclass == virtinst.VirtualCharDevice:
-                    dev = objclass(self.conn, devnode.name,
-                                   parsexmlnode=devnode, caps=caps)
-                else:
-                    dev = objclass(conn=self.conn,
-                                   parsexmlnode=devnode, caps=caps)
-                self._add_device(dev)
+            if objclass == virtinst.VirtualCharDevice:
+                dev = objclass(self.conn, devnode.name,
+                               parsexmlnode=devnode, caps=caps)
+            else:
+                dev = objclass(conn=self.conn,
+                               parsexmlnode=devnode, caps=caps)
+            dev._seed_xml_index(devindex)
+            self._add_device(dev)
 
         self._installer = virtinst.Installer.Installer(self.conn,
                                                    parsexmlnode=self._xml_node,
@@ -818,6 +824,11 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         self._numatune = DomainNumatune(self.conn,
                                         parsexmlnode=self._xml_node, caps=caps)
 
+        for obj in [self._installer, self._installer.bootconfig,
+                    self._features, self._clock, self._seclabel, self._cpu,
+                    self._numatune]:
+            obj._seed_xml_index(index)
+
     def _get_default_input_device(self):
         """
         Return a VirtualInputDevice.
@@ -836,7 +847,13 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
                                                  VirtualCharDevice.CHAR_PTY)
         return dev
 
-    def _get_device_xml(self, devs, install=True):
+    def _get_device_xml(self, devs, install=True, devkeys=None):
+        """
+        Return the XML of devs, joined. devkeys maps the id of each
+        transient device copy to a key for the device it was copied
+        from, which lets its XML be reused across the passes of _build_xml
+        """
+        devkeys = devkeys or {}
 
         def do_remove_media(d):
             # Keep cdrom around, but with no media attached,
@@ -865,18 +882,21 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
                 if do_remove_media(dev):
                     origpath = dev.path
                     dev.path = None
+                elif self._xml_fragments is not None and id(dev) in devkeys:
+                    # Same XML in the install and boot pass
+                    key = devkeys[id(dev)]
+                    if key not in self._xml_fragments:
+                        self._xml_fragments[key] = dev.get_xml_config()
+                    return self._xml_fragments[key]
 
                 return dev.get_xml_config()
             finally:
                 if origpath:
                     dev.path = origpath
 
-        xml = self._get_emulator_xml()
-        # Build XML
-        for dev in devs:
-            xml = _util.xml_append(xml, get_dev_xml(dev))
-
-        return xml
+        xml = [self._get_emulator_xml()]
+        xml.extend([get_dev_xml(dev) for dev in devs])
+        return "\n".join([x for x in xml if x])
 
     def _get_emulator_xml(self):
         emulator = self.emulator
@@ -938,8 +958,7 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         if not osxml:
             return None
 
-        xml = _util.xml_append(xml,
-                               self.installer.get_xml_config(self, install))
+        xml = _util.xml_append(xml, osxml)
         return xml
 
     def _get_vcpu_xml(self):
@@ -1012,8 +1031,11 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         # to worry about when to call set_defaults
         origdevs = self.get_all_devices()
         devs = []
+        devkeys = {}
         for dev in origdevs:
-            devs.append(dev.copy())
+            devcopy = dev.copy()
+            devs.append(devcopy)
+            devkeys[id(devcopy)] = id(dev)
         tmpfeat = self.features.copy()
 
         def get_transient_devices(devtype):
@@ -1039,48 +1061,42 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         if osblob_install and not self.installer.has_install_phase():
             return None
 
-        desc_xml = ""
+        xml = _util.XMLBuffer()
+        xml.open("<domain type='%s'>" % self.type)
+        xml.add("<name>%s</name>" % self.name)
+        xml.add("<uuid>%s</uuid>" % self.uuid)
         if self.description is not None:
             desc = str(self.description)
-            desc_xml = ("  <description>%s</description>" %
-                        _util.xml_escape(desc))
-
-        xml = ""
-        add = lambda x: _util.xml_append(xml, x)
-
-        xml = add("<domain type='%s'>" % self.type)
-        xml = add("  <name>%s</name>" % self.name)
-        xml = add("  <uuid>%s</uuid>" % self.uuid)
-        xml = add(desc_xml)
-        xml = add("  <memory>%s</memory>" % (self.maxmemory * 1024))
-        xml = add("  <currentMemory>%s</currentMemory>" % (self.memory * 1024))
+            xml.add("<description>%s</description>" % _util.xml_escape(desc))
+        xml.add("<memory>%s</memory>" % (self.maxmemory * 1024))
+        xml.add("<currentMemory>%s</currentMemory>" % (self.memory * 1024))
 
         # <blkiotune>
         # <memtune>
         if self.hugepage is True:
-            xml = add("  <memoryBacking>")
-            xml = add("    <hugepages/>")
-            xml = add("  </memoryBacking>")
+            xml.open("<memoryBacking>")
+            xml.add("<hugepages/>")
+            xml.close("</memoryBacking>")
 
-        xml = add(self._get_vcpu_xml())
+        xml.add_raw(self._get_vcpu_xml())
         # <cputune>
-        xml = add(self.numatune.get_xml_config())
+        xml.add_raw(self.numatune.get_xml_config())
         # <sysinfo>
         # XXX: <bootloader> goes here, not in installer XML
-        xml = add("  %s" % osblob)
-        xml = add(self._get_features_xml(tmpfeat))
-        xml = add(self._get_cpu_xml())
-        xml = add(self._get_clock_xml())
-        xml = add("  <on_poweroff>destroy</on_poweroff>")
-        xml = add("  <on_reboot>%s</on_reboot>" % action)
-        xml = add("  <on_crash>%s</on_crash>" % action)
-        xml = add("  <devices>")
-        xml = add(self._get_device_xml(devs, install))
-        xml = add("  </devices>")
-        xml = add(self._get_seclabel_xml())
-        xml = add("</domain>\n")
-
-        return xml
+        xml.add("%s" % osblob)
+        xml.add_raw(self._get_features_xml(tmpfeat))
+        xml.add_raw(self._get_cpu_xml())
+        xml.add_raw(self._get_clock_xml())
+        xml.add("<on_poweroff>destroy</on_poweroff>")
+        xml.add("<on_reboot>%s</on_reboot>" % action)
+        xml.add("<on_crash>%s</on_crash>" % action)
+        xml.open("<devices>")
+        xml.add_raw(self._get_device_xml(devs, install, devkeys))
+        xml.close("</devices>")
+        xml.add_raw(self._get_seclabel_xml())
+        xml.close("</domain>")
+
+        return xml.getvalue() + "\n"
 
     def post_install_check(self):
         """
@@ -1137,15 +1153,19 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
             except:
                 pass
 
-    def domain_is_shutdown(self):
+    def domain_is_shutdown(self, dominfo=None):
         """
         Return True if the created domain object is shutdown
+
+        @param dominfo: info() already fetched from the domain, to save
+                        another call
         """
         dom = self.domain
         if not dom:
             return False
 
-        dominfo = dom.info()
+        if dominfo is None:
+            dominfo = dom.info()
 
         state    = dominfo[0]
         cpu_time = dominfo[4]
@@ -1159,18 +1179,37 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         # shutdown. We will catch the error later.
         return state == libvirt.VIR_DOMAIN_NOSTATE and cpu_time == 0
 
-    def domain_is_crashed(self):
+    def domain_is_crashed(self, dominfo=None):
         """
         Return True if the created domain object is in a crashed state
+
+        @param dominfo: info() already fetched from the domain, to save
+                        another call
         """
         if not self.domain:
             return False
 
-        dominfo = self.domain.info()
+        if dominfo is None:
+            dominfo = self.domain.info()
         state = dominfo[0]
 
         return state == libvirt.VIR_DOMAIN_CRASHED
 
+    def wait_for_shutdown(self, timeout=None):
+        """
+        Wait for the created domain to shut down. Domain lifecycle events
+        are used if the connection delivers them, otherwise the domain
+        state is polled.
+
+        @param timeout: seconds to wait, or None to wait forever
+        @returns: True if the domain shut down
+        """
+        if not self.domain:
+            return False
+
+        return bool(_domainwait.wait_for(self.conn, self.name,
+                                         self.domain_is_shutdown, timeout))
+
     ##########################
     # Actual install methods #
     ##########################
@@ -1204,6 +1243,7 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
 
             logging.info("Undefining guest '%s'", self.name)
             vm.undefine()
+            _domcache.invalidate(self.conn)
         except libvirt.libvirtError, e:
             raise RuntimeError(_("Could not remove old vm '%s': %s") %
                                (self.name, str(e)))
@@ -1214,36 +1254,44 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         Begin the guest install (stage1).
         @param return_xml: Don't create the guest, just return generated XML
         """
-        is_initial = True
-
         self.validate_parms()
         self._consolechild = None
 
         self._prepare_install(meter, dry)
         try:
-            # Create devices if required (disk images, etc.)
-            if not dry:
-                self._create_devices(meter)
+            return self._install_prepared(consolecb, meter, removeOld, wait,
+                                          dry, return_xml, noboot)
+        finally:
+            self._cleanup_install()
 
-            start_xml, final_xml = self._build_xml(is_initial)
-            if return_xml:
-                return (start_xml, final_xml)
-            if dry:
-                return
+    def _install_prepared(self, consolecb, meter, removeOld, wait, dry,
+                          return_xml, noboot):
+        """
+        The part of start_install after the install media is prepared
+        """
+        is_initial = True
 
-            # Remove existing VM if requested
-            self.remove_original_vm(removeOld)
+        # Create devices if required (disk images, etc.)
+        if not dry:
+            self._create_devices(meter)
 
-            self.domain = self._create_guest(consolecb, meter, wait,
-                                             start_xml, final_xml, is_initial,
-                                             noboot)
+        start_xml, final_xml = self._build_xml(is_initial)
+        if return_xml:
+            return (start_xml, final_xml)
+        if dry:
+            return
 
-            # Set domain autostart flag if requested
-            self._flag_autostart()
+        # Remove existing VM if requested
+        self.remove_original_vm(removeOld)
 
-            return self.domain
-        finally:
-            self._cleanup_install()
+        self.domain = self._create_guest(consolecb, meter, wait,
+                                         start_xml, final_xml, is_initial,
+                                         noboot)
+
+        # Set domain autostart flag if requested
+        self._flag_autostart()
+
+        return self.domain
 
     def continue_install(self, consolecb=None, meter=None, wait=True,
                          dry=False, return_xml=False):
@@ -1278,8 +1326,14 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
         log_label = is_initial and "install" or "continue"
         disk_boot = not is_initial
 
-        start_xml = self.get_xml_config(install=True, disk_boot=disk_boot)
-        final_xml = self.get_xml_config(install=False)
+        # Devices produce the same XML in both passes, unless they are
+        # transient, so only build it once
+        self._xml_fragments = {}
+        try:
+            start_xml = self.get_xml_config(install=True, disk_boot=disk_boot)
+            final_xml = self.get_xml_config(install=False)
+        finally:
+            self._xml_fragments = None
 
         logging.debug("Generated %s XML: %s",
                       log_label,
@@ -1319,6 +1373,7 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
              self._consolechild) = self._wait_and_connect_console(consolecb)
 
         self.domain = self.conn.defineXML(final_xml)
+        _domcache.invalidate(self.conn)
         if is_initial:
             try:
                 logging.debug("XML fetched from libvirt object:\n%s",
@@ -1582,21 +1637,22 @@ class Guest(XMLBuilderDomain.XMLBuilderDomain):
 
 
 def _wait_for_domain(conn, name):
-    # sleep in .25 second increments until either a) we get running
-    # domain ID or b) it's been 5 seconds.  this is so that
-    # we can try to gracefully handle domain restarting failures
-    dom = None
-    for ignore in range(1, int(5 / .25)): # 5 seconds, .25 second sleeps
+    # Wait until either a) we get running domain ID or b) it's been
+    # 5 seconds. this is so that we can try to gracefully handle domain
+    # restarting failures
+    found = [None]
+
+    def check_running():
         try:
-            dom = conn.lookupByName(name)
-            if dom and dom.ID() != -1:
-                break
+            found[0] = conn.lookupByName(name)
+            return found[0].ID() != -1
         except libvirt.libvirtError, e:
             logging.debug("No guest running yet: " + str(e))
-            dom = None
-        time.sleep(0.25)
+            found[0] = None
+            return False
 
-    return dom
+    _domainwait.wait_for(conn, name, check_running, 5)
+    return found[0]
 
 # Back compat class to avoid ABI break
 XenGuest = Guest
@@ -28,16 +28,58 @@ import urllib2
 import urlparse
 import ftplib
 import tempfile
+import threading
+from virtinst import _download
+from virtinst import _httppool
+from virtinst import _mediacache
 from virtinst import _gettext as _
 
+# urlgrabber's pycurl backend shares one curl handle between all its
+# callers, so only one file may be open through it at a time. Held from
+# urlopen until the returned file is closed
+_grabber_lock = threading.Lock()
+
+class _GrabberFile(object):
+    """
+    A file opened through urlgrabber, releasing _grabber_lock on close
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def read(self, amt=-1):
+        return self._fileobj.read(amt)
+
+    def readline(self):
+        return self._fileobj.readline()
+
+    def close(self):
+        if self._fileobj is None:
+            return
+        try:
+            self._fileobj.close()
+        finally:
+            self._fileobj = None
+            _grabber_lock.release()
+
 # This is a generic base class for fetching/extracting files from
 # a media source, such as CD ISO, NFS server, or HTTP/FTP server
 class ImageFetcher:
 
+    # Whether fetched files go through the persistent media cache
+    _use_media_cache = False
+
     def __init__(self, location, scratchdir):
         self.location = location
         self.scratchdir = scratchdir
 
+        # Expected (algo, hexdigest) of files, from .treeinfo
+        self.checksums = {}
+
+        # Results of hasFile and other probes against this location,
+        # shared by every Distro class that asks
+        self._probe_cache = {}
+        self._probe_lock = threading.Lock()
+
     def _make_path(self, filename):
         if hasattr(self, "srcdir"):
             path = getattr(self, "srcdir")
@@ -51,20 +93,20 @@ class ImageFetcher:
 
         return path
 
-    def saveTemp(self, fileobj, prefix):
+    def _mkstemp(self, prefix):
         if not os.path.exists(self.scratchdir):
             os.makedirs(self.scratchdir, 0750)
         (fd, fn) = tempfile.mkstemp(prefix="virtinst-" + prefix,
                                     dir=self.scratchdir)
-        block_size = 16384
+        return fd, fn
+
+    def saveTemp(self, fileobj, prefix):
+        (fd, fn) = self._mkstemp(prefix)
+        dst = os.fdopen(fd, "wb")
         try:
-            while 1:
-                buff = fileobj.read(block_size)
-                if not buff:
-                    break
-                os.write(fd, buff)
+            _download.copy_stream(fileobj, dst)
         finally:
-            os.close(fd)
+            dst.close()
         return fn
 
     def prepareLocation(self):
@@ -74,37 +116,134 @@ class ImageFetcher:
         pass
 
     def acquireFile(self, filename, progresscb):
+        cache = None
+        if self._use_media_cache:
+            cache = _mediacache.get_cache(self.scratchdir)
+
+        if cache:
+            try:
+                tmpname = cache.acquire(self, filename, progresscb,
+                                        self.checksums.get(filename))
+                if tmpname:
+                    logging.debug("Saved file to " + tmpname)
+                    return tmpname
+            except (OSError, IOError), e:
+                logging.debug("Media cache failed for %s, fetching "
+                              "directly: %s", filename, str(e))
+
+        checksum = self.checksums.get(filename)
+        (fd, tmpname) = self._mkstemp(os.path.basename(filename) + ".")
+        os.close(fd)
+        try:
+            digests = self.downloadFile(filename, tmpname, progresscb,
+                                        checksum and [checksum[0]])
+            _download.check_checksum(self._make_path(filename), checksum,
+                                     digests)
+        except:
+            os.unlink(tmpname)
+            raise
+
+        logging.debug("Saved file to " + tmpname)
+        return tmpname
+
+    def downloadFile(self, filename, path, progresscb=None, algos=None,
+                     statepath=None):
+        """
+        Download filename to path, hashing it on the way.
+
+        @param algos: Hash algorithms to compute besides sha256
+        @param statepath: Where to keep resume state, for fetchers that
+                          can resume an interrupted download
+        @returns: dict mapping each algorithm to the hex digest
+        """
+        ignore = statepath
+        hasher = _download.Hasher(algos)
+        src = self.openFile(filename, progresscb)
+        try:
+            dst = open(path, "wb")
+            try:
+                _download.copy_stream(src, dst, hasher)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        return hasher.hexdigests()
+
+    def openFile(self, filename, progresscb=None):
+        """
+        Return a file like object for streaming the contents of filename,
+        without saving it to scratchdir
+        """
         # URLGrabber works for all network and local cases
+        path = self._make_path(filename)
+        base = os.path.basename(filename)
+        logging.debug("Fetching URI: %s", path)
+
+        kwargs = {}
+        if progresscb:
+            kwargs["progress_obj"] = progresscb
+            kwargs["text"] = _("Retrieving file %s...") % base
 
-        f = None
+        _grabber_lock.acquire()
         try:
-            path = self._make_path(filename)
-            base = os.path.basename(filename)
-            logging.debug("Fetching URI: %s", path)
+            return _GrabberFile(grabber.urlopen(path, **kwargs))
+        except Exception, e:
+            _grabber_lock.release()
+            raise ValueError(_("Couldn't acquire file %s: %s") %
+                               (path, str(e)))
+
+    def getValidators(self, filename):
+        """
+        Return a dict with the 'etag', 'last_modified' and 'size' the
+        server reports for filename, used to check whether a cached
+        copy is current. None if they can't be determined.
+        """
+        ignore = filename
+        return None
+
+    def cachedProbe(self, key, func):
+        """
+        Return the result of func(), which probes this location for
+        something. The result is cached under key, and concurrent callers
+        asking for the same key wait for a single probe to finish.
+        """
+        self._probe_lock.acquire()
+        try:
+            probe = self._probe_cache.get(key)
+            owner = probe is None
+            if owner:
+                probe = _Probe()
+                self._probe_cache[key] = probe
+        finally:
+            self._probe_lock.release()
 
+        if owner:
             try:
-                f = grabber.urlopen(path,
-                                    progress_obj=progresscb,
-                                    text=_("Retrieving file %s...") % base)
-            except Exception, e:
-                raise ValueError(_("Couldn't acquire file %s: %s") %
-                                   (path, str(e)))
+                probe.result = func()
+            finally:
+                probe.done.set()
 
-            tmpname = self.saveTemp(f, prefix=base + ".")
-            logging.debug("Saved file to " + tmpname)
-            return tmpname
-        finally:
-            if f:
-                f.close()
+        probe.done.wait()
+        return probe.result
 
+    def hasFile(self, filename):
+        return self.cachedProbe(("hasFile", filename),
+                                lambda: self._hasFile(filename))
 
-    def hasFile(self, src):
+    def _hasFile(self, src):
         raise NotImplementedError("Must be implemented in subclass")
 
+class _Probe(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = False
+
 # Base class for downloading from FTP / HTTP
 class URIImageFetcher(ImageFetcher):
 
-    def hasFile(self, filename):
+    _use_media_cache = True
+
+    def _hasFile(self, filename):
         raise NotImplementedError
 
     def prepareLocation(self):
@@ -112,46 +251,252 @@ class URIImageFetcher(ImageFetcher):
             raise ValueError(_("Opening URL %s failed.") %
                               (self.location))
 
+class _MeteredFile(object):
+    """
+    Wraps a file like object, reporting reads to a urlgrabber meter
+    """
+    def __init__(self, fileobj, meter, url, text, size):
+        self._fileobj = fileobj
+        self._meter = meter
+        self._amount = 0
+
+        meter.start(filename=None, url=url,
+                    basename=os.path.basename(url), size=size, text=text)
+
+    def _update(self, data):
+        self._amount += len(data)
+        self._meter.update(self._amount)
+        return data
+
+    def read(self, amt=None):
+        return self._update(self._fileobj.read(amt))
+
+    def readline(self):
+        return self._update(self._fileobj.readline())
+
+    def close(self):
+        if self._meter:
+            self._meter.end(self._amount)
+            self._meter = None
+        self._fileobj.close()
+
 class HTTPImageFetcher(URIImageFetcher):
 
-    def hasFile(self, filename):
+    # Plain http locations share keep-alive connections from _httppool.
+    # Probes are answered from the server's directory listings where it
+    # offers them, falling back to a HEAD request per file.
+
+    def _open(self, method, path):
+        response = _httppool.get_pool().request(method, path)
+        if response.status != 200:
+            response.read()
+            response.close()
+            raise IOError("%s %s: %s %s" % (method, path, response.status,
+                                            response.reason))
+        return response
+
+    def openFile(self, filename, progresscb=None):
+        path = self._make_path(filename)
+        if not _httppool.use_pool(path):
+            return URIImageFetcher.openFile(self, filename, progresscb)
+
+        logging.debug("Fetching URI: %s", path)
         try:
-            path = self._make_path(filename)
-            request = urllib2.Request(path)
-            request.get_method = lambda: "HEAD"
-            urllib2.urlopen(request)
+            response = self._open("GET", path)
         except Exception, e:
-            logging.debug("HTTP hasFile: didn't find %s: %s", path, str(e))
-            return False
+            raise ValueError(_("Couldn't acquire file %s: %s") %
+                               (path, str(e)))
+
+        if not progresscb:
+            return response
+
+        size = response.getheader("Content-Length")
+        text = _("Retrieving file %s...") % os.path.basename(filename)
+        return _MeteredFile(response, progresscb, path, text,
+                            size and int(size) or None)
+
+    def _head(self, filename):
+        """
+        Return the ETag, Last-Modified and size headers for filename as
+        a dict, or None if it doesn't exist
+        """
+        def probe():
+            path = self._make_path(filename)
+            try:
+                if _httppool.use_pool(path):
+                    response = self._open("HEAD", path)
+                    response.read()
+                    response.close()
+                    getheader = response.getheader
+                else:
+                    request = urllib2.Request(path)
+                    request.get_method = lambda: "HEAD"
+                    getheader = urllib2.urlopen(request).info().getheader
+            except Exception, e:
+                logging.debug("HTTP HEAD: didn't find %s: %s", path, str(e))
+                return None
+
+            size = getheader("Content-Length")
+            return {"etag": getheader("ETag"),
+                    "last_modified": getheader("Last-Modified"),
+                    "size": size and int(size) or None,
+                    "ranges": getheader("Accept-Ranges") == "bytes"}
+
+        return self.cachedProbe(("head", filename), probe)
+
+    def _listDirectory(self, dirname):
+        """
+        Return the set of names in the directory listing the server
+        serves for dirname, or None if it doesn't serve one
+        """
+        def probe():
+            path = self._make_path(dirname)
+            if not path.endswith("/"):
+                path += "/"
+            if not _httppool.use_pool(path):
+                return None
+
+            try:
+                response = self._open("GET", path)
+                try:
+                    ctype = response.getheader("Content-Type", "")
+                    if "html" not in ctype:
+                        return None
+                    content = response.read(_httppool.MAX_LISTING_BYTES)
+                    if response.read(1):
+                        return None
+                finally:
+                    response.close()
+            except Exception, e:
+                logging.debug("HTTP listing: none for %s: %s", path, str(e))
+                return None
+
+            names = _httppool.parse_listing(content)
+            if names is not None:
+                logging.debug("HTTP listing: %d entries in %s",
+                              len(names), path)
+            return names
+
+        return self.cachedProbe(("listing", dirname), probe)
+
+    def _findInListing(self, filename):
+        """
+        Look filename up in directory listings. Returns True or False,
+        or None if the listings can't tell
+        """
+        parts = [p for p in filename.split("/") if p]
+        if not parts:
+            if self._listDirectory("") is not None:
+                return True
+            return None
+
+        dirname = ""
+        for name in parts:
+            names = self._listDirectory(dirname)
+            if names is None:
+                return None
+            if name not in names:
+                if _httppool.listing_may_hide(name):
+                    return None
+                return False
+            dirname += name + "/"
         return True
 
+    def getValidators(self, filename):
+        head = self._head(filename)
+        if not head or (not head["etag"] and not head["last_modified"]):
+            return None
+        return {"etag": head["etag"],
+                "last_modified": head["last_modified"],
+                "size": head["size"]}
+
+    def downloadFile(self, filename, path, progresscb=None, algos=None,
+                     statepath=None):
+        url = self._make_path(filename)
+        head = None
+        if _httppool.use_pool(url):
+            head = self._head(filename)
+
+        if head and head["ranges"] and head["size"]:
+            # Weak ETags can't be used with If-Range
+            validator = head["etag"]
+            if not validator or validator.startswith("W/"):
+                validator = head["last_modified"]
+
+            text = _("Retrieving file %s...") % os.path.basename(filename)
+            try:
+                return _download.RangeDownload(url, path, head["size"],
+                                               validator, progresscb, text,
+                                               algos, statepath).run()
+            except _download.RangeError, e:
+                logging.debug("Range requests failed, fetching whole "
+                              "file: %s", str(e))
+
+        return URIImageFetcher.downloadFile(self, filename, path,
+                                            progresscb, algos)
+
+    def _hasFile(self, filename):
+        found = self._findInListing(filename)
+        if found is None:
+            found = self._head(filename) is not None
+        if not found:
+            logging.debug("HTTP hasFile: didn't find %s",
+                          self._make_path(filename))
+        return found
+
 class FTPImageFetcher(URIImageFetcher):
 
     def __init__(self, location, scratchdir):
         URIImageFetcher.__init__(self, location, scratchdir)
 
         self.ftp = None
+        # The control connection can only run one command at a time
+        self._ftp_lock = threading.Lock()
 
     def prepareLocation(self):
         url = urlparse.urlparse(self._make_path(""))
         self.ftp = ftplib.FTP(url[1])
         self.ftp.login()
 
-    def hasFile(self, filename):
+    def getValidators(self, filename):
         path = self._make_path(filename)
         url = urlparse.urlparse(path)
 
+        self._ftp_lock.acquire()
         try:
             try:
-                # If it's a file
-                self.ftp.size(url[2])
-            except ftplib.all_errors:
-                # If it's a dir
-                self.ftp.cwd(url[2])
-        except ftplib.all_errors, e:
-            logging.debug("FTP hasFile: couldn't access %s: %s",
-                          path, str(e))
-            return False
+                size = self.ftp.size(url[2])
+                mdtm = self.ftp.sendcmd("MDTM %s" % url[2])
+            except ftplib.all_errors, e:
+                logging.debug("FTP getValidators: failed for %s: %s",
+                              path, str(e))
+                return None
+        finally:
+            self._ftp_lock.release()
+
+        return {"etag": None,
+                "last_modified": mdtm.split()[-1],
+                "size": size}
+
+    def _hasFile(self, filename):
+        path = self._make_path(filename)
+        url = urlparse.urlparse(path)
+
+        self._ftp_lock.acquire()
+        try:
+            try:
+                try:
+                    # If it's a file
+                    self.ftp.size(url[2])
+                except ftplib.all_errors:
+                    # If it's a dir
+                    self.ftp.cwd(url[2])
+            except ftplib.all_errors, e:
+                logging.debug("FTP hasFile: couldn't access %s: %s",
+                              path, str(e))
+                return False
+        finally:
+            self._ftp_lock.release()
 
         return True
 
@@ -161,7 +506,7 @@ class LocalImageFetcher(ImageFetcher):
         ImageFetcher.__init__(self, location, scratchdir)
         self.srcdir = srcdir
 
-    def hasFile(self, filename):
+    def _hasFile(self, filename):
         src = self._make_path(filename)
         if os.path.exists(src):
             return True
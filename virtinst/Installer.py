@@ -26,6 +26,7 @@ import platform
 import logging
 import copy
 
+import _cpio
 import _util
 import virtinst
 import XMLBuilderDomain
@@ -74,6 +75,7 @@ class Installer(XMLBuilderDomain.XMLBuilderDomain):
         self._type = None
         self._location = None
         self._initrd_injections = []
+        self._initrd_compress_level = _cpio.DEFAULT_COMPRESS_LEVEL
         self._cdrom = False
         self._os_type = None
         self._scratchdir = None
@@ -203,6 +205,19 @@ class Installer(XMLBuilderDomain.XMLBuilderDomain):
         self._initrd_injections = val
     initrd_injections = property(get_initrd_injections, set_initrd_injections)
 
+    def get_initrd_compress_level(self):
+        return self._initrd_compress_level
+    def set_initrd_compress_level(self, val):
+        val = int(val)
+        if val < 0 or val > 9:
+            raise ValueError(_("initrd compression level must be between "
+                               "0 and 9"))
+        self._initrd_compress_level = val
+    initrd_compress_level = property(get_initrd_compress_level,
+                                     set_initrd_compress_level,
+                                     doc="gzip level (0 for none) of the "
+                                         "archive holding initrd_injections")
+
     # kernel + initrd pair to use for installing as opposed to using a location
     def get_boot(self):
         return {"kernel" : self._install_bootconfig.kernel,
@@ -73,8 +73,8 @@ class Interface(object):
         if prefix="br", we find the first unused name such as "br0", "br1",
         etc.
         """
-        return _util.generate_name(prefix, conn.interfaceLookupByName, sep="",
-                                   force_num=True)
+        return _util.generate_names(prefix, _util.list_interface_names(conn),
+                                    sep="", force_num=True)[0]
 
     def __init__(self, object_type, name, conn=None):
         """
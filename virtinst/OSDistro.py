@@ -21,15 +21,19 @@
 
 import logging
 import os
+import sys
 import gzip
 import re
 import tempfile
 import socket
+import threading
 import ConfigParser
+import StringIO
 
 import virtinst
 import osdict
 from virtinst import _util
+from virtinst import _mediacache
 from virtinst import _gettext as _
 
 from ImageFetcher import MountedImageFetcher
@@ -101,18 +105,53 @@ def _storeForDistro(fetcher, baseuri, typ, progresscb, arch, distro=None,
 
     stores.append(GenericDistro)
 
-    for sclass in stores:
-        store = sclass(baseuri, arch, typ, scratchdir)
+    stores = [sclass(baseuri, arch, typ, scratchdir) for sclass in stores]
+    for store in stores:
         if skip_treeinfo:
             store.uses_treeinfo = False
-        if store.isValidStore(fetcher, progresscb):
-            return store
+
+    store = _detectStore(fetcher, progresscb, stores)
+    if store:
+        return store
 
     raise ValueError(
         _("Could not find an installable distribution at '%s'\n"
           "The location must be the root directory of an install tree." %
           baseuri))
 
+def _detectStore(fetcher, progresscb, stores):
+    """
+    Run isValidStore for every candidate store concurrently, so the
+    network round trips of their probes overlap. Probes for the same
+    file are only done once, via the fetcher's probe cache. Returns
+    the first valid store in the order passed, or None.
+    """
+    results = [None] * len(stores)
+
+    def probe(idx):
+        try:
+            results[idx] = (stores[idx].isValidStore(fetcher, progresscb),
+                            None)
+        except Exception:
+            results[idx] = (False, sys.exc_info())
+
+    threads = []
+    for idx in range(len(stores)):
+        t = threading.Thread(target=probe, args=(idx,),
+                             name="Detecting %s" % stores[idx].name)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    for store, (valid, exc_info) in zip(stores, results):
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if valid:
+            return store
+    return None
+
 def _locationCheckWrapper(guest, baseuri, progresscb,
                           scratchdir, _type, arch, callback):
     fetcher = _fetcherForURI(baseuri, scratchdir)
@@ -187,6 +226,39 @@ def detectMediaDistro(location, arch):
     return store.get_osdict_info()
 
 
+def _parseTreeinfo(fetcher):
+    f = fetcher.openFile(".treeinfo")
+    try:
+        content = f.read()
+    finally:
+        f.close()
+
+    treeinfo = ConfigParser.SafeConfigParser()
+    treeinfo.readfp(StringIO.StringIO(content), ".treeinfo")
+
+    # Record media checksums so fetched files can be verified. Paths
+    # are case sensitive, so use a parser that doesn't lowercase them
+    sums = ConfigParser.RawConfigParser()
+    sums.optionxform = str
+    sums.readfp(StringIO.StringIO(content), ".treeinfo")
+    if sums.has_section("checksums"):
+        for path, val in sums.items("checksums"):
+            checksum = _mediacache.parse_checksum(val)
+            if checksum:
+                fetcher.checksums[path] = checksum
+
+    return treeinfo
+
+def _readTreeinfo(fetcher):
+    # Fetched and parsed once per location, every Distro class shares
+    # the result. Callers must not modify it
+    treeinfo = fetcher.cachedProbe(("treeinfo",),
+                                   lambda: _parseTreeinfo(fetcher))
+    if treeinfo is False:
+        raise ValueError(_("Couldn't read .treeinfo from %s") %
+                         fetcher.location)
+    return treeinfo
+
 def distroFromTreeinfo(fetcher, progresscb, uri, arch, vmtype=None,
                        scratchdir=None):
     # Parse treeinfo 'family' field, and return the associated Distro class
@@ -194,12 +266,7 @@ def distroFromTreeinfo(fetcher, progresscb, uri, arch, vmtype=None,
     if not fetcher.hasFile(".treeinfo"):
         return None
 
-    tmptreeinfo = fetcher.acquireFile(".treeinfo", progresscb)
-    try:
-        treeinfo = ConfigParser.SafeConfigParser()
-        treeinfo.read(tmptreeinfo)
-    finally:
-        os.unlink(tmptreeinfo)
+    treeinfo = _readTreeinfo(fetcher)
 
     try:
         fam = treeinfo.get("general", "family")
@@ -324,12 +391,7 @@ class Distro:
 
         logging.debug("Detected .treeinfo file")
 
-        tmptreeinfo = fetcher.acquireFile(".treeinfo", progresscb)
-        try:
-            self.treeinfo = ConfigParser.SafeConfigParser()
-            self.treeinfo.read(tmptreeinfo)
-        finally:
-            os.unlink(tmptreeinfo)
+        self.treeinfo = _readTreeinfo(fetcher)
         return True
 
     def _getTreeinfoMedia(self, mediaName):
@@ -341,15 +403,15 @@ class Distro:
         return self.treeinfo.get("images-%s" % t, mediaName)
 
     def _fetchAndMatchRegex(self, fetcher, progresscb, filename, regex):
-        # Fetch 'filename' and return True/False if it matches the regex
-        local_file = None
-        try:
+        # Stream 'filename' and return True/False if it matches the regex
+        ignore = progresscb
+
+        def match():
             try:
-                local_file = fetcher.acquireFile(filename, progresscb)
+                f = fetcher.openFile(filename)
             except:
                 return False
 
-            f = open(local_file, "r")
             try:
                 while 1:
                     buf = f.readline()
@@ -359,11 +421,9 @@ class Distro:
                         return True
             finally:
                 f.close()
-        finally:
-            if local_file is not None:
-                os.unlink(local_file)
+            return False
 
-        return False
+        return fetcher.cachedProbe(("regex", filename, regex), match)
 
     def _kernelFetchHelper(self, fetcher, guest, progresscb, kernelpath,
                            initrdpath):
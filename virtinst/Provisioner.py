@@ -0,0 +1,234 @@
+#
+# Installing many guests at once
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+"""
+Module for installing a batch of guests concurrently
+
+General workflow:
+
+    - Build a Guest for each VM, as for Guest.start_install
+
+    - Pass the list to start_install_batch, which installs them on a
+      bounded pool of threads
+
+    - Check the returned InstallResult of each guest: success, error
+      and the domain created
+"""
+
+import logging
+import threading
+import time
+
+import urlgrabber.progress as progress
+
+import _httppool
+import _util
+import support
+from virtinst import _gettext as _
+
+# Guests installed at once, unless the caller passes its own limit
+DEFAULT_JOBS = 4
+
+# Media preparation that isn't safe to run in several install threads
+# at once holds this: uploads to a remote host pick scratch pool and
+# volume names which concurrent uploads could both claim, and urlgrabber,
+# used for every location the HTTP connection pool can't fetch, isn't
+# thread safe
+_media_lock = threading.Lock()
+
+
+class InstallResult(object):
+    """
+    The outcome of installing one guest of a batch
+    """
+    def __init__(self, guest):
+        self.guest = guest
+        self.domain = None
+        self.error = None
+        self.elapsed = 0
+
+    def get_success(self):
+        return self.error is None
+    success = property(get_success)
+
+
+def _media_key(guest):
+    """
+    Guests with the same key fetch the same install media
+    """
+    installer = guest.installer
+    if not installer.location or not installer.scratchdir_required():
+        return None
+    return (installer.__class__, installer.location, installer.scratchdir,
+            guest.is_remote())
+
+def _check_collisions(results):
+    """
+    Fail all but the first guest of the batch using each name or UUID
+    """
+    names = {}
+    uuids = {}
+    for result in results:
+        guest = result.guest
+        if guest.name in names:
+            result.error = ValueError(_("Guest name '%s' is used more than "
+                                        "once in the batch") % guest.name)
+        elif guest.uuid in uuids:
+            result.error = ValueError(_("Guest UUID '%(uuid)s' of '%(name)s' "
+                                        "is already used by '%(other)s'") %
+                                      {"uuid" : guest.uuid,
+                                       "name" : guest.name,
+                                       "other" : uuids[guest.uuid]})
+        else:
+            names[guest.name] = True
+            uuids[guest.uuid] = guest.name
+
+def _needs_media_lock(guest):
+    location = guest.installer.location
+    if guest.is_remote():
+        return True
+    return bool(location) and not _httppool.use_pool(location)
+
+def _prepare_media(guest, meter):
+    if _needs_media_lock(guest):
+        _media_lock.acquire()
+        try:
+            guest._prepare_install(meter)
+        finally:
+            _media_lock.release()
+    else:
+        guest._prepare_install(meter)
+
+def _install_thread(result, meter, donemeter, waitevent, doneevent,
+                    removeOld, noboot):
+    """
+    Install result.guest, recording its domain or the error
+    """
+    guest = result.guest
+    start = time.time()
+    try:
+        try:
+            try:
+                guest.validate_parms()
+                guest._consolechild = None
+
+                # Let the first guest of this location populate the media
+                # cache before we look there
+                if waitevent:
+                    waitevent.wait()
+                _prepare_media(guest, meter)
+            finally:
+                if doneevent:
+                    doneevent.set()
+
+            try:
+                result.domain = guest._install_prepared(None, meter,
+                                                        removeOld, False,
+                                                        False, False, noboot)
+            finally:
+                guest._cleanup_install()
+        except Exception, e:
+            _util.log_exception("Error installing '%s'" % guest.name)
+            result.error = e
+    finally:
+        result.elapsed = time.time() - start
+        donemeter.end(1)
+
+def start_install_batch(guests, meter=None, meters=None, jobs=None,
+                        removeOld=None, noboot=False):
+    """
+    Install every guest in guests, like Guest.start_install without a
+    console, running up to jobs installs at once. Storage for the
+    running installs is created concurrently. The first guest installing
+    from each location prepares its media before the others using that
+    location, so they can take it from the media cache.
+
+    A failing guest doesn't stop the others: each guest's outcome is
+    recorded in the returned list of InstallResult, in the order of
+    guests.
+
+    @param meter: Meter counting the guests that have finished
+    @param meters: Optional list of meters, one for each guest, to report
+                   that guest's media fetches and storage creation to
+    @param jobs: Most installs to run at once, default DEFAULT_JOBS
+    """
+    if not meter:
+        meter = progress.BaseMeter()
+    if jobs is None:
+        jobs = DEFAULT_JOBS
+    if type(jobs) is not int or jobs < 1:
+        raise ValueError(_("Install jobs must be a positive integer."))
+    if not support.support_threading():
+        jobs = 1
+    if not meters:
+        meters = [progress.BaseMeter() for ignore in guests]
+
+    logging.debug("Starting install of %d guests, %d at a time.",
+                  len(guests), jobs)
+
+    results = [InstallResult(guest) for guest in guests]
+    _check_collisions(results)
+
+    aggmeter = _util.AggregateMeter(meter, len(guests),
+                                    text=_("Installing %d guests") %
+                                    len(guests))
+
+    leaders = {}
+    pending = []
+    for result, guestmeter in zip(results, meters):
+        donemeter = aggmeter.new_child(1)
+        if result.error:
+            donemeter.end(1)
+            continue
+
+        waitevent = None
+        doneevent = None
+        key = _media_key(result.guest)
+        if key is not None:
+            if key in leaders:
+                waitevent = leaders[key]
+            else:
+                doneevent = threading.Event()
+                leaders[key] = doneevent
+
+        pending.append((result, guestmeter, donemeter, waitevent, doneevent,
+                        removeOld, noboot))
+
+    # Pending installs are started in order, so each location's first
+    # guest is always running before the guests waiting on it
+    running = []
+    while pending or running:
+        running = [t for t in running if t.isAlive()]
+
+        while pending and len(running) < jobs:
+            args = pending.pop(0)
+            t = threading.Thread(target=_install_thread,
+                                 name="Installing %s" % args[0].guest.name,
+                                 args=args)
+            t.setDaemon(True)
+            t.start()
+            running.append(t)
+
+        if running:
+            running[0].join(0.25)
+        aggmeter.update()
+    aggmeter.end()
+
+    failed = [r for r in results if not r.success]
+    logging.debug("Batch install finished, %d of %d guests failed.",
+                  len(failed), len(results))
+    return results
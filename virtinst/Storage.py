@@ -54,6 +54,7 @@ import logging
 from _util import xml_escape as escape
 
 import _util
+import _storageindex
 import support
 from virtinst import _gettext as _
 
@@ -989,6 +990,8 @@ class StorageVolume(StorageObject):
         self._capacity = None
         self._format = None
         self._input_vol = None
+        self._backing_store = None
+        self._backing_format = None
 
         self.allocation = allocation
         self.capacity = capacity
@@ -1031,10 +1034,9 @@ class StorageVolume(StorageObject):
                                                     pool_object=pool_object,
                                                     pool_name=pool_name,
                                                     conn=conn)
-        pool_object.refresh(0)
+        existing = _util.list_volume_names(pool_object) + collidelist
 
-        return _util.generate_name(name, pool_object.storageVolLookupByName,
-                                   suffix, collidelist=collidelist)
+        return _util.generate_names(name, existing, suffix=suffix)[0]
     find_free_name = staticmethod(find_free_name)
 
     def lookup_pool_by_name(pool_object=None, pool_name=None, conn=None):
@@ -1137,6 +1139,23 @@ class StorageVolume(StorageObject):
                          doc=_("virStorageVolume pointer to clone/use as "
                                "input."))
 
+    def get_backing_store(self):
+        return self._backing_store
+    def set_backing_store(self, val):
+        if val is not None and not os.path.isabs(val):
+            raise ValueError(_("Backing store must be an absolute path."))
+        self._backing_store = val
+    backing_store = property(get_backing_store, set_backing_store,
+                             doc=_("Path of the volume or file the new "
+                                   "volume is an overlay of."))
+
+    def get_backing_format(self):
+        return self._backing_format
+    def set_backing_format(self, val):
+        self._backing_format = val
+    backing_format = property(get_backing_format, set_backing_format,
+                              doc=_("Format of the backing store."))
+
     # Property functions used by more than one child class
     def get_format(self):
         return self._format
@@ -1181,10 +1200,19 @@ class StorageVolume(StorageObject):
         tar_xml = "  <target>\n" + \
                   "%s" % (self._get_target_xml()) + \
                   "  </target>\n"
+        backing_xml = ""
+        if self.backing_store:
+            backing_xml = "  <backingStore>\n" + \
+                          "    <path>%s</path>\n" % escape(self.backing_store)
+            if self.backing_format:
+                backing_xml += ("    <format type='%s'/>\n" %
+                                self.backing_format)
+            backing_xml += "  </backingStore>\n"
         return  "  <capacity>%d</capacity>\n" % self.capacity + \
                 "  <allocation>%d</allocation>\n" % self.allocation + \
                 "%s" % src_xml + \
-                "%s" % tar_xml
+                "%s" % tar_xml + \
+                "%s" % backing_xml
 
     def install(self, meter=None):
         """
@@ -1211,6 +1239,7 @@ class StorageVolume(StorageObject):
                     vol = self.pool.createXMLFrom(xml, self.input_vol, 0)
                 else:
                     vol = self.pool.createXML(xml, 0)
+                _storageindex.add_volume(self.pool, self.name)
 
                 if meter:
                     meter.end(self.capacity)
@@ -1314,6 +1343,20 @@ class FileVolume(StorageVolume):
     def _get_source_xml(self):
         return ""
 
+class OverlayVolume(FileVolume):
+    """
+    Build and install a qcow2 volume which only holds the changes made on
+    top of its backing store, an existing volume or file
+    """
+
+    def __init__(self, name, capacity, backing_store, backing_format="raw",
+                 pool=None, pool_name=None, conn=None, perms=None):
+        FileVolume.__init__(self, name=name, capacity=capacity, pool=pool,
+                            pool_name=pool_name, conn=conn, format="qcow2",
+                            allocation=0, perms=perms)
+        self.backing_store = backing_store
+        self.backing_format = backing_format
+
 class DiskVolume(StorageVolume):
     """
     Build and install xml volumes for use on physical disk pools
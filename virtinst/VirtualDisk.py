@@ -32,6 +32,10 @@ import libvirt
 
 import virtinst
 import _util
+import _diskio
+import _domcache
+import _storageindex
+import _upload
 import Storage
 from VirtualDevice import VirtualDevice
 from XMLBuilderDomain import _xml_property
@@ -62,6 +66,27 @@ def _vdisk_clone(path, clone):
     except OSError:
         return False
 
+def _qemu_img_overlay(path, backing, backing_format):
+    """
+    Create a qcow2 image at path which uses backing as its backing file
+    """
+    # qemu-img escapes commas in option values by doubling them
+    opts = ("backing_file=%s,backing_fmt=%s" %
+            (backing.replace(",", ",,"), backing_format))
+    cmd = ["qemu-img", "create", "-f", "qcow2", "-o", opts, path]
+    logging.debug("Creating overlay: %s", cmd)
+
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+    except OSError, e:
+        raise RuntimeError(_("Error running qemu-img: %s") % str(e))
+
+    if proc.returncode != 0:
+        raise RuntimeError(_("Error creating overlay %s: %s") %
+                           (path, (err or out).strip()))
+
 def _qemu_sanitize_drvtype(phystype, fmt, manual_format=False):
     """
     Sanitize libvirt storage volume format to a valid qemu driver type
@@ -127,27 +152,7 @@ def _check_if_pool_source(conn, path):
     If passed path is a host disk device like /dev/sda, want to let the user
     use it
     """
-    if not _util.is_storage_capable(conn):
-        return None
-
-    def check_pool(poolname, path):
-        pool = conn.storagePoolLookupByName(poolname)
-        xml = pool.XMLDesc(0)
-
-        for element in ["dir", "device", "adapter"]:
-            xml_path = _util.get_xml_path(xml,
-                                          "/pool/source/%s/@path" % element)
-            if xml_path == path:
-                return pool
-
-    running_list = conn.listStoragePools()
-    inactive_list = conn.listDefinedStoragePools()
-    for plist in [running_list, inactive_list]:
-        for name in plist:
-            p = check_pool(name, path)
-            if p:
-                return p
-    return None
+    return _storageindex.lookup_pool_by_source(conn, path)
 
 def _check_if_path_managed(conn, path):
     """
@@ -170,32 +175,24 @@ def _check_if_path_managed(conn, path):
                 raise
             return None, e
 
-    def lookup_vol_name(name):
-        try:
-            name = os.path.basename(path)
-            if pool and name in pool.listVolumes():
-                return pool.lookupByName(name)
-        except:
-            pass
-        return None
-
     vol = lookup_vol_by_path()[0]
     if not vol:
-        pool = _util.lookup_pool_by_path(conn, os.path.dirname(path))
+        index = _storageindex.get_index(conn)
+        pool = _storageindex.lookup_pool_by_path(conn, os.path.dirname(path))
 
         # Is pool running?
-        if pool and pool.info()[0] != libvirt.VIR_STORAGE_POOL_RUNNING:
+        if pool and not index.is_pool_active(pool):
             pool = None
 
     # Attempt to lookup path as a storage volume
     if pool and not vol:
         try:
-            # Pool may need to be refreshed, but if it errors,
+            # Pool may need to be refreshed (the index does that when
+            # the volume isn't in its list), but if it errors,
             # invalidate it
-            pool.refresh(0)
-            vol, verr = lookup_vol_by_path()
-            if verr:
-                vol = lookup_vol_name(os.path.basename(path))
+            vol = index.lookup_volume(pool, os.path.basename(path))
+            if not vol:
+                vol, verr = lookup_vol_by_path()
         except Exception, e:
             vol = None
             pool = None
@@ -322,6 +319,11 @@ class VirtualDisk(VirtualDevice):
     IO_MODE_THREADS = "threads"
     io_modes = [IO_MODE_NATIVE, IO_MODE_THREADS]
 
+    PREALLOC_AUTO = _diskio.PREALLOC_AUTO
+    PREALLOC_FALLOCATE = _diskio.PREALLOC_FALLOCATE
+    PREALLOC_WRITE = _diskio.PREALLOC_WRITE
+    prealloc_modes = _diskio.prealloc_modes
+
     @staticmethod
     def disk_type_to_xen_driver_name(disk_type):
         """
@@ -473,31 +475,8 @@ class VirtualDisk(VirtualDevice):
         if not path:
             return
 
-        active, inactive = _util.fetch_all_guests(conn)
-        vms = active + inactive
-
-        def count_cb(ctx):
-            c = 0
-
-            template = "count(/domain/devices/disk["
-            if check_conflict:
-                template += "not(shareable) and "
-            template += "source/@%s='%s'])"
-
-            for dtype in VirtualDisk._target_props:
-                xpath = template % (dtype, path)
-                c += ctx.xpathEval(xpath)
-
-            return c
-
-        names = []
-        for vm in vms:
-            xml = vm.XMLDesc(0)
-            tmpcount = _util.get_xml_path(xml, func=count_cb)
-            if tmpcount:
-                names.append(vm.name())
-
-        return names
+        snapshot = _domcache.get_snapshot(conn)
+        return snapshot.path_in_use_by(path, check_conflict=check_conflict)
 
     @staticmethod
     def stat_local_path(path):
@@ -600,6 +579,7 @@ class VirtualDisk(VirtualDevice):
         self._type = None
         self._device = None
         self._sparse = None
+        self._preallocation = None
         self._readOnly = None
         self._vol_object = None
         self._pool_object = None
@@ -609,6 +589,11 @@ class VirtualDisk(VirtualDevice):
         self._driver_cache = None
         self._selinux_label = None
         self._clone_path = None
+        self._clone_engine = None
+        self._clone_abort = None
+        self._clone_backend = None
+        self._clone_backing_format = None
+        self._upload_path = None
         self._format = None
         self._driverName = driverName
         self._driverType = driverType
@@ -678,7 +663,7 @@ class VirtualDisk(VirtualDevice):
         xpath = None
         for prop in self._target_props:
             xpath = "./source/@" + prop
-            if self._xml_ctx.xpathEval(xpath):
+            if self._xml_cache.xpathEval(xpath):
                 return xpath
         return "./source/@file"
     def _xml_set_xpath(self):
@@ -734,6 +719,56 @@ class VirtualDisk(VirtualDevice):
         self.__validate_wrapper("_clone_path", val, validate, self.clone_path)
     clone_path = property(_get_clone_path, _set_clone_path)
 
+    def _get_clone_engine(self):
+        return self._clone_engine
+    def _set_clone_engine(self, val):
+        self._clone_engine = val
+    clone_engine = property(_get_clone_engine, _set_clone_engine,
+                            doc="Engine used to copy clone_path to a local "
+                                "path. If unset, a default engine is used.")
+
+    def _get_clone_abort(self):
+        return self._clone_abort
+    def _set_clone_abort(self, val):
+        self._clone_abort = val
+    clone_abort = property(_get_clone_abort, _set_clone_abort,
+                           doc="Optional threading.Event which stops a "
+                               "local clone in progress when set.")
+
+    def _get_clone_backend(self):
+        return self._clone_backend
+    clone_backend = property(_get_clone_backend,
+                             doc="Name of the copy backend (reflink, "
+                                 "copy_file_range, ...) used by the last "
+                                 "local clone.")
+
+    def _get_clone_backing_format(self):
+        return self._clone_backing_format
+    def _set_clone_backing_format(self, val):
+        self._clone_backing_format = val
+    clone_backing_format = property(_get_clone_backing_format,
+                                    _set_clone_backing_format,
+                                    doc="If set, clone_path isn't copied: "
+                                        "a qcow2 overlay using clone_path, "
+                                        "in this format, as its backing "
+                                        "file is created instead.")
+
+    def _get_upload_path(self):
+        return self._upload_path
+    def _set_upload_path(self, val, validate=True):
+        if val is not None:
+            self._check_str(val, "upload_path")
+            val = os.path.abspath(val)
+            if not os.access(val, os.R_OK) or os.path.isdir(val):
+                raise ValueError(_("Upload path '%s' must be a readable "
+                                   "file.") % val)
+        self.__validate_wrapper("_upload_path", val, validate,
+                                self.upload_path)
+    upload_path = property(_get_upload_path, _set_upload_path,
+                           doc="Local disk image to upload into the new "
+                               "storage volume through a libvirt stream. "
+                               "If sparse, holes in the image aren't sent.")
+
     def _get_size(self):
         retsize = self.__existing_storage_size()
         if retsize is None:
@@ -810,6 +845,19 @@ class VirtualDisk(VirtualDevice):
         self.__validate_wrapper("_sparse", val, validate, self.sparse)
     sparse = property(get_sparse, set_sparse)
 
+    def get_preallocation(self):
+        return self._preallocation
+    def set_preallocation(self, val):
+        if val is not None:
+            self._check_str(val, "preallocation")
+            if val not in self.prealloc_modes:
+                raise ValueError(_("Unknown preallocation mode '%s'") % val)
+        self._preallocation = val
+    preallocation = property(get_preallocation, set_preallocation,
+                             doc="How to fully allocate new local storage "
+                                 "when sparse is False. One of "
+                                 "prealloc_modes, default is PREALLOC_AUTO.")
+
     def get_read_only(self):
         return self._readOnly
     def set_read_only(self, val, validate=True):
@@ -1223,6 +1271,15 @@ class VirtualDisk(VirtualDevice):
 
         self.__set_format()
 
+        if self.upload_path:
+            if not create_media or not self.vol_install:
+                raise ValueError(_("A disk image can only be uploaded "
+                                   "into a new storage volume."))
+            if os.path.getsize(self.upload_path) > self.vol_install.capacity:
+                raise ValueError(_("Disk image '%s' is larger than the "
+                                   "volume being created.") %
+                                 self.upload_path)
+
         # If not creating the storage, our job is easy
         if not create_media:
             # Make sure we have access to the local path
@@ -1272,6 +1329,8 @@ class VirtualDisk(VirtualDevice):
             (not self.clone_path or self.vol_install.input_vol)):
             self._set_vol_object(self.vol_install.install(meter=progresscb),
                                  validate=False)
+            if self.upload_path:
+                self._upload_storage(progresscb)
             # Then just leave: vol_install should handle any selinux stuff
             return
 
@@ -1285,7 +1344,13 @@ class VirtualDisk(VirtualDevice):
         progresscb.start(filename=self.path, size=long(size_bytes),
                          text=text)
 
-        if self.clone_path:
+        if self.clone_path and self.clone_backing_format:
+            # Linked clone, only the overlay is created
+            _qemu_img_overlay(self.path, self.clone_path,
+                              self.clone_backing_format)
+            progresscb.end(size_bytes)
+
+        elif self.clone_path:
             # VDisk clone
             if (_util.is_vdisk(self.clone_path) or
                 (os.path.exists(self.path) and _util.is_vdisk(self.path))):
@@ -1323,24 +1388,14 @@ class VirtualDisk(VirtualDevice):
 
         try:
             try:
-                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_DSYNC)
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT)
 
                 if sparse:
                     os.ftruncate(fd, size_bytes)
                 else:
-                    # 1 meg of nulls
-                    mb = 1024 * 1024
-                    buf = '\x00' * mb
-
-                    left = size_bytes
-                    while left > 0:
-                        if left < mb:
-                            buf = '\x00' * left
-                        left = max(left - mb, 0)
-
-                        os.write(fd, buf)
-                        progresscb.update(size_bytes - left)
-            except OSError, e:
+                    _diskio.preallocate(fd, size_bytes, self.preallocation,
+                                        progresscb)
+            except (OSError, IOError), e:
                 raise RuntimeError(_("Error creating diskimage %s: %s") %
                                    (path, str(e)))
         finally:
@@ -1348,61 +1403,44 @@ class VirtualDisk(VirtualDevice):
                 os.close(fd)
             progresscb.end(size_bytes)
 
+    def _upload_storage(self, meter):
+        """
+        Upload upload_path into the volume we just created
+        """
+        vol = self.vol_object
+        logging.debug("Uploading %s to %s, sparse=%s",
+                      self.upload_path, vol.path(), self.sparse)
+        try:
+            _upload.upload_volume(self.conn, vol, self.upload_path, meter,
+                                  _("Uploading %s") %
+                                  os.path.basename(self.upload_path),
+                                  sparse=self.sparse)
+        except Exception, e:
+            try:
+                vol.delete(0)
+            except libvirt.libvirtError:
+                logging.debug("Failed to remove volume after failed "
+                              "upload", exc_info=True)
+            raise RuntimeError(_("Error uploading %s to %s: %s") %
+                               (self.upload_path, vol.path(), str(e)))
+
     def _clone_local(self, meter, size_bytes):
 
         # if a destination file exists and sparse flg is True,
         # this priority takes a existing file.
-        if (os.path.exists(self.path) == False and self.sparse == True):
-            clone_block_size = 4096
-            sparse = True
-            fd = None
-            try:
-                fd = os.open(self.path, os.O_WRONLY | os.O_CREAT)
-                os.ftruncate(fd, size_bytes)
-            finally:
-                if fd:
-                    os.close(fd)
-        else:
-            clone_block_size = 1024 * 1024 * 10
-            sparse = False
+        sparse = (not os.path.exists(self.path) and self.sparse)
+        engine = self.clone_engine or _diskio.CloneEngine()
 
         logging.debug("Local Cloning %s to %s, sparse=%s, block_size=%s",
-                      self.clone_path, self.path, sparse, clone_block_size)
-
-        zeros = '\0' * 4096
+                      self.clone_path, self.path, sparse, engine.blocksize)
 
-        src_fd, dst_fd = None, None
         try:
-            try:
-                src_fd = os.open(self.clone_path, os.O_RDONLY)
-                dst_fd = os.open(self.path, os.O_WRONLY | os.O_CREAT)
-
-                i = 0
-                while 1:
-                    l = os.read(src_fd, clone_block_size)
-                    s = len(l)
-                    if s == 0:
-                        meter.end(size_bytes)
-                        break
-                    # check sequence of zeros
-                    if sparse and zeros == l:
-                        os.lseek(dst_fd, s, 1)
-                    else:
-                        b = os.write(dst_fd, l)
-                        if s != b:
-                            meter.end(i)
-                            break
-                    i += s
-                    if i < size_bytes:
-                        meter.update(i)
-            except OSError, e:
-                raise RuntimeError(_("Error cloning diskimage %s to %s: %s") %
-                                       (self.clone_path, self.path, str(e)))
-        finally:
-            if src_fd is not None:
-                os.close(src_fd)
-            if dst_fd is not None:
-                os.close(dst_fd)
+            job = engine.clone(self.clone_path, self.path, size_bytes,
+                               sparse, meter, abort=self.clone_abort)
+            self._clone_backend = job.backend.name
+        except (OSError, IOError), e:
+            raise RuntimeError(_("Error cloning diskimage %s to %s: %s") %
+                               (self.clone_path, self.path, str(e)))
 
     def setup_dev(self, conn=None, meter=None):
         """
@@ -1427,6 +1465,46 @@ class VirtualDisk(VirtualDevice):
         if self.__creating_storage() or self.clone_path:
             self._do_create_storage(progresscb)
 
+        self._relabel_storage()
+
+    @staticmethod
+    def setup_clones(disks, meters=None):
+        """
+        Clone the local clone_path shared by all the passed disks to each
+        of their paths, reading the source only once. The clone_engine,
+        sparse and size settings of the first disk are used for all.
+
+        @param disks: VirtualDisk instances with the same clone_path
+        @param meters: Optional list of progress meters, one per disk
+        """
+        first = disks[0]
+        meters = meters or [progress.BaseMeter() for d in disks]
+        engine = first.clone_engine or _diskio.CloneEngine()
+        size_bytes = long(first.size * 1024L * 1024L * 1024L)
+
+        text = (_("Cloning %(srcfile)s") %
+                {'srcfile' : os.path.basename(first.clone_path)})
+        for disk, meter in zip(disks, meters):
+            meter.start(filename=disk.path, size=size_bytes, text=text)
+
+        logging.debug("Local Cloning %s to %s, sparse=%s, block_size=%s",
+                      first.clone_path, [d.path for d in disks],
+                      first.sparse, engine.blocksize)
+
+        try:
+            jobs = engine.clone_many(first.clone_path,
+                                     [d.path for d in disks], size_bytes,
+                                     first.sparse, meters,
+                                     abort=first.clone_abort)
+        except (OSError, IOError), e:
+            raise RuntimeError(_("Error cloning diskimage %s: %s") %
+                               (first.clone_path, str(e)))
+
+        for disk, job in zip(disks, jobs):
+            disk._clone_backend = job.backend.name
+            disk._relabel_storage()
+
+    def _relabel_storage(self):
         # Relabel storage if it was requested
         storage_label = self._storage_security_label()
         if storage_label and storage_label != self.selinux_label:
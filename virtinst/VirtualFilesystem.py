@@ -125,7 +125,7 @@ class VirtualFilesystem(VirtualDevice.VirtualDevice):
         ret = "./source/@dir"
         for prop in self._target_props:
             xpath = "./source/@" + prop
-            if self._xml_ctx.xpathEval(xpath):
+            if self._xml_cache.xpathEval(xpath):
                 ret = xpath
 
         return ret
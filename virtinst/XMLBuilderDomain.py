@@ -20,6 +20,8 @@
 # MA 02110-1301 USA.
 
 import copy
+import re
+import weakref
 
 import libvirt
 import libxml2
@@ -28,36 +30,99 @@ import CapabilitiesParser
 import _util
 from virtinst import _gettext as _
 
+# Parsed documents in use, mapping the document's key to a
+# [doc, refcount] pair. libxml2 wrappers hash on the underlying xmlDoc
+# pointer, so every wrapper of a document maps to the same key
 _xml_refs = {}
-def _unref_doc(doc):
-    if not doc:
-        return
 
-    idx = None
-    for n in _xml_refs:
-        if n == doc:
-            idx = n
-            break
+# Maps a weak reference to each XMLBuilderDomain with parsed XML to the
+# _DocRef it holds. The weak reference callback releases the _DocRef
+# when its owner is collected
+_xml_owners = {}
 
-    if not idx:
+_xml_contexts = 0
+
+def _unref_doc(key):
+    if key not in _xml_refs:
         return
 
-    _xml_refs[idx] = _xml_refs[idx] - 1
-    if _xml_refs[idx] == 0:
-        idx.freeDoc()
+    entry = _xml_refs[key]
+    entry[1] -= 1
+    if entry[1] == 0:
+        del(_xml_refs[key])
+        entry[0].freeDoc()
 
 def _ref_doc(doc):
+    """
+    Take a reference on doc, returning the key to unref it with
+    """
     if not doc:
-        return
+        return None
 
-    idx = doc
-    for n in _xml_refs:
-        if n == doc:
-            idx = n
-            break
+    key = hash(doc)
+    if key in _xml_refs:
+        _xml_refs[key][1] += 1
+    else:
+        _xml_refs[key] = [doc, 1]
+    return key
 
-    refcount = _xml_refs.get(idx) or 0
-    _xml_refs[idx] = refcount + 1
+class _DocRef(object):
+    """
+    One object's reference to a parsed document, along with the xpath
+    context it evaluates against. This holds no reference to its owner,
+    so it can be released from a weak reference callback.
+    """
+    def __init__(self, doc):
+        # Remember the document we referenced. Nodes can move to another
+        # document later, like devices added to a parsed guest
+        self.key = _ref_doc(doc)
+        self.ctx = None
+
+    def set_ctx(self, ctx):
+        global _xml_contexts
+
+        self._free_ctx()
+        self.ctx = ctx
+        if ctx:
+            _xml_contexts += 1
+
+    def _free_ctx(self):
+        global _xml_contexts
+
+        if self.ctx:
+            self.ctx.xpathFreeContext()
+            self.ctx = None
+            _xml_contexts -= 1
+
+    def release(self):
+        self._free_ctx()
+        if self.key is not None:
+            _unref_doc(self.key)
+            self.key = None
+
+def _owner_collected(ownerref):
+    try:
+        docref = _xml_owners.pop(ownerref, None)
+        if docref:
+            docref.release()
+    except:
+        # Module globals may already be gone at interpreter exit
+        pass
+
+def get_doc_registry_stats():
+    """
+    Return a dict describing the parsed XML still in use: the number of
+    live documents, the references held on them, the objects holding
+    those references, and the xpath contexts allocated for them. The
+    counts stay constant across the lifetime of a long running process
+    unless parsed objects are leaked.
+    """
+    return {
+        "docs": len(_xml_refs),
+        "refs": sum([entry[1] for entry in _xml_refs.values()]),
+        "owners": len(_xml_owners),
+        "contexts": _xml_contexts,
+    }
 
 def _sanitize_libxml_xml(xml):
     # Strip starting <?...> line
@@ -67,34 +132,146 @@ def _sanitize_libxml_xml(xml):
         xml += "\n"
     return xml
 
+# Bumped whenever nodes are added to or removed from a parsed document.
+# xpath results cached before the bump may hold freed nodes
+_xml_generation = 0
+
+# Bumped whenever node content changes, which may change what xpath
+# predicates like [@type='pci'] match
+_xml_content_generation = 0
+
+def _xml_changed(structure=True):
+    global _xml_generation
+    global _xml_content_generation
+
+    if structure:
+        _xml_generation += 1
+    _xml_content_generation += 1
+
+def _xpath_tests_content(xpath):
+    return "[" in xpath or "(" in xpath
+
+# xpaths like ./source/@file, which only step through child elements and
+# optionally end at an attribute, can be answered from an index
+_simple_xpath = re.compile(r"^\.(/[A-Za-z_][\w.-]*)*(/@[A-Za-z_][\w.-]*)?$")
+
+def _index_element(targets, node, subindex_paths, subindexes):
+    prop = node.properties
+    while prop:
+        if prop.type == "attribute" and not prop.ns():
+            for index, path in targets:
+                index.setdefault(path + "/@" + prop.name, []).append(prop)
+        prop = prop.next
+
+    child = node.children
+    while child:
+        if child.type == "element" and not child.ns():
+            childtargets = [(index, path + "/" + child.name)
+                            for index, path in targets]
+            for index, path in childtargets:
+                index.setdefault(path, []).append(child)
+
+            if childtargets[0][1] in subindex_paths:
+                subindex = {".": [child]}
+                subindexes.append((child, subindex))
+                childtargets.append((subindex, "."))
+
+            _index_element(childtargets, child, subindex_paths, subindexes)
+        child = child.next
+
+def _index_xml_tree(node, subindex_paths=None):
+    """
+    Walk the tree under node once, mapping every simple xpath relative
+    to node to the list of nodes it selects, in document order. Elements
+    found at any of subindex_paths get an index of their own subtree,
+    built in the same pass.
+
+    @returns: (index, [(subnode, subindex), ...])
+    """
+    index = {".": [node]}
+    subindexes = []
+    _index_element([(index, ".")], node, subindex_paths or [], subindexes)
+    return index, subindexes
+
+class _XPathCache(object):
+    """
+    Evaluates xpaths relative to a node, remembering each result.
+    Results are dropped when any parsed document is structurally edited,
+    and results of xpaths with predicates or functions are also dropped
+    when node content changes.
+
+    Simple xpaths are answered from an index of the subtree if one was
+    seeded. The xpath context is only created once a query needs it.
+    """
+    def __init__(self, node, docref):
+        self.node = node
+        self.docref = docref
+        self._index = None
+        self._results = {}
+        self._generation = _xml_generation
+
+    def seed(self, index):
+        self._index = index
+
+    def _get_ctx(self):
+        if not self.docref.ctx:
+            ctx = self.node.doc.xpathNewContext()
+            ctx.setContextNode(self.node)
+            self.docref.set_ctx(ctx)
+        return self.docref.ctx
+
+    def xpathEval(self, xpath):
+        if self._generation != _xml_generation:
+            self._index = None
+            self._results = {}
+            self._generation = _xml_generation
+
+        cached = self._results.get(xpath)
+        if cached and cached[0] in [None, _xml_content_generation]:
+            return cached[1]
+
+        if self._index is not None and _simple_xpath.match(xpath):
+            ret = self._index.get(xpath, [])
+            self._results[xpath] = (None, ret)
+            return ret
+
+        ret = self._get_ctx().xpathEval(xpath)
+
+        content_gen = None
+        if _xpath_tests_content(xpath):
+            content_gen = _xml_content_generation
+        self._results[xpath] = (content_gen, ret)
+        return ret
+
 def _get_xpath_node(ctx, xpath, is_multi=False):
     node = ctx.xpathEval(xpath)
     if not is_multi:
         return (node and node[0] or None)
     return node
 
+def _set_node_content(node, val):
+    # Setting element content frees its children, so if any of them
+    # are elements, cached results may point at freed nodes
+    structure = False
+    if node.type == "element":
+        child = node.children
+        while child:
+            if child.type != "text":
+                structure = True
+                break
+            child = child.next
+
+    node.setContent(val)
+    _xml_changed(structure)
+
 def _build_xpath_node(ctx, xpath, addnode=None):
     """
     Build all nodes required to set an xpath. If we have XML <foo/>, and want
     to set xpath /foo/bar/baz@booyeah, we create node 'bar' and 'baz'
     returning the last node created.
     """
-    parentpath = ""
     parentnode = None
 
-    def prevSibling(node):
-        parent = node.get_parent()
-        if not parent:
-            return None
-
-        prev = None
-        for child in parent.children:
-            if child == node:
-                return prev
-            prev = child
-
-        return None
-
     def make_node(parentnode, newnode):
         # Add the needed parent node, try to preserve whitespace by
         # looking for a starting TEXT node, and copying it
@@ -111,7 +288,7 @@ def _build_xpath_node(ctx, xpath, addnode=None):
             # <features>
             #   <acpi/>
             # </features>
-            prevsib = prevSibling(parentnode)
+            prevsib = parentnode.get_prev()
             if node_is_text(prevsib):
                 sib = libxml2.newText(prevsib.content)
             else:
@@ -135,29 +312,33 @@ def _build_xpath_node(ctx, xpath, addnode=None):
 
         sib.addNextSibling(newnode)
         newnode.addNextSibling(txt)
+        _xml_changed()
         return newnode
 
-    nodelist = xpath.split("/")
-    for idx in range(len(nodelist)):
-        nodename = nodelist[idx]
-        if not nodename:
+    nodelist = [n for n in xpath.split("/") if n]
+    if xpath.startswith("/") and nodelist:
+        nodelist[0] = "/" + nodelist[0]
+
+    # Find the deepest element of the path that already exists. Anything
+    # below it has to be created, and can't match a query since the
+    # created nodes start out empty
+    start = 0
+    for idx in range(len(nodelist), 0, -1):
+        if nodelist[idx - 1].startswith("@"):
             continue
 
+        node = _get_xpath_node(ctx, "/".join(nodelist[:idx]))
+        if node:
+            parentnode = node
+            start = idx
+            break
+
+    for nodename in nodelist[start:]:
         # If xpath is a node property, set it and move on
         if nodename.startswith("@"):
             nodename = nodename.strip("@")
             parentnode = parentnode.setProp(nodename, "")
-            continue
-
-        if not parentpath:
-            parentpath = nodename
-        else:
-            parentpath += "/%s" % nodename
-
-        # Node found, nothing to create for now
-        node = _get_xpath_node(ctx, parentpath)
-        if node:
-            parentnode = node
+            _xml_changed()
             continue
 
         if not parentnode:
@@ -207,6 +388,7 @@ def _remove_xpath_node(ctx, xpath, dofree=True):
             white.freeNode()
 
         node.unlinkNode()
+        _xml_changed()
         if dofree:
             node.freeNode()
 
@@ -266,7 +448,7 @@ def _xml_property(fget=None, fset=None, fdel=None, doc=None,
         if usexpath is None:
             return getval
 
-        nodes = _util.listify(_get_xpath_node(self._xml_ctx,
+        nodes = _util.listify(_get_xpath_node(self._xml_cache,
                                               usexpath, is_multi))
         if nodes:
             ret = []
@@ -311,7 +493,7 @@ def _xml_property(fget=None, fset=None, fdel=None, doc=None,
         if nodexpath is None:
             return
 
-        nodes = _util.listify(_get_xpath_node(self._xml_ctx,
+        nodes = _util.listify(_get_xpath_node(self._xml_cache,
                                               nodexpath, is_multi))
 
         xpath_list = nodexpath
@@ -329,15 +511,15 @@ def _xml_property(fget=None, fset=None, fdel=None, doc=None,
 
             if val not in [None, False]:
                 if not node:
-                    node = _build_xpath_node(self._xml_node, usexpath)
+                    node = _build_xpath_node(self._xml_cache, usexpath)
 
                 if val is True:
                     # Boolean property, creating the node is enough
                     pass
                 else:
-                    node.setContent(str(val))
+                    _set_node_content(node, str(val))
             else:
-                _remove_xpath_node(self._xml_node, usexpath)
+                _remove_xpath_node(self._xml_cache, usexpath)
 
 
     if fdel:
@@ -370,7 +552,8 @@ class XMLBuilderDomain(object):
         self.__caps = None
 
         self._xml_node = None
-        self._xml_ctx = None
+        self._xml_cache = None
+        self._xml_ownerref = None
 
         if conn:
             self.set_conn(conn)
@@ -383,18 +566,6 @@ class XMLBuilderDomain(object):
         if parsexml or parsexmlnode:
             self._parsexml(parsexml, parsexmlnode)
 
-    def __del__(self):
-        try:
-            if self._xml_node:
-                _unref_doc(self._xml_node.doc)
-        except:
-            pass
-        try:
-            if self._xml_ctx:
-                self._xml_ctx.xpathFreeContext()
-        except:
-            pass
-
     def copy(self):
         # Otherwise we can double free XML info
         if self._is_parse():
@@ -416,7 +587,7 @@ class XMLBuilderDomain(object):
 
     def _get_caps(self):
         if not self.__caps and self.conn:
-            self.__caps = CapabilitiesParser.parse(self.conn.getCapabilities())
+            self.__caps = CapabilitiesParser.get_caps(self.conn)
         return self.__caps
 
     def is_remote(self):
@@ -440,7 +611,7 @@ class XMLBuilderDomain(object):
                                 (name, type(val))))
 
     def _is_parse(self):
-        return bool(self._xml_node or self._xml_ctx)
+        return bool(self._xml_node)
 
     def set_xml_node(self, node):
         self._parsexml(None, node)
@@ -451,20 +622,24 @@ class XMLBuilderDomain(object):
         return None
 
     def _add_child_node(self, parent_xpath, newnode):
-        ret = _build_xpath_node(self._xml_ctx, parent_xpath, newnode)
+        ret = _build_xpath_node(self._xml_cache, parent_xpath, newnode)
         return ret
 
     def _remove_child_xpath(self, xpath):
-        _remove_xpath_node(self._xml_ctx, xpath, dofree=False)
+        _remove_xpath_node(self._xml_cache, xpath, dofree=False)
         self._set_xml_context()
 
     def _set_xml_context(self):
-        doc = self._xml_node.doc
-        ctx = doc.xpathNewContext()
-        ctx.setContextNode(self._xml_node)
-        if self._xml_ctx:
-            self._xml_ctx.xpathFreeContext()
-        self._xml_ctx = ctx
+        docref = _xml_owners[self._xml_ownerref]
+        docref.set_ctx(None)
+        self._xml_cache = _XPathCache(self._xml_node, docref)
+
+    def _seed_xml_index(self, index):
+        """
+        Answer simple xpath lookups from index, as built by
+        _index_xml_tree for our node, until the XML is next edited
+        """
+        self._xml_cache.seed(index)
 
     def _parsexml(self, xml, node):
         if xml:
@@ -472,7 +647,14 @@ class XMLBuilderDomain(object):
         else:
             self._xml_node = node
 
-        _ref_doc(self._xml_node.doc)
+        # Reference the new document before dropping whatever we parsed
+        # before, in case they are the same
+        docref = _DocRef(self._xml_node.doc)
+        if self._xml_ownerref:
+            _owner_collected(self._xml_ownerref)
+
+        self._xml_ownerref = weakref.ref(self, _owner_collected)
+        _xml_owners[self._xml_ownerref] = docref
         self._set_xml_context()
 
     def _get_xml_config(self):
@@ -488,8 +670,8 @@ class XMLBuilderDomain(object):
         @return: object xml representation as a string
         @rtype: str
         """
-        if self._xml_ctx:
-            node = _get_xpath_node(self._xml_ctx, self._dumpxml_xpath)
+        if self._xml_node:
+            node = _get_xpath_node(self._xml_cache, self._dumpxml_xpath)
             if not node:
                 return ""
             return _sanitize_libxml_xml(node.serialize())
@@ -498,10 +680,8 @@ class XMLBuilderDomain(object):
 
     @staticmethod
     def indent(xmlstr, level):
-        xml = ""
         if not xmlstr:
-            return xml
+            return ""
 
-        for l in iter(xmlstr.splitlines()):
-            xml += " " * level + l + "\n"
-        return xml
+        pad = " " * level
+        return "".join([pad + l + "\n" for l in xmlstr.splitlines()])
@@ -34,6 +34,7 @@ enable_rhel6_defaults = _config.rhel6defaults
 
 import Storage
 import Interface
+import Provisioner
 from Guest import Guest, XenGuest
 from VirtualDevice import VirtualDevice
 from VirtualNetworkInterface import VirtualNetworkInterface, \
@@ -75,7 +76,7 @@ __all__ = ["Guest", "XenGuest", "VirtualNetworkInterface",
            "VirtualDisk", "XenDisk", "FullVirtGuest", "ParaVirtGuest",
            "DistroInstaller", "PXEInstaller", "LiveCDInstaller",
            "ImportInstaller", "ImageInstaller", "CloneDesign",
-           "Storage", "Interface",
+           "Storage", "Interface", "Provisioner",
            "User", "util", "support", "VirtualDevice", "Clock", "Seclabel",
            "CPU",
            "VirtualHostDevice", "VirtualHostDeviceUSB", "VirtualVideoDevice",
@@ -0,0 +1,199 @@
+#
+# Building cpio archives for initrd injection
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal cpio writer. These do NOT form part of the API and must not be
+# used by clients.
+#
+
+import os
+import stat
+import StringIO
+import threading
+import time
+import zlib
+
+# gzip compression level of appended archives. 0 appends an uncompressed
+# archive, which the kernel accepts as well
+DEFAULT_COMPRESS_LEVEL = 6
+
+# Archives whose inputs total at most this many bytes are built in memory
+# and remembered, so injecting the same files into many initrds only
+# builds the archive once
+MEMO_MAX_BYTES = 4 * 1024 * 1024
+_MEMO_MAX_ENTRIES = 8
+
+_memo = {}
+_memo_order = []
+_memo_lock = threading.Lock()
+
+_BLOCKSIZE = 1024 * 1024
+
+_NEWC_MAGIC = "070701"
+_TRAILER = "TRAILER!!!"
+
+
+def _pad(length):
+    return "\0" * ((4 - length % 4) % 4)
+
+class _GzipSink(object):
+    """
+    Write a single gzip member to fileobj
+    """
+    def __init__(self, fileobj, level):
+        self._fileobj = fileobj
+        # wbits 16 + MAX_WBITS selects the gzip container
+        self._compress = zlib.compressobj(level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        self._fileobj.write(self._compress.compress(data))
+
+    def close(self):
+        self._fileobj.write(self._compress.flush())
+
+
+class CpioWriter(object):
+    """
+    Writes a newc format cpio archive, as the kernel expects in an
+    initramfs, to any object with a write method. Entries are owned by
+    root.
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._ino = 0
+        self._mtime = int(time.time())
+
+    def _header(self, name, mode, size, mtime):
+        self._ino += 1
+        fields = [self._ino, mode, 0, 0, 1, mtime, size,
+                  0, 0, 0, 0, len(name) + 1, 0]
+        header = _NEWC_MAGIC + "".join(["%08X" % f for f in fields])
+        header += name + "\0"
+        self._fileobj.write(header + _pad(len(header)))
+
+    def add_dir(self, name, mode=0755):
+        self._header(name, stat.S_IFDIR | mode, 0, self._mtime)
+
+    def add_file(self, name, path):
+        """
+        Add the file at path as name, streaming its contents
+        """
+        f = open(path, "rb")
+        try:
+            st = os.fstat(f.fileno())
+            self._header(name, stat.S_IFREG | stat.S_IMODE(st.st_mode),
+                         st.st_size, int(st.st_mtime))
+
+            remaining = st.st_size
+            while remaining > 0:
+                buf = f.read(min(_BLOCKSIZE, remaining))
+                if not buf:
+                    raise IOError("%s shrank while being archived" % path)
+                self._fileobj.write(buf)
+                remaining -= len(buf)
+        finally:
+            f.close()
+        self._fileobj.write(_pad(st.st_size))
+
+    def close(self):
+        self._header(_TRAILER, 0, 0, 0)
+
+
+def write_archive(fileobj, paths, level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Write a cpio archive holding each file in paths at the root
+    directory, gzip compressed unless level is 0
+    """
+    sink = fileobj
+    if level:
+        sink = _GzipSink(fileobj, level)
+
+    writer = CpioWriter(sink)
+    writer.add_dir(".")
+    for path in paths:
+        writer.add_file(os.path.basename(path), path)
+    writer.close()
+
+    if level:
+        sink.close()
+
+def _memo_key(paths, level):
+    key = [level]
+    total = 0
+    for path in paths:
+        st = os.stat(path)
+        total += st.st_size
+        key.append((os.path.abspath(path), st.st_size, st.st_mtime,
+                    st.st_mode, st.st_ino))
+    return tuple(key), total
+
+def build_archive(paths, level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Return the archive for paths as a string, building it only if the
+    files have changed since the last call
+    """
+    key, ignore = _memo_key(paths, level)
+
+    _memo_lock.acquire()
+    try:
+        if key in _memo:
+            return _memo[key]
+    finally:
+        _memo_lock.release()
+
+    buf = StringIO.StringIO()
+    write_archive(buf, paths, level)
+    data = buf.getvalue()
+
+    _memo_lock.acquire()
+    try:
+        if key not in _memo:
+            _memo[key] = data
+            _memo_order.append(key)
+            while len(_memo_order) > _MEMO_MAX_ENTRIES:
+                del(_memo[_memo_order.pop(0)])
+    finally:
+        _memo_lock.release()
+    return data
+
+def append_archive(dst, paths, level=DEFAULT_COMPRESS_LEVEL):
+    """
+    Append an archive of paths to the file dst. If anything fails, dst
+    is truncated back to its original size.
+    """
+    ignore, total = _memo_key(paths, level)
+
+    f = open(dst, "ab")
+    try:
+        origsize = os.fstat(f.fileno()).st_size
+        try:
+            if not level:
+                # The kernel only looks for an uncompressed archive at a
+                # 4 byte aligned offset, and skips NUL padding before it
+                f.write("\0" * ((4 - origsize % 4) % 4))
+            if total <= MEMO_MAX_BYTES:
+                f.write(build_archive(paths, level))
+            else:
+                write_archive(f, paths, level)
+            f.flush()
+        except:
+            f.truncate(origsize)
+            raise
+    finally:
+        f.close()
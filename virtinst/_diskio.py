@@ -0,0 +1,1001 @@
+#
+# Helpers for copying local disk images
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal disk I/O helpers. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import os
+import io
+import errno
+import fcntl
+import logging
+import struct
+import threading
+import Queue
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+# os.SEEK_DATA/os.SEEK_HOLE are not exposed by python, but the values
+# are the same on Linux and Solaris
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+# Errors lseek returns if the kernel or filesystem can't report holes
+_NO_SEEK_HOLE_ERRORS = [errno.EINVAL, errno.ENOSYS,
+                        getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+                        errno.EOPNOTSUPP]
+
+# Errors meaning a copy offload method isn't usable for this source and
+# destination, so the next one should be tried
+_NO_OFFLOAD_ERRORS = _NO_SEEK_HOLE_ERRORS + [errno.EXDEV, errno.ENOTTY,
+                                             errno.EBADF]
+
+# linux/fs.h _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+def get_extents(fd, size):
+    """
+    Return a list of (offset, length) tuples describing the data regions
+    of the open file 'fd', up to 'size' bytes. Holes are omitted. If the
+    kernel or filesystem can't report holes, the whole range is returned
+    as a single extent.
+    """
+    extents = []
+    offset = 0
+
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, e:
+                if e.errno != errno.ENXIO:
+                    raise
+                # No data past 'offset'
+                break
+
+            if start >= size:
+                break
+
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            extents.append((start, end - start))
+            offset = end
+    except OSError, e:
+        if e.errno not in _NO_SEEK_HOLE_ERRORS:
+            raise
+        logging.debug("SEEK_DATA/SEEK_HOLE not supported: %s", str(e))
+        extents = [(0, size)]
+
+    os.lseek(fd, 0, 0)
+    return extents
+
+def is_zero(buf, start, end):
+    """
+    Return True if buf[start:end] is all NUL bytes, without copying
+    """
+    if buf[start] or buf[end - 1]:
+        return False
+    return buf.count("\0", start, end) == (end - start)
+
+def write_all(fileobj, view):
+    """
+    Write all of memoryview 'view' to fileobj, handling short writes
+    without copying. Returns the number of bytes written.
+    """
+    total = len(view)
+    offset = 0
+    while offset < total:
+        ret = fileobj.write(view[offset:])
+        if not ret:
+            raise IOError(errno.EIO, "Short write to %s" % fileobj.name)
+        offset += ret
+    return total
+
+
+QCOW2_MAGIC = "QFI\xfb"
+
+# Header magic of the image formats qemu can back an overlay with,
+# checked in order
+_FORMAT_MAGICS = [("QFI\xfb", None),
+                  ("QED\0", "qed"),
+                  ("KDMV", "vmdk"),
+                  ("# Disk DescriptorFile", "vmdk"),
+                  ("conectix", "vpc"),
+                  ("<<< ", "vdi")]
+
+def get_image_format(path):
+    """
+    Return the format of the image at path, as named by qemu, going by
+    its header. Files without a known header are 'raw'.
+    """
+    f = open(path, "rb")
+    try:
+        header = f.read(64)
+    finally:
+        f.close()
+
+    for magic, fmt in _FORMAT_MAGICS:
+        if not header.startswith(magic):
+            continue
+        if magic == QCOW2_MAGIC:
+            version = struct.unpack(">I", header[4:8])[0]
+            fmt = version == 1 and "qcow" or "qcow2"
+        return fmt
+    return "raw"
+
+def get_backing_file(path):
+    """
+    Return the absolute path of the backing file recorded in the header
+    of the qcow2 image at path, or None if it isn't a qcow2 image with a
+    backing file. Relative backing paths are resolved against the
+    directory of the image, as qemu does.
+    """
+    f = open(path, "rb")
+    try:
+        header = f.read(20)
+        if len(header) < 20 or header[:4] != QCOW2_MAGIC:
+            return None
+
+        offset = struct.unpack(">Q", header[8:16])[0]
+        size = struct.unpack(">I", header[16:20])[0]
+        if not offset or not size:
+            return None
+
+        f.seek(offset)
+        backing = f.read(size)
+    finally:
+        f.close()
+
+    return os.path.join(os.path.dirname(os.path.abspath(path)), backing)
+
+_libc = None
+def _libc_func(name, restype, argtypes):
+    """
+    Lookup a libc function via ctypes, raising ENOSYS if unavailable
+    """
+    global _libc
+    if ctypes and _libc is None:
+        try:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        except Exception, e:
+            logging.debug("Failed to load libc: %s", str(e))
+            _libc = False
+
+    func = _libc and getattr(_libc, name, None)
+    if not func:
+        raise OSError(errno.ENOSYS, "%s is not available" % name)
+
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+def _check_ret(ret):
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+class CopyBackend(object):
+    """
+    Method for moving data between two open files. Subclasses override
+    copy(), which raises OSError with one of _NO_OFFLOAD_ERRORS if the
+    method isn't supported for the passed files.
+    """
+    name = None
+
+    # If True, copy() always duplicates the whole source file
+    whole_file = False
+
+    def copy(self, src_fd, dst_fd, offset, length):
+        """
+        Copy 'length' bytes at 'offset' from src_fd to the same offset
+        in dst_fd. Returns the number of bytes copied, which is only
+        less than length if the source hit EOF.
+        """
+        raise NotImplementedError()
+
+
+class ReflinkBackend(CopyBackend):
+    """
+    Share the source extents with FICLONE (btrfs, XFS, ...)
+    """
+    name = "reflink"
+    whole_file = True
+
+    def copy(self, src_fd, dst_fd, offset, length):
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return length
+
+
+class CopyFileRangeBackend(CopyBackend):
+    """
+    In kernel copy with copy_file_range(2), which filesystems can turn
+    into a reflink or server side copy
+    """
+    name = "copy_file_range"
+
+    def copy(self, src_fd, dst_fd, offset, length):
+        func = _libc_func("copy_file_range", ctypes.c_ssize_t,
+                          [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                           ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                           ctypes.c_size_t, ctypes.c_uint])
+        off_in = ctypes.c_int64(offset)
+        off_out = ctypes.c_int64(offset)
+
+        left = length
+        while left > 0:
+            ret = _check_ret(func(src_fd, ctypes.byref(off_in),
+                                  dst_fd, ctypes.byref(off_out),
+                                  min(left, 1024 * 1024 * 1024), 0))
+            if not ret:
+                break
+            left -= ret
+        return length - left
+
+
+class SendfileBackend(CopyBackend):
+    """
+    In kernel copy with sendfile(2), avoiding userspace buffers
+    """
+    name = "sendfile"
+
+    def copy(self, src_fd, dst_fd, offset, length):
+        func = _libc_func("sendfile64", ctypes.c_ssize_t,
+                          [ctypes.c_int, ctypes.c_int,
+                           ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t])
+        off_in = ctypes.c_int64(offset)
+        os.lseek(dst_fd, offset, 0)
+
+        left = length
+        while left > 0:
+            ret = _check_ret(func(dst_fd, src_fd, ctypes.byref(off_in),
+                                  min(left, 1024 * 1024 * 1024)))
+            if not ret:
+                break
+            left -= ret
+        return length - left
+
+
+class ReadWriteBackend(CopyBackend):
+    """
+    Plain read/write through a userspace buffer. Always available. Sparse
+    clones always go through the engine's own buffers instead, so zero
+    blocks inside data extents can be skipped.
+    """
+    name = "readwrite"
+
+    def __init__(self, blocksize=1024 * 1024):
+        self.blocksize = blocksize
+
+    def copy(self, src_fd, dst_fd, offset, length):
+        os.lseek(src_fd, offset, 0)
+        os.lseek(dst_fd, offset, 0)
+
+        left = length
+        while left > 0:
+            buf = os.read(src_fd, min(left, self.blocksize))
+            if not buf:
+                break
+
+            pos = 0
+            while pos < len(buf):
+                ret = os.write(dst_fd, buf[pos:])
+                if not ret:
+                    raise IOError(errno.EIO, "Short write to fd %d" % dst_fd)
+                pos += ret
+            left -= len(buf)
+        return length - left
+
+
+def default_backends():
+    """
+    Return copy backends in order of preference
+    """
+    return [ReflinkBackend(), CopyFileRangeBackend(), SendfileBackend(),
+            ReadWriteBackend()]
+
+
+# Preallocation strategies for non-sparse files
+PREALLOC_AUTO = "auto"
+PREALLOC_FALLOCATE = "fallocate"
+PREALLOC_WRITE = "write"
+prealloc_modes = [PREALLOC_AUTO, PREALLOC_FALLOCATE, PREALLOC_WRITE]
+
+class PreallocStrategy(object):
+    """
+    Method for fully allocating a new file. Subclasses override
+    allocate(), which raises OSError with one of _NO_OFFLOAD_ERRORS if
+    the method isn't supported for the passed file.
+    """
+    name = None
+
+    # Size of each allocation step, between progress updates
+    stepsize = 1024 * 1024 * 1024
+
+    def allocate(self, fd, size, meter=None):
+        raise NotImplementedError()
+
+
+class FallocateStrategy(PreallocStrategy):
+    """
+    Allocate with fallocate(2), which reserves blocks that read back as
+    zeros without writing anything. libc's posix_fallocate silently falls
+    back to writing a byte per block, so it is not used.
+    """
+    name = PREALLOC_FALLOCATE
+
+    def allocate(self, fd, size, meter=None):
+        func = _libc_func("fallocate64", ctypes.c_int,
+                          [ctypes.c_int, ctypes.c_int,
+                           ctypes.c_int64, ctypes.c_int64])
+
+        offset = 0
+        while offset < size:
+            length = min(self.stepsize, size - offset)
+            _check_ret(func(fd, 0, offset, length))
+            offset += length
+            if meter and offset < size:
+                meter.update(offset)
+
+
+class WriteZerosStrategy(PreallocStrategy):
+    """
+    Write large, aligned zero buffers and flush the file once at the end
+    """
+    name = PREALLOC_WRITE
+    bufsize = 8 * 1024 * 1024
+
+    def allocate(self, fd, size, meter=None):
+        fileobj = io.FileIO(fd, "w", closefd=False)
+        zeros = memoryview(bytearray(self.bufsize))
+
+        fileobj.seek(0)
+        offset = 0
+        while offset < size:
+            offset += write_all(fileobj, zeros[:min(self.bufsize,
+                                                    size - offset)])
+            if meter and offset < size and not offset % self.stepsize:
+                meter.update(offset)
+
+        os.fsync(fd)
+
+
+def preallocate(fd, size, mode=None, meter=None):
+    """
+    Fully allocate 'size' bytes of the open file 'fd', reporting progress
+    to the urlgrabber meter if passed. With the default PREALLOC_AUTO mode
+    fallocate is used where the filesystem supports it, falling back to
+    writing zeros.
+
+    @returns: Name of the strategy used
+    """
+    mode = mode or PREALLOC_AUTO
+    if mode not in prealloc_modes:
+        raise ValueError("Unknown preallocation mode '%s'" % mode)
+
+    strategies = []
+    if mode in [PREALLOC_AUTO, PREALLOC_FALLOCATE]:
+        strategies.append(FallocateStrategy())
+    if mode in [PREALLOC_AUTO, PREALLOC_WRITE]:
+        strategies.append(WriteZerosStrategy())
+
+    for strategy in strategies:
+        try:
+            strategy.allocate(fd, size, meter)
+            logging.debug("Preallocated %d bytes with %s",
+                          size, strategy.name)
+            return strategy.name
+        except (OSError, IOError), e:
+            if (e.errno not in _NO_OFFLOAD_ERRORS or
+                strategy is strategies[-1]):
+                raise
+            logging.debug("Preallocation with '%s' not supported: %s",
+                          strategy.name, str(e))
+
+
+class BufferPool(object):
+    """
+    Fixed size pool of reusable bytearray buffers. Buffers are allocated
+    lazily up to 'count', after which get() blocks until one is returned.
+    """
+    def __init__(self, bufsize, count):
+        self.bufsize = bufsize
+        self.count = count
+
+        self._lock = threading.Lock()
+        self._allocated = 0
+        self._free = Queue.Queue()
+
+    def get(self):
+        self._lock.acquire()
+        try:
+            if self._free.empty() and self._allocated < self.count:
+                self._allocated += 1
+                return bytearray(self.bufsize)
+        finally:
+            self._lock.release()
+        return self._free.get()
+
+    def put(self, buf):
+        self._free.put(buf)
+
+
+class CloneJob(object):
+    """
+    State shared between the worker threads of a single CloneEngine.clone,
+    which is returned to the caller as a record of the clone.
+    """
+    def __init__(self, src, dst, size, sparse):
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.sparse = sparse
+
+        # Name of the CopyBackend used for the data
+        self.backend = None
+
+        self.queue = Queue.Queue()
+        self.abort = threading.Event()
+        self.error = None
+
+        self._lock = threading.Lock()
+        self.done = 0
+        self.written = 0
+
+    def add_progress(self, done, written):
+        self._lock.acquire()
+        try:
+            self.done += done
+            self.written += written
+        finally:
+            self._lock.release()
+
+    def set_error(self, e):
+        self._lock.acquire()
+        try:
+            if not self.error:
+                self.error = e
+        finally:
+            self._lock.release()
+        self.abort.set()
+
+
+class CloneEngine(object):
+    """
+    Copy a local file or block device to a local destination.
+
+    Data regions of the source are found with SEEK_DATA/SEEK_HOLE so holes
+    are never read, and are split into ranges which are copied by several
+    worker threads. The first backend in 'backends' that works for the
+    source and destination does the copying. Sparse clones only use a
+    whole file backend, like reflink, which keeps the source's holes:
+    otherwise each worker reads into a buffer from a shared pool and
+    every aligned 'zero_block_size' sub-block that is all zeros is skipped
+    rather than written.
+    """
+
+    def __init__(self, blocksize=1024 * 1024, workers=4,
+                 chunksize=64 * 1024 * 1024, zero_block_size=4096,
+                 backends=None):
+        self.blocksize = blocksize
+        self.workers = max(1, workers)
+        self.chunksize = max(chunksize, blocksize)
+        self.zero_block_size = zero_block_size
+        self.backends = backends or default_backends()
+
+        self._pool = BufferPool(self.blocksize, self.workers)
+        self._zeros = None
+
+    def set_concurrency(self, clones):
+        """
+        Size the buffer pool for 'clones' concurrent calls to clone(),
+        so they don't have to wait on each other's buffers
+        """
+        self._pool = BufferPool(self.blocksize, self.workers * clones)
+
+    def _get_zeros(self):
+        if self._zeros is None:
+            self._zeros = bytearray(self.blocksize)
+        return self._zeros
+
+    def _split_ranges(self, extents, size, sparse):
+        """
+        Return a list of (offset, length, is_data) work items covering
+        the source. Holes only need handling if we are not cloning sparse.
+        """
+        ranges = []
+
+        def add_range(start, end, is_data):
+            while start < end:
+                chunk = min(self.chunksize, end - start)
+                ranges.append((start, chunk, is_data))
+                start += chunk
+
+        offset = 0
+        for start, length in extents + [(size, 0)]:
+            if not sparse:
+                add_range(offset, start, False)
+            add_range(start, start + length, True)
+            offset = max(offset, start + length)
+
+        return ranges
+
+    def _write_data(self, dst, view, buf, count, sparse):
+        """
+        Write the first 'count' bytes of buf to dst, seeking over zero
+        sub-blocks if sparse. Returns number of bytes actually written.
+        """
+        if not sparse:
+            write_all(dst, view[:count])
+            return count
+
+        zbs = self.zero_block_size
+        written = 0
+        pos = 0
+        while pos < count:
+            # Collect a run of sub-blocks of the same kind
+            zero = None
+            end = pos
+            while end < count:
+                blockend = min(end + zbs, count)
+                blockzero = is_zero(buf, end, blockend)
+                if zero is None:
+                    zero = blockzero
+                elif blockzero != zero:
+                    break
+                end = blockend
+
+            if zero:
+                dst.seek(end - pos, 1)
+            else:
+                write_all(dst, view[pos:end])
+                written += end - pos
+            pos = end
+
+        return written
+
+    def _copy_data(self, job, src, dst, view, buf, offset, length):
+        """
+        Copy a data range with the job's backend. Returns the number of
+        bytes of the range that were handled.
+        """
+        left = length
+        while left > 0 and not job.abort.isSet():
+            if job.sparse:
+                # Zero blocks are only found going through our buffer
+                count = src.readinto(view[:min(left, self.blocksize)])
+                written = self._write_data(dst, view, buf, count, True)
+            else:
+                count = job.backend.copy(src.fileno(), dst.fileno(),
+                                         offset + length - left,
+                                         min(left, self.chunksize))
+                written = count
+
+            if not count:
+                # Source is shorter than expected
+                break
+
+            left -= count
+            job.add_progress(count, written)
+
+        return length - left
+
+    def _copy_zeros(self, job, dst, length):
+        zeros = memoryview(self._get_zeros())
+        left = length
+        while left > 0 and not job.abort.isSet():
+            count = min(left, self.blocksize)
+            write_all(dst, zeros[:count])
+            left -= count
+            job.add_progress(count, count)
+
+        return length - left
+
+    def _worker(self, job):
+        src = None
+        dst = None
+        buf = self._pool.get()
+        view = memoryview(buf)
+        try:
+            try:
+                src = io.FileIO(job.src, "r")
+                dst = io.FileIO(job.dst, "r+")
+
+                while not job.abort.isSet():
+                    try:
+                        offset, length, is_data = job.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+
+                    src.seek(offset)
+                    dst.seek(offset)
+                    if is_data:
+                        done = self._copy_data(job, src, dst, view, buf,
+                                               offset, length)
+                    else:
+                        done = self._copy_zeros(job, dst, length)
+
+                    if done < length:
+                        job.add_progress(length - done, 0)
+            except Exception, e:
+                job.set_error(e)
+        finally:
+            self._pool.put(buf)
+            if src:
+                src.close()
+            if dst:
+                dst.close()
+
+    def _probe_backend(self, job, created, ranges):
+        """
+        Pick the first backend that works for this clone. Range based
+        backends are tried on the start of the first data range, which
+        is trimmed from 'ranges' on success. They would allocate zero
+        blocks, so sparse clones don't try them. Returns True if a whole
+        file backend has already done the entire copy.
+        """
+        data = [r for r in ranges if r[2]]
+
+        src_fd = os.open(job.src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(job.dst, os.O_WRONLY)
+            try:
+                for backend in self.backends:
+                    if not data:
+                        break
+
+                    # Reflinking keeps the source allocation, so only
+                    # use it for fresh, sparse destinations
+                    if backend.whole_file and not (created and job.sparse):
+                        continue
+                    if job.sparse and not backend.whole_file:
+                        continue
+
+                    offset, length = data[0][0], data[0][1]
+                    if not backend.whole_file:
+                        length = min(length, self.blocksize)
+
+                    try:
+                        count = backend.copy(src_fd, dst_fd, offset, length)
+                    except (OSError, IOError), e:
+                        if e.errno not in _NO_OFFLOAD_ERRORS:
+                            raise
+                        logging.debug("Copy backend '%s' not usable for "
+                                      "%s -> %s: %s", backend.name,
+                                      job.src, job.dst, str(e))
+                        continue
+
+                    job.backend = backend
+                    if backend.whole_file:
+                        return True
+
+                    idx = ranges.index(data[0])
+                    ranges[idx] = (offset + count, data[0][1] - count, True)
+                    job.add_progress(count, count)
+                    return False
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+
+        job.backend = ReadWriteBackend(self.blocksize)
+        return False
+
+    def _create_dest(self, dst):
+        """
+        Create dst if it doesn't exist yet, returning True if we did
+        """
+        if os.path.exists(dst):
+            return False
+        os.close(os.open(dst, os.O_WRONLY | os.O_CREAT))
+        return True
+
+    def _source_extents(self, src, size):
+        fd = os.open(src, os.O_RDONLY)
+        try:
+            return get_extents(fd, size)
+        finally:
+            os.close(fd)
+
+    def _fill_size(self, dst, size):
+        # Make sure a sparse clone is full size, even with trailing holes
+        if os.path.getsize(dst) < size:
+            fd = os.open(dst, os.O_WRONLY)
+            try:
+                os.ftruncate(fd, size)
+            finally:
+                os.close(fd)
+
+    def _label_meter(self, meter, job):
+        if meter and getattr(meter, "text", None):
+            meter.text = "%s (%s)" % (meter.text, job.backend.name)
+
+    def clone(self, src, dst, size, sparse, meter=None, abort=None):
+        """
+        Copy 'size' bytes from path src to path dst, reporting progress
+        to the urlgrabber meter if passed. If sparse, dst is created as a
+        sparse file and holes or zero blocks are skipped.
+
+        @param abort: Optional threading.Event, which stops the clone with
+                      an IOError when set
+        @returns: CloneJob instance recording the backend used and the
+                  number of bytes actually written
+        """
+        created = self._create_dest(dst)
+        extents = self._source_extents(src, size)
+
+        job = CloneJob(src, dst, size, sparse)
+        if abort:
+            job.abort = abort
+        ranges = self._split_ranges(extents, size, sparse)
+
+        if self._probe_backend(job, created, ranges):
+            ranges = []
+            job.add_progress(size, 0)
+        if sparse and created:
+            self._fill_size(dst, size)
+
+        self._label_meter(meter, job)
+
+        ranges = [r for r in ranges if r[1]]
+        for item in ranges:
+            job.queue.put(item)
+
+        logging.debug("Cloning %s to %s: sparse=%s backend=%s "
+                      "data_extents=%d ranges=%d workers=%d blocksize=%d",
+                      src, dst, sparse, job.backend.name, len(extents),
+                      len(ranges), self.workers, self.blocksize)
+
+        # Everything not covered by a range is a hole we skip over. This
+        # must be counted before the workers start adding their progress
+        holes = size - job.done - sum([r[1] for r in ranges])
+        job.add_progress(holes, 0)
+
+        threads = []
+        for ignore in range(min(self.workers, len(ranges))):
+            t = threading.Thread(target=self._worker, args=(job,),
+                                 name="CloneEngine worker")
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        try:
+            for t in threads:
+                while t.isAlive():
+                    t.join(0.25)
+                    if meter and job.done < size:
+                        meter.update(job.done)
+        except:
+            job.abort.set()
+            raise
+
+        if job.error:
+            raise job.error
+        if job.abort.isSet():
+            raise IOError(errno.EINTR,
+                          "Clone of %s to %s aborted" % (src, dst))
+
+        if meter:
+            meter.end(size)
+        logging.debug("Cloned %s to %s with %s, wrote %d of %d bytes",
+                      src, dst, job.backend.name, job.written, size)
+        return job
+
+    def _try_reflink(self, job):
+        """
+        Share the whole source with job.dst using the first whole file
+        backend that works. Returns True on success.
+        """
+        for backend in self.backends:
+            if not backend.whole_file:
+                continue
+
+            src_fd = os.open(job.src, os.O_RDONLY)
+            try:
+                dst_fd = os.open(job.dst, os.O_WRONLY)
+                try:
+                    try:
+                        backend.copy(src_fd, dst_fd, 0, job.size)
+                    except (OSError, IOError), e:
+                        if e.errno not in _NO_OFFLOAD_ERRORS:
+                            raise
+                        logging.debug("Copy backend '%s' not usable for "
+                                      "%s -> %s: %s", backend.name,
+                                      job.src, job.dst, str(e))
+                        continue
+                finally:
+                    os.close(dst_fd)
+            finally:
+                os.close(src_fd)
+
+            job.backend = backend
+            return True
+        return False
+
+    def _fanout_range(self, jobs, src, dsts, view, buf, offset, length,
+                      is_data):
+        """
+        Read a range of the source once and write it to every destination.
+        Hole ranges are only written, as zeros, to non sparse clones.
+        """
+        lead = jobs[0]
+        zeros = None
+        if not is_data:
+            zeros = memoryview(self._get_zeros())
+        else:
+            src.seek(offset)
+
+        pos = offset
+        left = length
+        while left > 0 and not lead.abort.isSet():
+            count = min(left, self.blocksize)
+            if is_data:
+                count = src.readinto(view[:count])
+                if not count:
+                    # Source is shorter than expected
+                    break
+
+            for job, dst in zip(jobs, dsts):
+                dst.seek(pos)
+                if is_data:
+                    written = self._write_data(dst, view, buf, count,
+                                               job.sparse)
+                elif job.sparse:
+                    written = 0
+                else:
+                    written = write_all(dst, zeros[:count])
+                job.add_progress(count, written)
+
+            pos += count
+            left -= count
+
+        if left:
+            for job in jobs:
+                job.add_progress(left, 0)
+
+    def _fanout_worker(self, jobs):
+        lead = jobs[0]
+        src = None
+        dsts = []
+        buf = self._pool.get()
+        view = memoryview(buf)
+        try:
+            try:
+                src = io.FileIO(lead.src, "r")
+                for job in jobs:
+                    dsts.append(io.FileIO(job.dst, "r+"))
+
+                while not lead.abort.isSet():
+                    try:
+                        offset, length, is_data = lead.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+
+                    self._fanout_range(jobs, src, dsts, view, buf,
+                                       offset, length, is_data)
+            except Exception, e:
+                lead.set_error(e)
+        finally:
+            self._pool.put(buf)
+            for f in [src] + dsts:
+                if f:
+                    f.close()
+
+    def clone_many(self, src, dsts, size, sparse, meters=None, abort=None):
+        """
+        Copy 'size' bytes from path src to every path in dsts. Fresh
+        destinations are reflinked to the source where the filesystem
+        allows it when cloning sparse. All the others are filled by the
+        worker threads in a single pass over the source: each range is
+        read once into a pool buffer and written to every destination,
+        skipping zero blocks of sparse ones.
+
+        @param meters: Optional list of urlgrabber meters, one for each
+                       destination
+        @param abort: Optional threading.Event, which stops the clones
+                      with an IOError when set
+        @returns: List of CloneJob instances, in the order of dsts
+        """
+        meters = meters or [None] * len(dsts)
+        jobs = []
+        fanout = []
+        for dst in dsts:
+            created = self._create_dest(dst)
+
+            # Skipping zeros in an existing file would leave its old data
+            job = CloneJob(src, dst, size, sparse and created)
+            jobs.append(job)
+
+            if job.sparse and self._try_reflink(job):
+                job.add_progress(size, 0)
+                continue
+
+            job.backend = ReadWriteBackend(self.blocksize)
+            if job.sparse:
+                self._fill_size(dst, size)
+            fanout.append(job)
+
+        ranges = []
+        if fanout:
+            allsparse = not [j for j in fanout if not j.sparse]
+            extents = self._source_extents(src, size)
+            ranges = [r for r in self._split_ranges(extents, size, allsparse)
+                      if r[1]]
+
+            # All the fanned out clones share the lead job's work queue
+            # and abort flag, so one failure stops them all
+            lead = fanout[0]
+            if abort:
+                lead.abort = abort
+            for job in fanout[1:]:
+                job.queue = lead.queue
+                job.abort = lead.abort
+            for item in ranges:
+                lead.queue.put(item)
+
+            holes = size - sum([r[1] for r in ranges])
+            for job in fanout:
+                job.add_progress(holes, 0)
+
+        for job, meter in zip(jobs, meters):
+            self._label_meter(meter, job)
+
+        logging.debug("Cloning %s to %d destinations: sparse=%s "
+                      "reflinked=%d ranges=%d workers=%d blocksize=%d",
+                      src, len(dsts), sparse, len(jobs) - len(fanout),
+                      len(ranges), self.workers, self.blocksize)
+
+        threads = []
+        for ignore in range(min(self.workers, len(ranges))):
+            t = threading.Thread(target=self._fanout_worker, args=(fanout,),
+                                 name="CloneEngine fanout worker")
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        def update_meters():
+            for job, meter in zip(jobs, meters):
+                if meter and job.done < size:
+                    meter.update(job.done)
+
+        try:
+            for t in threads:
+                while t.isAlive():
+                    t.join(0.25)
+                    update_meters()
+        except:
+            if fanout:
+                fanout[0].abort.set()
+            raise
+
+        if fanout and fanout[0].error:
+            raise fanout[0].error
+        if fanout and fanout[0].abort.isSet():
+            raise IOError(errno.EINTR, "Clone of %s aborted" % src)
+
+        for job, meter in zip(jobs, meters):
+            if meter:
+                meter.end(size)
+            logging.debug("Cloned %s to %s with %s, wrote %d of %d bytes",
+                          src, job.dst, job.backend.name, job.written, size)
+        return jobs
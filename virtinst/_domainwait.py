@@ -0,0 +1,211 @@
+#
+# Waiting for guest state changes
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal domain state waiting helpers. These do NOT form part of the API
+# and must not be used by clients.
+#
+
+import logging
+import threading
+import time
+
+import libvirt
+
+# Poll intervals, in seconds, used when libvirt can't deliver domain
+# events. Every poll that doesn't find the wanted state doubles the
+# interval, up to the maximum
+DEFAULT_MIN_POLL = 0.1
+DEFAULT_MAX_POLL = 2.0
+
+# Even with events, the state is rechecked this often in case an event
+# was lost
+EVENT_RECHECK = 10.0
+
+_min_poll = DEFAULT_MIN_POLL
+_max_poll = DEFAULT_MAX_POLL
+
+_loop_lock = threading.Lock()
+_loop_thread = None
+
+def set_poll_interval(minval, maxval):
+    """
+    Set the bounds of the back off used when polling a guest's state
+    """
+    global _min_poll, _max_poll
+    _min_poll = max(0.01, float(minval))
+    _max_poll = max(_min_poll, float(maxval))
+
+def _run_event_loop():
+    while True:
+        try:
+            libvirt.virEventRunDefaultImpl()
+        except Exception, e:
+            logging.debug("libvirt event loop iteration failed: %s", str(e))
+            time.sleep(1)
+
+def start_event_loop():
+    """
+    Register libvirt's default event implementation and run it in a
+    daemon thread. Only connections opened after this deliver domain
+    events. Calling it again is harmless.
+
+    @returns: True if the event loop is running
+    """
+    global _loop_thread
+
+    _loop_lock.acquire()
+    try:
+        if _loop_thread:
+            return True
+        if not hasattr(libvirt, "virEventRegisterDefaultImpl"):
+            return False
+
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except libvirt.libvirtError, e:
+            logging.debug("Failed to register event implementation: %s",
+                          str(e))
+            return False
+
+        _loop_thread = threading.Thread(target=_run_event_loop,
+                                        name="libvirt event loop")
+        _loop_thread.setDaemon(True)
+        _loop_thread.start()
+        return True
+    finally:
+        _loop_lock.release()
+
+def is_event_loop_running():
+    return _loop_thread is not None
+
+
+class DomainWaiter(object):
+    """
+    Wait for a guest to reach some state. The caller's check is rerun
+    each time libvirt reports a lifecycle event for the guest. If the
+    connection can't deliver events, the check is polled instead,
+    backing off from the minimum to the maximum poll interval.
+    """
+    def __init__(self, conn, name, use_events=None):
+        self.conn = conn
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._events = 0
+        self._callback_id = None
+
+        if use_events is None:
+            use_events = is_event_loop_running()
+        if use_events:
+            self._register()
+
+    def _register(self):
+        if not hasattr(self.conn, "domainEventRegisterAny"):
+            return
+
+        try:
+            self._callback_id = self.conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._event_cb,
+                None)
+        except Exception, e:
+            logging.debug("Domain events not available, polling '%s': %s",
+                          self.name, str(e))
+
+    def _event_cb(self, conn, dom, event, detail, opaque):
+        ignore = conn, detail, opaque
+        if dom.name() != self.name:
+            return
+
+        logging.debug("Lifecycle event %s for '%s'", event, self.name)
+        self._cond.acquire()
+        try:
+            self._events += 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def has_events(self):
+        return self._callback_id is not None
+
+    def _get_events(self):
+        self._cond.acquire()
+        try:
+            return self._events
+        finally:
+            self._cond.release()
+
+    def wait(self, check, timeout=None):
+        """
+        Call check until it returns a true value, and return that. If
+        timeout seconds pass first, the last false value is returned.
+        check is always called at least once.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        interval = _min_poll
+
+        while True:
+            seen = self._get_events()
+            ret = check()
+            if ret:
+                return ret
+
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return ret
+
+            if self.has_events():
+                delay = EVENT_RECHECK
+            else:
+                delay = interval
+                interval = min(interval * 2, _max_poll)
+            if deadline is not None:
+                delay = min(delay, deadline - now)
+
+            self._cond.acquire()
+            try:
+                # Don't sleep if an event arrived while check was running
+                if self._events == seen:
+                    self._cond.wait(delay)
+            finally:
+                self._cond.release()
+
+    def close(self):
+        """
+        Stop listening for events
+        """
+        if self._callback_id is None:
+            return
+
+        try:
+            self.conn.domainEventDeregisterAny(self._callback_id)
+        except Exception, e:
+            logging.debug("Failed to deregister domain events: %s", str(e))
+        self._callback_id = None
+
+def wait_for(conn, name, check, timeout=None):
+    """
+    Convenience wrapper running a single DomainWaiter.wait
+    """
+    waiter = DomainWaiter(conn, name)
+    try:
+        return waiter.wait(check, timeout)
+    finally:
+        waiter.close()
@@ -0,0 +1,232 @@
+#
+# Cache of the guest XML defined on a connection
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal domain XML cache. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import logging
+import threading
+import weakref
+
+import libvirt
+
+import _util
+
+# Disk <source> attributes that hold a path
+_disk_source_props = ["file", "dev", "dir"]
+
+def normalize_mac(mac):
+    """
+    Return a canonical lowercase form of the passed MAC address, so
+    addresses can be compared as strings
+    """
+    try:
+        return ":".join(["%02x" % int(part, 16) for part in mac.split(":")])
+    except ValueError:
+        return mac.lower()
+
+
+class DomainSnapshot(object):
+    """
+    Point in time view of every guest defined on a connection. Each guest's
+    XML is fetched and parsed once, and indexed by disk source path and MAC
+    address.
+
+    The snapshot is rebuilt when invalidate() is called, when libvirt
+    reports a domain lifecycle event (if an event loop is running), or
+    when the list of running and defined guests has changed since the
+    snapshot was taken.
+    """
+    def __init__(self, conn):
+        # Only hold a weak reference, so the cache doesn't keep the
+        # connection alive
+        try:
+            self._connref = weakref.ref(conn)
+        except TypeError:
+            self._connref = lambda: conn
+
+        self._lock = threading.Lock()
+        self._valid = False
+        self._guest_list = None
+        self._event_id = None
+
+        # path -> list of (vm name, shareable)
+        self._disk_paths = {}
+        # normalized mac -> list of (vm name, active)
+        self._macs = {}
+
+        self._register_events()
+
+    def _get_conn(self):
+        return self._connref()
+    conn = property(_get_conn)
+
+    def _register_events(self):
+        if not hasattr(self.conn, "domainEventRegisterAny"):
+            return
+
+        def _event_cb(conn, dom, event, detail, opaque):
+            ignore = conn, event, detail, opaque
+            logging.debug("Domain event for '%s', invalidating snapshot",
+                          dom.name())
+            self.invalidate()
+
+        try:
+            self._event_id = self.conn.domainEventRegisterAny(
+                None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, _event_cb, None)
+        except Exception, e:
+            logging.debug("Domain events not available for snapshot: %s",
+                          str(e))
+
+    def _current_guest_list(self):
+        return (sorted(self.conn.listDomainsID()),
+                sorted(self.conn.listDefinedDomains()))
+
+    def invalidate(self):
+        """
+        Throw away the snapshot so it is rebuilt on next access
+        """
+        self._lock.acquire()
+        try:
+            self._valid = False
+        finally:
+            self._lock.release()
+
+    def _index_guest(self, name, xml, active):
+        def parse_cb(ctx):
+            for disk in ctx.xpathEval("/domain/devices/disk"):
+                shareable = bool(disk.xpathEval("./shareable"))
+                for prop in _disk_source_props:
+                    for node in disk.xpathEval("./source/@%s" % prop):
+                        if node.content:
+                            self._disk_paths.setdefault(
+                                node.content, []).append((name, shareable))
+
+            for node in ctx.xpathEval("/domain/devices/interface/mac/@address"):
+                if node.content:
+                    mac = normalize_mac(node.content)
+                    self._macs.setdefault(mac, []).append((name, active))
+
+        _util.get_xml_path(xml, func=parse_cb)
+
+    def _build(self):
+        guest_list = self._current_guest_list()
+        if self._valid and guest_list == self._guest_list:
+            return
+
+        self._disk_paths = {}
+        self._macs = {}
+
+        active, inactive = _util.fetch_all_guest_xml(self.conn)
+        for vms, is_active in [(active, True), (inactive, False)]:
+            for vm, xml in vms:
+                self._index_guest(vm.name(), xml, is_active)
+
+        logging.debug("Built domain snapshot: %d guests, %d disk paths, "
+                      "%d MACs", len(active) + len(inactive),
+                      len(self._disk_paths), len(self._macs))
+        self._guest_list = guest_list
+        self._valid = True
+
+    def path_in_use_by(self, path, check_conflict=False):
+        """
+        Return a list of VM names using the passed path. If check_conflict,
+        skip guests using the path with the 'shareable' flag.
+        """
+        self._lock.acquire()
+        try:
+            self._build()
+            users = self._disk_paths.get(path, [])
+        finally:
+            self._lock.release()
+
+        names = []
+        for name, shareable in users:
+            if check_conflict and shareable:
+                continue
+            if name not in names:
+                names.append(name)
+        return names
+
+    def disk_paths(self):
+        """
+        Return a list of every disk source path used by a guest
+        """
+        self._lock.acquire()
+        try:
+            self._build()
+            return self._disk_paths.keys()
+        finally:
+            self._lock.release()
+
+    def mac_in_use_by(self, mac):
+        """
+        Return a tuple of lists of (active, inactive) VM names using the
+        passed MAC address
+        """
+        self._lock.acquire()
+        try:
+            self._build()
+            users = self._macs.get(normalize_mac(mac), [])
+        finally:
+            self._lock.release()
+
+        active = [name for name, is_active in users if is_active]
+        inactive = [name for name, is_active in users if not is_active]
+        return active, inactive
+
+
+_snapshots = weakref.WeakKeyDictionary()
+_snapshots_lock = threading.Lock()
+
+def get_snapshot(conn):
+    """
+    Return the shared DomainSnapshot for the passed connection
+    """
+    _snapshots_lock.acquire()
+    try:
+        try:
+            snapshot = _snapshots.get(conn)
+            if not snapshot:
+                snapshot = DomainSnapshot(conn)
+                _snapshots[conn] = snapshot
+            return snapshot
+        except TypeError:
+            # Connection object doesn't support weak references
+            return DomainSnapshot(conn)
+    finally:
+        _snapshots_lock.release()
+
+def invalidate(conn):
+    """
+    Invalidate the cached snapshot for the passed connection, if any.
+    Call this after defining, undefining or changing a guest.
+    """
+    _snapshots_lock.acquire()
+    try:
+        try:
+            snapshot = _snapshots.get(conn)
+        except TypeError:
+            snapshot = None
+    finally:
+        _snapshots_lock.release()
+
+    if snapshot:
+        snapshot.invalidate()
@@ -0,0 +1,418 @@
+#
+# Download engine for install media
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal download engine. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import hashlib
+import httplib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    json = None
+
+from virtinst import _httppool
+from virtinst import _gettext as _
+
+# Bounds of the adaptive read size
+MIN_BUFSIZE = 64 * 1024
+MAX_BUFSIZE = 4 * 1024 * 1024
+
+# Reads are sized to take about this long, so progress stays smooth on
+# slow links while fast links use few large reads
+_target_read_secs = 0.25
+
+# Files are split into at most MAX_SEGMENTS ranges of at least
+# SEGMENT_SIZE bytes, fetched in parallel
+SEGMENT_SIZE = 16 * 1024 * 1024
+MAX_SEGMENTS = 4
+
+# Times a segment is resumed after a network error before giving up
+MAX_RETRIES = 5
+
+# Seconds to wait for segment threads to stop after a cancel. A thread
+# stuck on a stalled connection is left to the socket timeout
+CANCEL_TIMEOUT = 5
+
+# Bytes downloaded between saves of the resume state
+STATE_INTERVAL = 16 * 1024 * 1024
+
+_net_errors = (IOError, socket.error, httplib.HTTPException)
+
+
+class _ReadSize(object):
+    """
+    Read size that grows while reads complete quickly and shrinks when
+    they stall
+    """
+    def __init__(self):
+        self.size = MIN_BUFSIZE
+
+    def adapt(self, nbytes, elapsed):
+        if nbytes < self.size:
+            return
+        if elapsed < _target_read_secs / 2:
+            self.size = min(self.size * 2, MAX_BUFSIZE)
+        elif elapsed > _target_read_secs * 4:
+            self.size = max(self.size / 2, MIN_BUFSIZE)
+
+
+class Hasher(object):
+    """
+    Computes a sha256 digest, plus any other passed algorithms, in one
+    pass over the data
+    """
+    def __init__(self, algos=None):
+        self._hashes = {"sha256": hashlib.sha256()}
+        for algo in algos or []:
+            if algo not in self._hashes:
+                self._hashes[algo] = hashlib.new(algo)
+
+    def update(self, data):
+        for h in self._hashes.values():
+            h.update(data)
+
+    def hexdigests(self):
+        ret = {}
+        for algo, h in self._hashes.items():
+            ret[algo] = h.hexdigest()
+        return ret
+
+
+def copy_stream(src, dst, hasher=None):
+    """
+    Copy file object src to dst with adaptively sized reads, feeding
+    the data to hasher if passed. Returns the number of bytes copied.
+    """
+    readsize = _ReadSize()
+    total = 0
+    while 1:
+        start = time.time()
+        buf = src.read(readsize.size)
+        if not buf:
+            break
+        readsize.adapt(len(buf), time.time() - start)
+
+        dst.write(buf)
+        if hasher:
+            hasher.update(buf)
+        total += len(buf)
+    return total
+
+def check_checksum(url, checksum, digests):
+    """
+    Raise ValueError if the (algo, hexdigest) checksum doesn't match the
+    digests computed for url
+    """
+    if not checksum:
+        return
+
+    algo, want = checksum
+    got = digests.get(algo)
+    if got != want:
+        raise ValueError(_("Checksum mismatch for %(url)s: expected "
+                           "%(algo)s %(want)s, got %(got)s") %
+                         {"url": url, "algo": algo,
+                          "want": want, "got": got})
+
+
+class RangeError(Exception):
+    """
+    The server didn't honor a Range request
+    """
+    pass
+
+class _Segment(object):
+    def __init__(self, start, end, pos=None):
+        self.start = start
+        self.end = end
+        if pos is None:
+            pos = start
+        self.pos = pos
+
+
+class RangeDownload(object):
+    """
+    Fetch an http URL into path using parallel Range requests.
+
+    Each segment resumes from where it stopped after a network error.
+    If statepath is passed, progress is saved there periodically and on
+    failure, so a later download of the same unchanged URL to the same
+    path picks up where this one left off.
+
+    The file is hashed as it streams in. Data that arrives ahead of the
+    hashed prefix is read back from disk (normally from the page cache)
+    once the segments before it complete.
+    """
+    def __init__(self, url, path, size, validator=None, meter=None,
+                 text=None, algos=None, statepath=None):
+        self.url = url
+        self.path = path
+        self.size = size
+        self.validator = validator
+        self.meter = meter
+        self.text = text
+        self.statepath = statepath
+
+        self._hasher = Hasher(algos)
+        self._hashed = 0
+        self._segments = []
+        self._lock = threading.Lock()
+        self._cancel = False
+        self._errors = []
+        self._unsaved = 0
+
+    # Resume state
+
+    def _load_state(self):
+        if not self.statepath or not json or not os.path.exists(self.path):
+            return None
+        try:
+            f = open(self.statepath, "r")
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+        if (state.get("url") != self.url or
+            state.get("size") != self.size or
+            state.get("validator") != self.validator or
+            os.path.getsize(self.path) != self.size):
+            logging.debug("Discarding stale partial download of %s",
+                          self.url)
+            return None
+        return [_Segment(*s) for s in state["segments"]]
+
+    def _save_state(self):
+        if not self.statepath or not json or not self.validator:
+            return
+
+        state = {"url": self.url, "size": self.size,
+                 "validator": self.validator,
+                 "segments": [[s.start, s.end, s.pos]
+                              for s in self._segments]}
+        (fd, tmpname) = tempfile.mkstemp(
+                                    dir=os.path.dirname(self.statepath))
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(tmpname, self.statepath)
+
+    def _plan(self):
+        count = max(1, min(MAX_SEGMENTS, self.size / SEGMENT_SIZE))
+        step = self.size / count
+        ret = []
+        for idx in range(count):
+            end = (idx == count - 1) and self.size or (idx + 1) * step
+            ret.append(_Segment(idx * step, end))
+        return ret
+
+    # Progress and hashing
+
+    def _amount(self):
+        return sum([s.pos - s.start for s in self._segments])
+
+    def _catch_up(self, readfile):
+        """
+        Hash data on disk between the hashed offset and the end of the
+        contiguous downloaded prefix. Called with the lock held.
+        """
+        prefix = 0
+        for seg in self._segments:
+            prefix = seg.pos
+            if seg.pos < seg.end:
+                break
+
+        readfile.seek(self._hashed)
+        while self._hashed < prefix:
+            buf = readfile.read(min(MAX_BUFSIZE, prefix - self._hashed))
+            if not buf:
+                break
+            self._hasher.update(buf)
+            self._hashed += len(buf)
+
+    def _advance(self, seg, offset, buf, readfile):
+        self._lock.acquire()
+        try:
+            seg.pos = offset + len(buf)
+            if offset == self._hashed:
+                self._hasher.update(buf)
+                self._hashed += len(buf)
+            if seg.pos == seg.end:
+                self._catch_up(readfile)
+
+            if self.meter:
+                self.meter.update(self._amount())
+
+            self._unsaved += len(buf)
+            if self._unsaved >= STATE_INTERVAL:
+                self._unsaved = 0
+                self._save_state()
+        finally:
+            self._lock.release()
+
+    # Fetching
+
+    def _fetch_range(self, seg, dst, readfile, readsize):
+        headers = {"Range": "bytes=%d-%d" % (seg.pos, seg.end - 1)}
+        if self.validator:
+            headers["If-Range"] = self.validator
+
+        response = _httppool.get_pool().request("GET", self.url, headers)
+        try:
+            content_range = response.getheader("Content-Range", "")
+            if (response.status != 206 or
+                not content_range.startswith("bytes %d-" % seg.pos)):
+                raise RangeError("%s: %s %s" % (self.url, response.status,
+                                                 response.reason))
+
+            dst.seek(seg.pos)
+            while seg.pos < seg.end and not self._cancel:
+                start = time.time()
+                buf = response.read(min(readsize.size, seg.end - seg.pos))
+                if not buf:
+                    raise IOError("Connection closed at byte %d of %s" %
+                                  (seg.pos, self.url))
+                readsize.adapt(len(buf), time.time() - start)
+
+                offset = seg.pos
+                dst.write(buf)
+                self._advance(seg, offset, buf, readfile)
+
+            if seg.pos == seg.end:
+                # Hit EOF so the connection goes back to the pool
+                response.read(1)
+        finally:
+            response.close()
+
+    def _run_segment(self, seg):
+        # Unbuffered, so _catch_up in another thread can read back
+        # everything a segment has reported
+        dst = open(self.path, "r+b", 0)
+        readfile = open(self.path, "rb", 0)
+        readsize = _ReadSize()
+        retries = 0
+        try:
+            while seg.pos < seg.end and not self._cancel:
+                try:
+                    self._fetch_range(seg, dst, readfile, readsize)
+                except RangeError:
+                    raise
+                except _net_errors, e:
+                    retries += 1
+                    if retries > MAX_RETRIES:
+                        raise
+                    logging.debug("Resuming %s at byte %d after error: %s",
+                                  self.url, seg.pos, str(e))
+                    dst.flush()
+                    time.sleep(min(2 ** retries, 30))
+        finally:
+            dst.close()
+            readfile.close()
+
+    def _worker(self, seg):
+        try:
+            self._run_segment(seg)
+        except Exception, e:
+            self._lock.acquire()
+            try:
+                self._errors.append(e)
+                self._cancel = True
+            finally:
+                self._lock.release()
+
+    def run(self):
+        """
+        Download the file, returning a dict mapping each hash algorithm
+        to the hex digest of the data
+        """
+        self._segments = self._load_state()
+        if self._segments:
+            logging.debug("Resuming download of %s at %d of %d bytes",
+                          self.url, self._amount(), self.size)
+        else:
+            self._segments = self._plan()
+            f = open(self.path, "wb")
+            try:
+                f.truncate(self.size)
+            finally:
+                f.close()
+
+        if self.meter:
+            self.meter.start(filename=None, url=self.url,
+                             basename=os.path.basename(self.url),
+                             size=self.size, text=self.text)
+            self.meter.update(self._amount())
+
+        threads = []
+        for seg in self._segments:
+            if seg.pos < seg.end:
+                t = threading.Thread(target=self._worker, args=(seg,),
+                                     name="Download %d-%d" % (seg.start,
+                                                              seg.end))
+                t.setDaemon(True)
+                threads.append(t)
+                t.start()
+
+        try:
+            for t in threads:
+                # Short timeouts let KeyboardInterrupt through
+                while t.isAlive():
+                    t.join(0.5)
+        except:
+            self._cancel = True
+            deadline = time.time() + CANCEL_TIMEOUT
+            for t in threads:
+                t.join(max(0, deadline - time.time()))
+
+            # Threads still running may be advancing their segments
+            self._lock.acquire()
+            try:
+                self._save_state()
+            finally:
+                self._lock.release()
+            raise
+
+        if self._errors:
+            self._save_state()
+            raise self._errors[0]
+
+        readfile = open(self.path, "rb")
+        try:
+            self._catch_up(readfile)
+        finally:
+            readfile.close()
+
+        if self.meter:
+            self.meter.end(self.size)
+        if self.statepath and os.path.exists(self.statepath):
+            os.unlink(self.statepath)
+        return self._hasher.hexdigests()
@@ -0,0 +1,357 @@
+#
+# Keep-alive HTTP connection pool
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal HTTP connection pool. These do NOT form part of the API and
+# must not be used by clients.
+#
+
+import httplib
+import logging
+import re
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
+
+# Idle connections kept open per host
+MAX_IDLE_PER_HOST = 4
+
+# Redirects followed before giving up
+MAX_REDIRECTS = 5
+
+# Seconds a pooled connection waits on the server before failing, so a
+# stalled transfer errors out instead of hanging
+DEFAULT_TIMEOUT = 60
+
+# Largest directory listing we'll parse
+MAX_LISTING_BYTES = 2 * 1024 * 1024
+
+_redirect_codes = [301, 302, 303, 307, 308]
+
+# Exceptions that mean a reused keep-alive connection was closed by the
+# server while idle, so the request should be retried on a fresh one
+_stale_errors = (httplib.BadStatusLine, httplib.CannotSendRequest,
+                 socket.error)
+
+# Names default server configs leave out of listings (Apache's stock
+# IndexIgnore), so their absence from a listing proves nothing
+_hidden_re = re.compile(r"^(\.|README|HEADER)|[~#]$")
+
+_listing_title_re = re.compile(
+                        r"<title>\s*(Index of|Directory listing for) ",
+                        re.IGNORECASE)
+
+_href_re = re.compile(r"""<a\s[^>]*href\s*=\s*["']?([^"'\s>]+)""",
+                      re.IGNORECASE)
+
+
+class _Response(object):
+    """
+    File like wrapper around an httplib response. The connection goes
+    back to the pool once the body has been read to the end and closed.
+    """
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._buf = ""
+        self._eof = False
+
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._buf + self._response.read()
+            self._buf = ""
+            self._eof = True
+            return data
+
+        if self._buf:
+            data = self._buf[:amt]
+            self._buf = self._buf[amt:]
+            return data
+
+        data = self._response.read(amt)
+        if not data:
+            self._eof = True
+        return data
+
+    def readline(self):
+        while "\n" not in self._buf and not self._eof:
+            data = self._response.read(16384)
+            if not data:
+                self._eof = True
+                break
+            self._buf += data
+
+        idx = self._buf.find("\n")
+        if idx < 0:
+            idx = len(self._buf)
+        else:
+            idx += 1
+        line = self._buf[:idx]
+        self._buf = self._buf[idx:]
+        return line
+
+    def close(self):
+        if not self._conn:
+            return
+
+        reuse = (self._eof and not self._buf and
+                 not self._response.will_close)
+        self._response.close()
+        self._pool._release(self._key, self._conn, reuse)
+        self._conn = None
+
+
+class _UrllibResponse(object):
+    """
+    Gives a urllib2 response the interface of _Response
+    """
+    def __init__(self, response, url):
+        self._response = response
+
+        self.url = response.geturl() or url
+        # Non http handlers, like file:, don't report a status
+        self.status = response.getcode() or 200
+        self.reason = getattr(response, "msg", "")
+
+    def getheader(self, name, default=None):
+        return self._response.info().getheader(name, default)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._response.read()
+        return self._response.read(amt)
+
+    def readline(self):
+        return self._response.readline()
+
+    def close(self):
+        self._response.close()
+
+
+class ConnectionPool(object):
+    """
+    Pool of keep-alive HTTP connections, keyed by host and port.
+
+    Connections are checked out for the life of one request and handed
+    back once its response is fully read, so callers in several threads
+    can share the pool. Up to MAX_IDLE_PER_HOST idle connections are
+    kept per host. Socket operations give up after timeout seconds.
+    """
+    def __init__(self, max_idle=MAX_IDLE_PER_HOST, timeout=DEFAULT_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._idle = {}
+
+        # Instrumentation
+        self.requests = 0
+        self.connections = 0
+
+    def _get(self, key):
+        """
+        Return (conn, reused)
+        """
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections += 1
+        finally:
+            self._lock.release()
+
+        return httplib.HTTPConnection(key, timeout=self.timeout), False
+
+    def _release(self, key, conn, reuse):
+        if reuse:
+            self._lock.acquire()
+            try:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(conn)
+                    return
+            finally:
+                self._lock.release()
+        conn.close()
+
+    def _new_connection(self, key):
+        self._lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self._lock.release()
+        return httplib.HTTPConnection(key, timeout=self.timeout)
+
+    def _request_once(self, method, url, headers):
+        (scheme, netloc, path, query, ignore) = urlparse.urlsplit(url)
+        if scheme != "http":
+            raise ValueError("Unsupported URL scheme '%s'" % scheme)
+
+        path = path or "/"
+        if query:
+            path += "?" + query
+        headers = headers.copy()
+        headers.setdefault("User-Agent", "virtinst")
+
+        conn, reused = self._get(netloc)
+        while True:
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                break
+            except _stale_errors:
+                conn.close()
+                if not reused:
+                    raise
+                logging.debug("Reopening stale connection to %s", netloc)
+                conn = self._new_connection(netloc)
+                reused = False
+            except:
+                conn.close()
+                raise
+
+        return _Response(self, netloc, conn, response, url)
+
+    def _request_urllib(self, method, url, headers):
+        request = urllib2.Request(url, headers=headers)
+        request.get_method = lambda: method
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            # Error responses are returned, as with the pool
+            response = e
+        return _UrllibResponse(response, url)
+
+    def request(self, method, url, headers=None):
+        """
+        Issue an HTTP request, following redirects. Returns a file like
+        response object with 'status', 'url' and getheader(), which must
+        be closed by the caller. Redirects away from plain http, for
+        example to https, are followed by urllib2.
+        """
+        headers = headers or {}
+        for ignore in range(MAX_REDIRECTS + 1):
+            response = self._request_once(method, url, headers)
+            location = response.getheader("Location")
+            if response.status not in _redirect_codes or not location:
+                return response
+
+            # Drain the redirect body so the connection can be reused
+            response.read()
+            response.close()
+            url = urlparse.urljoin(url, location)
+            logging.debug("Following redirect to %s", url)
+
+            if urlparse.urlsplit(url)[0] != "http":
+                return self._request_urllib(method, url, headers)
+
+        raise IOError("Too many redirects fetching %s" % url)
+
+    def close(self):
+        """
+        Close every idle connection
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def get_stats(self):
+        """
+        Return a dict with the number of requests issued and connections
+        opened through this pool
+        """
+        return {"requests": self.requests, "connections": self.connections}
+
+
+_pool = ConnectionPool()
+
+def get_pool():
+    """
+    Return the shared connection pool
+    """
+    return _pool
+
+def set_timeout(timeout):
+    """
+    Set the socket timeout, in seconds, of new connections opened by the
+    shared pool
+    """
+    _pool.timeout = timeout
+
+def use_pool(url):
+    """
+    Return whether url can be fetched through the pool. Proxied and
+    non plain http URLs are left to urllib2 and urlgrabber.
+    """
+    (scheme, netloc) = urlparse.urlsplit(url)[:2]
+    if scheme != "http":
+        return False
+
+    if "http" in urllib.getproxies():
+        host = netloc.split("@")[-1].split(":")[0]
+        if not urllib.proxy_bypass(host):
+            return False
+    return True
+
+def parse_listing(content):
+    """
+    Parse an autoindex style directory listing, as served by Apache,
+    nginx, lighttpd and Python's SimpleHTTPServer. Returns the set of
+    entry names (directories without their trailing slash), or None if
+    content doesn't look like a complete listing.
+    """
+    if not _listing_title_re.search(content):
+        return None
+
+    names = set()
+    for href in _href_re.findall(content):
+        href = href.split("?")[0].split("#")[0]
+        if (not href or href.startswith("/") or href.startswith("../") or
+            href in [".", "..", "./"] or "://" in href):
+            continue
+        name = urllib.unquote(href.rstrip("/"))
+        if name and "/" not in name:
+            names.add(name)
+    return names
+
+def listing_may_hide(name):
+    """
+    Return whether a server may leave name out of a directory listing
+    even though it exists
+    """
+    return bool(_hidden_re.search(name))
@@ -0,0 +1,367 @@
+#
+# Persistent cache of install media fetched from network locations
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal media cache. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    json = None
+
+from virtinst import _diskio
+from virtinst import _download
+
+# Name of the cache directory created under the installer scratchdir
+CACHE_DIRNAME = ".media-cache"
+
+# Default byte budget of a cache, 0 disables caching
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Partial downloads untouched for this long are removed
+_stale_tmp_secs = 7 * 24 * 60 * 60
+
+_max_bytes = DEFAULT_MAX_BYTES
+
+def set_max_bytes(val):
+    """
+    Set the byte budget used by caches returned from get_cache. 0
+    disables the cache.
+    """
+    global _max_bytes
+    _max_bytes = max(0, int(val))
+
+def get_max_bytes():
+    return _max_bytes
+
+def get_cache(scratchdir):
+    """
+    Return the MediaCache kept under the passed scratchdir, or None if
+    caching is disabled
+    """
+    if not _max_bytes or not scratchdir or not json:
+        return None
+    return MediaCache(os.path.join(scratchdir, CACHE_DIRNAME), _max_bytes)
+
+def parse_checksum(val):
+    """
+    Split a .treeinfo style 'algo:hexdigest' checksum. Returns None if
+    the algorithm isn't supported by hashlib.
+    """
+    if not val or val.count(":") != 1:
+        return None
+
+    algo, digest = val.split(":")
+    algo = algo.strip().lower()
+    try:
+        hashlib.new(algo)
+    except ValueError:
+        return None
+    return algo, digest.strip().lower()
+
+
+class _FileLock(object):
+    """
+    Exclusive flock(2) lock, held from acquire() until release()
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self):
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class MediaCache(object):
+    """
+    On-disk cache of fetched files, shared between processes.
+
+    File contents are stored once, named by their sha256 digest. An index
+    entry per URL records the digest and the ETag, Last-Modified and size
+    the server reported when it was fetched, so a later fetch of the same
+    URL can be validated with a single cheap request. When the install
+    tree's .treeinfo lists a checksum for the file, it is checked too.
+
+    Least recently used entries are evicted when the objects exceed the
+    byte budget. Cached files are handed to callers as their own reflink
+    or copy in scratchdir, never a hard link, so changing the owner or
+    label of a handed out file leaves the cache alone.
+    """
+    def __init__(self, cachedir, max_bytes):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+
+        self._objdir = os.path.join(cachedir, "objects")
+        self._indexdir = os.path.join(cachedir, "index")
+        self._lockdir = os.path.join(cachedir, "locks")
+        self._tmpdir = os.path.join(cachedir, "tmp")
+
+    # Locking and index helpers
+
+    def _setup(self):
+        for path in [self._objdir, self._indexdir,
+                     self._lockdir, self._tmpdir]:
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path, 0750)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def _index_lock(self):
+        return _FileLock(os.path.join(self.cachedir, "lock"))
+
+    def _url_key(self, url):
+        return hashlib.sha256(url).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self._indexdir, key)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objdir, digest)
+
+    def _read_entry(self, key):
+        try:
+            f = open(self._entry_path(key), "r")
+            try:
+                entry = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+        if not os.path.exists(self._object_path(entry.get("sha256", ""))):
+            return None
+        return entry
+
+    def _write_entry(self, key, entry):
+        (fd, tmpname) = tempfile.mkstemp(dir=self._tmpdir)
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump(entry, f)
+        finally:
+            f.close()
+        os.rename(tmpname, self._entry_path(key))
+
+    def _all_entries(self):
+        ret = []
+        for key in os.listdir(self._indexdir):
+            entry = self._read_entry(key)
+            if entry:
+                ret.append((key, entry))
+            else:
+                try:
+                    os.unlink(self._entry_path(key))
+                except OSError:
+                    pass
+        return ret
+
+    # Validation
+
+    def _is_valid(self, entry, validators, checksum):
+        if checksum:
+            algo, digest = checksum
+            if algo == "sha256":
+                if entry["sha256"] != digest:
+                    return False
+            elif entry.get(algo) != digest:
+                return False
+
+        if validators:
+            for key in ["etag", "last_modified", "size"]:
+                if validators.get(key) != entry.get(key):
+                    return False
+        return True
+
+    def _evict(self, keep_digest):
+        self._clean_tmp()
+
+        entries = self._all_entries()
+        entries.sort(key=lambda e: e[1].get("atime", 0))
+
+        refs = {}
+        for ignore, entry in entries:
+            refs[entry["sha256"]] = refs.get(entry["sha256"], 0) + 1
+
+        sizes = {}
+        for digest in refs:
+            try:
+                sizes[digest] = os.path.getsize(self._object_path(digest))
+            except OSError:
+                pass
+        total = sum(sizes.values())
+
+        for key, entry in entries:
+            if total <= self.max_bytes:
+                break
+            digest = entry["sha256"]
+            if digest == keep_digest:
+                continue
+
+            logging.debug("Evicting %s from media cache", entry["url"])
+            os.unlink(self._entry_path(key))
+            refs[digest] -= 1
+            if not refs[digest] and digest in sizes:
+                os.unlink(self._object_path(digest))
+                total -= sizes.pop(digest)
+
+    # Fetching
+
+    def _download(self, fetcher, filename, progresscb, key, checksum):
+        """
+        Download filename into the cache tmp dir, hashing it on the way.
+        An interrupted download is left in place, so the next attempt
+        can resume it if the fetcher supports that.
+        Returns (tmpname, dict of digests)
+        """
+        partname = os.path.join(self._tmpdir, key + ".part")
+        statepath = partname + ".state"
+        try:
+            digests = fetcher.downloadFile(filename, partname, progresscb,
+                                           checksum and [checksum[0]],
+                                           statepath)
+        except:
+            if not os.path.exists(statepath) and os.path.exists(partname):
+                os.unlink(partname)
+            raise
+        return partname, digests
+
+    def _clean_tmp(self):
+        # Drop partial downloads nobody has resumed in a while
+        now = time.time()
+        for name in os.listdir(self._tmpdir):
+            path = os.path.join(self._tmpdir, name)
+            try:
+                if now - os.path.getmtime(path) > _stale_tmp_secs:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+    def _hand_off(self, objpath, scratchdir, prefix):
+        """
+        Give the caller its own name for the cached file in scratchdir
+        """
+        if not os.path.exists(scratchdir):
+            os.makedirs(scratchdir, 0750)
+        (fd, fn) = tempfile.mkstemp(prefix="virtinst-" + prefix,
+                                    dir=scratchdir)
+        os.close(fd)
+
+        # Clone into our tmp dir and rename over the file we created, so
+        # we never follow anything planted in a shared scratchdir. A
+        # fresh sparse clone is reflinked where the filesystem allows
+        size = os.path.getsize(objpath)
+        clonename = os.path.join(self._tmpdir, os.path.basename(fn))
+        try:
+            _diskio.CloneEngine().clone(objpath, clonename, size, True)
+            os.rename(clonename, fn)
+        except OSError, e:
+            logging.debug("Couldn't move cloned media, copying: %s", str(e))
+            if os.path.exists(clonename):
+                os.unlink(clonename)
+            _diskio.CloneEngine().clone(objpath, fn, size, True)
+        return fn
+
+    def acquire(self, fetcher, filename, progresscb, checksum=None):
+        """
+        Fetch filename from the passed ImageFetcher through the cache.
+
+        @param checksum: Optional (algo, hexdigest) the file must match
+        @returns: Path of a file in the fetcher's scratchdir, or None if
+                  the file can't be validated and so shouldn't be cached
+        """
+        url = fetcher._make_path(filename)
+        validators = fetcher.getValidators(filename)
+        if not validators and not checksum:
+            logging.debug("No validators for %s, not caching", url)
+            return None
+
+        self._setup()
+        key = self._url_key(url)
+        prefix = os.path.basename(filename) + "."
+
+        # Only one process downloads a given URL at a time. Others wait,
+        # then find it in the cache
+        urllock = _FileLock(os.path.join(self._lockdir, key))
+        urllock.acquire()
+        try:
+            entry = self._read_entry(key)
+            if entry and self._is_valid(entry, validators, checksum):
+                lock = self._index_lock()
+                lock.acquire()
+                try:
+                    entry = self._read_entry(key)
+                    if entry:
+                        logging.debug("Using cached copy of %s", url)
+                        entry["atime"] = time.time()
+                        self._write_entry(key, entry)
+                        return self._hand_off(
+                                        self._object_path(entry["sha256"]),
+                                        fetcher.scratchdir, prefix)
+                finally:
+                    lock.release()
+
+            tmpname, digests = self._download(fetcher, filename, progresscb,
+                                              key, checksum)
+            try:
+                _download.check_checksum(url, checksum, digests)
+            except ValueError:
+                os.unlink(tmpname)
+                raise
+
+            digest = digests["sha256"]
+            entry = {"url": url, "sha256": digest, "atime": time.time()}
+            if validators:
+                entry.update(validators)
+            if checksum:
+                entry[checksum[0]] = digests[checksum[0]]
+
+            lock = self._index_lock()
+            lock.acquire()
+            try:
+                objpath = self._object_path(digest)
+                if os.path.exists(objpath):
+                    os.unlink(tmpname)
+                else:
+                    os.chmod(tmpname, 0444)
+                    os.rename(tmpname, objpath)
+                self._write_entry(key, entry)
+                self._evict(digest)
+
+                logging.debug("Added %s to media cache", url)
+                return self._hand_off(objpath, fetcher.scratchdir, prefix)
+            finally:
+                lock.release()
+        finally:
+            urllock.release()
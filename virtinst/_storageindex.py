@@ -0,0 +1,298 @@
+#
+# Index of the storage pools and volumes on a connection
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal storage index. These do NOT form part of the API and must
+# not be used by clients.
+#
+
+import os
+import logging
+import threading
+import weakref
+
+import libvirt
+
+import _util
+
+# Pool <source> elements that hold a path
+_pool_source_elements = ["dir", "device", "adapter"]
+
+class _PoolEntry(object):
+    def __init__(self, pool, target_path, source_paths):
+        self.pool = pool
+        self.target_path = target_path
+        self.source_paths = source_paths
+        self.active = False
+
+        # Volume names, filled in on first lookup
+        self.volumes = None
+
+class StorageIndex(object):
+    """
+    Maps pool target paths, pool source paths and volume names to
+    pools, so path lookups don't need to fetch and parse every pool's
+    XML each time.
+
+    Each pool's XML is only fetched when the pool first shows up. The
+    cheap pool name lists are compared on every lookup so pools defined,
+    undefined, started or stopped behind our back are picked up
+    incrementally.
+    """
+    def __init__(self, conn):
+        try:
+            self._connref = weakref.ref(conn)
+        except TypeError:
+            self._connref = lambda: conn
+
+        self._lock = threading.Lock()
+
+        # pool name -> _PoolEntry
+        self._pools = {}
+        # abspath of target path -> list of pool names
+        self._target_paths = {}
+        # source path -> list of pool names
+        self._source_paths = {}
+
+    def _get_conn(self):
+        return self._connref()
+    conn = property(_get_conn)
+
+    def invalidate(self):
+        """
+        Throw away the index so it is rebuilt on next access
+        """
+        self._lock.acquire()
+        try:
+            self._pools = {}
+            self._target_paths = {}
+            self._source_paths = {}
+        finally:
+            self._lock.release()
+
+    def _add_pool(self, name):
+        pool = self.conn.storagePoolLookupByName(name)
+
+        def parse_cb(ctx):
+            target = ctx.xpathEval("string(/pool/target/path)") or None
+            sources = []
+            for element in _pool_source_elements:
+                for node in ctx.xpathEval("/pool/source/%s/@path" % element):
+                    if node.content:
+                        sources.append(node.content)
+            return target, sources
+
+        target, sources = _util.get_xml_path(pool.XMLDesc(0), func=parse_cb)
+        if target:
+            target = os.path.abspath(target)
+
+        entry = _PoolEntry(pool, target, sources)
+        self._pools[name] = entry
+        if target:
+            self._target_paths.setdefault(target, []).append(name)
+        for path in sources:
+            self._source_paths.setdefault(path, []).append(name)
+
+    def _remove_pool(self, name):
+        entry = self._pools.pop(name)
+        pathmaps = [(self._target_paths, [entry.target_path]),
+                    (self._source_paths, entry.source_paths)]
+        for pathmap, paths in pathmaps:
+            for path in paths:
+                if path not in pathmap:
+                    continue
+                pathmap[path].remove(name)
+                if not pathmap[path]:
+                    del(pathmap[path])
+
+    def _sync(self):
+        running = self.conn.listStoragePools()
+        inactive = self.conn.listDefinedStoragePools()
+        names = running + inactive
+
+        for name in self._pools.keys():
+            if name not in names:
+                self._remove_pool(name)
+
+        for name in names:
+            if name in self._pools:
+                continue
+            try:
+                self._add_pool(name)
+            except libvirt.libvirtError, e:
+                # pool probably in the process of being removed
+                logging.debug("Failed to index pool '%s': %s", name, str(e))
+
+        for name in running:
+            if name in self._pools:
+                self._pools[name].active = True
+        for name in inactive:
+            if name in self._pools:
+                # Volumes need to be listed again once it is restarted
+                self._pools[name].active = False
+                self._pools[name].volumes = None
+
+    def _lookup(self, pathmap, path):
+        self._lock.acquire()
+        try:
+            self._sync()
+            entries = [self._pools[name] for name in pathmap.get(path, [])]
+        finally:
+            self._lock.release()
+
+        # Favor running pools over inactive pools
+        for entry in entries:
+            if entry.active:
+                return entry.pool
+        if entries:
+            return entries[0].pool
+        return None
+
+    def lookup_pool_by_path(self, path):
+        """
+        Return the pool with the passed target path, or None
+        """
+        return self._lookup(self._target_paths, os.path.abspath(path))
+
+    def lookup_pool_by_source(self, path):
+        """
+        Return the pool with the passed source path (for example a host
+        disk device like /dev/sda), or None
+        """
+        return self._lookup(self._source_paths, path)
+
+    def is_pool_active(self, pool):
+        """
+        Return whether the passed pool was running at the last lookup
+        """
+        self._lock.acquire()
+        try:
+            entry = self._pools.get(pool.name())
+            return bool(entry and entry.active)
+        finally:
+            self._lock.release()
+
+    def lookup_volume(self, pool, name):
+        """
+        Return the volume called 'name' in the passed running pool, or
+        None. Names found in the cached volume list are looked up
+        directly. Otherwise the pool is refreshed and its volumes listed
+        again before giving up, since another client may have added the
+        volume since the list was made.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._pools.get(pool.name())
+            if entry and (entry.volumes is None or
+                          name not in entry.volumes):
+                pool.refresh(0)
+                entry.volumes = set(pool.listVolumes())
+            has_vol = entry and name in entry.volumes
+        finally:
+            self._lock.release()
+
+        if not has_vol:
+            return None
+        try:
+            return pool.storageVolLookupByName(name)
+        except libvirt.libvirtError:
+            # Removed behind our back
+            self._lock.acquire()
+            try:
+                entry.volumes.discard(name)
+            finally:
+                self._lock.release()
+            return None
+
+    def add_volume(self, pool, name):
+        """
+        Record a volume created in the passed pool
+        """
+        self._lock.acquire()
+        try:
+            entry = self._pools.get(pool.name())
+            if entry and entry.volumes is not None:
+                entry.volumes.add(name)
+        finally:
+            self._lock.release()
+
+
+_indexes = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+def get_index(conn):
+    """
+    Return the shared StorageIndex for the passed connection
+    """
+    _indexes_lock.acquire()
+    try:
+        try:
+            index = _indexes.get(conn)
+            if not index:
+                index = StorageIndex(conn)
+                _indexes[conn] = index
+            return index
+        except TypeError:
+            # Connection object doesn't support weak references
+            return StorageIndex(conn)
+    finally:
+        _indexes_lock.release()
+
+def _lookup_index(conn):
+    _indexes_lock.acquire()
+    try:
+        try:
+            return _indexes.get(conn)
+        except TypeError:
+            return None
+    finally:
+        _indexes_lock.release()
+
+def invalidate(conn):
+    """
+    Invalidate the storage index for the passed connection, if any
+    """
+    index = _lookup_index(conn)
+    if index:
+        index.invalidate()
+
+def add_volume(pool, name):
+    """
+    Record a volume created in the passed pool object
+    """
+    index = _lookup_index(pool._conn)
+    if index:
+        index.add_volume(pool, name)
+
+def lookup_pool_by_path(conn, path):
+    """
+    Return the pool with the passed target path, favoring running
+    pools, or None
+    """
+    if not _util.is_storage_capable(conn):
+        return None
+    return get_index(conn).lookup_pool_by_path(path)
+
+def lookup_pool_by_source(conn, path):
+    """
+    Return the pool with the passed source path, favoring running
+    pools, or None
+    """
+    if not _util.is_storage_capable(conn):
+        return None
+    return get_index(conn).lookup_pool_by_source(path)
@@ -0,0 +1,368 @@
+#
+# Uploading local files through libvirt streams
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free  Software Foundation; either version 2 of the License, or
+# (at your option)  any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301 USA.
+
+#
+# Internal stream upload helpers. These do NOT form part of the API and
+# must not be used by clients.
+#
+
+import logging
+import os
+import Queue
+import threading
+import time
+
+import libvirt
+
+import _util
+import support
+import _diskio
+
+# Default bytes read from the file and handed to stream.send at a time
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Chunks read ahead of the one being sent
+_READ_AHEAD = 1
+
+# Granularity of zero run scanning in sparse uploads
+ZERO_BLOCK_SIZE = 64 * 1024
+
+# Largest read while scanning for zeros
+MAX_SCAN_READ = 4 * 1024 * 1024
+
+# Holes smaller than this are sent as data, since skipping them costs
+# more than it saves
+MIN_HOLE_SIZE = 1024 * 1024
+
+# Missing from older libvirt python bindings
+VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM = getattr(libvirt,
+                                "VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM", 1)
+VIR_STORAGE_VOL_FILE = getattr(libvirt, "VIR_STORAGE_VOL_FILE", 0)
+
+_chunk_size = DEFAULT_CHUNK_SIZE
+
+def set_chunk_size(val):
+    """
+    Set the chunk size used by uploads that don't pass their own
+    """
+    global _chunk_size
+    _chunk_size = max(4096, int(val))
+
+def get_chunk_size():
+    return _chunk_size
+
+def format_rate(nbytes, elapsed):
+    """
+    Return a human readable throughput string
+    """
+    rate = nbytes / max(elapsed, 0.001)
+    for unit in ["B", "KiB", "MiB"]:
+        if rate < 1024:
+            return "%.1f %s/s" % (rate, unit)
+        rate /= 1024.0
+    return "%.1f GiB/s" % rate
+
+
+class _Reader(threading.Thread):
+    """
+    Reads chunks of a file into a bounded queue, so the next chunk is
+    read from disk while the current one is sent
+    """
+    def __init__(self, fileobj, chunksize, length=None):
+        threading.Thread.__init__(self, name="Upload reader")
+        self.setDaemon(True)
+
+        self.fileobj = fileobj
+        self.chunksize = chunksize
+        self.remaining = length
+        self.queue = Queue.Queue(_READ_AHEAD)
+        self.stopped = False
+
+    def _put(self, item):
+        # Time out periodically so a cancelled upload doesn't leave us
+        # blocked on a full queue
+        while not self.stopped:
+            try:
+                self.queue.put(item, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def run(self):
+        try:
+            while not self.stopped:
+                size = self.chunksize
+                if self.remaining is not None:
+                    size = min(size, self.remaining)
+
+                data = size and self.fileobj.read(size) or ""
+                self._put(data)
+                if not data:
+                    break
+                if self.remaining is not None:
+                    self.remaining -= len(data)
+        except Exception, e:
+            self._put(e)
+
+    def get(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def stop(self):
+        self.stopped = True
+
+
+class _Progress(object):
+    """
+    Reports upload progress to a meter, and logs throughput at the end
+    """
+    def __init__(self, meter, size, text):
+        self.meter = meter
+        self.done = 0
+        self.sent = 0
+        self._start = time.time()
+
+        meter.start(size=size, text=text)
+
+    def add(self, nbytes, sent=True):
+        self.done += nbytes
+        if sent:
+            self.sent += nbytes
+        self.meter.update(self.done)
+
+    def end(self):
+        self.meter.end(self.done)
+
+        elapsed = time.time() - self._start
+        logging.debug("Uploaded %d bytes, sent %d, in %.1fs (%s)",
+                      self.done, self.sent, elapsed,
+                      format_rate(self.sent, elapsed))
+
+
+def send_all(stream, data):
+    """
+    Send all of data on stream. Partial sends are retried with a buffer
+    over the unsent tail, rather than a sliced copy of it.
+    """
+    total = len(data)
+    ret = stream.send(data)
+    sent = ret
+    while ret > 0 and sent < total:
+        ret = stream.send(buffer(data, sent))
+        sent += ret
+
+def _send_region(stream, fileobj, offset, length, chunksize, progress):
+    """
+    Send length bytes of fileobj starting at offset, or everything from
+    the current position up to EOF if they are None
+    """
+    if offset is not None:
+        fileobj.seek(offset)
+    reader = _Reader(fileobj, chunksize or _chunk_size, length)
+    reader.start()
+    try:
+        while True:
+            data = reader.get()
+            if not data:
+                break
+
+            send_all(stream, data)
+            progress.add(len(data))
+    finally:
+        reader.stop()
+
+def upload(stream, fileobj, size, meter, text, chunksize=None):
+    """
+    Send size bytes from fileobj over a stream already registered with
+    stream.upload, reporting progress to meter, then finish the stream.
+    Returns the number of bytes sent.
+    """
+    progress = _Progress(meter, size, text)
+    _send_region(stream, fileobj, None, None, chunksize, progress)
+    stream.finish()
+    progress.end()
+    return progress.sent
+
+
+def _is_zero(buf, start, end):
+    if buf[start] != "\0" or buf[end - 1] != "\0":
+        return False
+    return buf.count("\0", start, end) == (end - start)
+
+def _scan_zeros(fileobj, offset, length):
+    """
+    Split the extent at offset into the runs that aren't all zeros
+    """
+    ret = []
+    runstart = None
+    fileobj.seek(offset)
+
+    pos = offset
+    end = offset + length
+    while pos < end:
+        buf = fileobj.read(min(MAX_SCAN_READ, end - pos))
+        if not buf:
+            break
+
+        for blockstart in range(0, len(buf), ZERO_BLOCK_SIZE):
+            blockend = min(blockstart + ZERO_BLOCK_SIZE, len(buf))
+            if _is_zero(buf, blockstart, blockend):
+                if runstart is not None:
+                    ret.append((runstart, pos + blockstart - runstart))
+                    runstart = None
+            elif runstart is None:
+                runstart = pos + blockstart
+        pos += len(buf)
+
+    if runstart is not None:
+        ret.append((runstart, pos - runstart))
+    return ret
+
+def _merge_regions(regions):
+    ret = []
+    for offset, length in regions:
+        if ret and offset - (ret[-1][0] + ret[-1][1]) < MIN_HOLE_SIZE:
+            prevoff = ret[-1][0]
+            ret[-1] = (prevoff, offset + length - prevoff)
+        else:
+            ret.append((offset, length))
+    return ret
+
+def get_data_regions(fileobj, size):
+    """
+    Return a sorted list of (offset, length) regions of fileobj holding
+    data. Holes are found with SEEK_DATA/SEEK_HOLE, and the remaining
+    extents are scanned for runs of zeros. Holes smaller than
+    MIN_HOLE_SIZE are folded into the surrounding data.
+    """
+    regions = []
+    for offset, length in _diskio.get_extents(fileobj.fileno(), size):
+        regions.extend(_scan_zeros(fileobj, offset, length))
+    return _merge_regions(regions)
+
+
+def _upload_full(conn, vol, fileobj, size, chunksize, progress):
+    stream = conn.newStream(0)
+    try:
+        stream.upload(vol, 0, size, 0)
+        _send_region(stream, fileobj, 0, size, chunksize, progress)
+        stream.finish()
+    except:
+        _abort(stream)
+        raise
+
+def _upload_sparse_stream(conn, vol, fileobj, size, regions, chunksize,
+                          progress):
+    stream = conn.newStream(0)
+    try:
+        stream.upload(vol, 0, size, VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM)
+
+        pos = 0
+        for offset, length in regions + [(size, 0)]:
+            if offset > pos:
+                stream.sendHole(offset - pos, 0)
+                progress.add(offset - pos, sent=False)
+            if length:
+                _send_region(stream, fileobj, offset, length, chunksize,
+                             progress)
+            pos = offset + length
+        stream.finish()
+    except:
+        _abort(stream)
+        raise
+
+def _upload_extents(conn, vol, fileobj, size, regions, chunksize,
+                    progress):
+    # The volume was created sparse, so holes can just be left
+    # unwritten. Each data region gets its own ranged upload
+    pos = 0
+    for offset, length in regions:
+        progress.add(offset - pos, sent=False)
+        stream = conn.newStream(0)
+        try:
+            stream.upload(vol, offset, length, 0)
+            _send_region(stream, fileobj, offset, length, chunksize,
+                         progress)
+            stream.finish()
+        except:
+            _abort(stream)
+            raise
+        pos = offset + length
+    progress.add(size - pos, sent=False)
+
+def _can_upload_extents(vol):
+    """
+    Whether vol maps byte for byte onto the uploaded file, so data
+    regions can be written at their offsets. That only holds for raw
+    files: a qcow2 or other formatted volume has to be sent whole.
+    """
+    if vol.info()[0] != VIR_STORAGE_VOL_FILE:
+        return False
+    fmt = _util.get_xml_path(vol.XMLDesc(0), "/volume/target/format/@type")
+    return fmt == "raw"
+
+def _abort(stream):
+    try:
+        stream.abort()
+    except:
+        pass
+
+def upload_volume(conn, vol, path, meter, text, chunksize=None,
+                  sparse=False):
+    """
+    Upload the local file at path into the storage volume vol.
+
+    With sparse, holes and runs of zeros in the file aren't sent. If
+    libvirt supports sparse streams they are sent as stream holes,
+    otherwise only the data regions of a raw file volume are written,
+    leaving the holes of the freshly created volume in place.
+    """
+    size = os.path.getsize(path)
+    fileobj = open(path, "rb")
+    try:
+        regions = None
+        if sparse:
+            regions = get_data_regions(fileobj, size)
+            datasize = sum([r[1] for r in regions])
+            logging.debug("%s has %d data regions, %d of %d bytes",
+                          path, len(regions), datasize, size)
+            if datasize == size:
+                regions = None
+
+        progress = _Progress(meter, size, text)
+        if regions is None:
+            _upload_full(conn, vol, fileobj, size, chunksize, progress)
+        elif support.check_stream_support(conn,
+                                          support.SUPPORT_STREAM_SPARSE):
+            _upload_sparse_stream(conn, vol, fileobj, size, regions,
+                                  chunksize, progress)
+        elif _can_upload_extents(vol):
+            _upload_extents(conn, vol, fileobj, size, regions, chunksize,
+                            progress)
+        else:
+            # Holes in a block device hold stale data, and offsets in a
+            # formatted image don't match the file, so every byte has
+            # to be written
+            logging.debug("No sparse stream support, uploading all of %s",
+                          path)
+            _upload_full(conn, vol, fileobj, size, chunksize, progress)
+        progress.end()
+    finally:
+        fileobj.close()
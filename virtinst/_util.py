@@ -29,6 +29,7 @@ import re
 import commands
 import logging
 import traceback
+import threading
 import platform
 import subprocess
 
@@ -36,6 +37,7 @@ import libxml2
 import libvirt
 
 import virtinst.util as util
+import support
 from virtinst import _gettext as _
 
 try:
@@ -186,10 +188,47 @@ def xml_append(orig, new):
         orig += "\n"
     return orig + new
 
-def fetch_all_guests(conn):
+class XMLBuffer(object):
     """
-    Return 2 lists: ([all_running_vms], [all_nonrunning_vms])
+    Accumulates XML lines in a list and joins them once, rather than
+    growing a string with every append. Lines passed to add() are
+    indented by the nesting of the open() and close() calls around them.
+    add_raw() takes text that is already indented, like device XML.
+    Empty lines are skipped, as with xml_append.
+    """
+    def __init__(self, level=0):
+        self._parts = []
+        self._level = level
+
+    def open(self, line):
+        self.add(line)
+        self._level += 2
+
+    def close(self, line):
+        self._level -= 2
+        self.add(line)
+
+    def add(self, line):
+        if line:
+            self._parts.append(" " * self._level + line)
+
+    def add_raw(self, xml):
+        if xml:
+            self._parts.append(xml)
+
+    def getvalue(self):
+        return "\n".join(self._parts)
+
+def _fetch_all_guests_bulk(conn):
+    """
+    Enumerate guests with virConnect.listAllDomains, which needs two
+    round trips no matter how many guests exist
     """
+    active = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+    inactive = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_INACTIVE)
+    return (active, inactive)
+
+def _fetch_all_guests_loop(conn):
     active = []
     inactive = []
 
@@ -211,10 +250,140 @@ def fetch_all_guests(conn):
             inactive.append(vm)
         except:
             # guest probably in process of dieing
-            logging.warn("Failed to lookup inactive domain %d", name)
+            logging.warn("Failed to lookup inactive domain %s", name)
 
     return (active, inactive)
 
+def fetch_all_guests(conn):
+    """
+    Return 2 lists: ([all_running_vms], [all_nonrunning_vms])
+    """
+    if support.check_conn_support(conn, support.SUPPORT_CONN_LISTALLDOMAINS):
+        try:
+            return _fetch_all_guests_bulk(conn)
+        except libvirt.libvirtError, e:
+            logging.debug("listAllDomains failed, falling back to "
+                          "per guest lookup: %s", str(e))
+
+    return _fetch_all_guests_loop(conn)
+
+# Maximum number of XMLDesc calls fetch_all_guest_xml keeps in flight
+_xml_fetch_workers = 8
+
+def fetch_all_guest_xml(conn, flags=0):
+    """
+    Fetch the XML of every guest on the connection. Over a remote
+    connection the XMLDesc calls are issued from several threads, so
+    their round trips overlap.
+
+    Guests that disappear while their XML is being fetched are skipped.
+
+    @returns: 2 lists of (vm, xml) tuples: (running, nonrunning)
+    """
+    active, inactive = fetch_all_guests(conn)
+    vms = active + inactive
+    xmls = [None] * len(vms)
+
+    def fetch(idx):
+        vm = vms[idx]
+        try:
+            xmls[idx] = vm.XMLDesc(flags)
+        except libvirt.libvirtError, e:
+            # guest probably in process of dieing
+            logging.debug("Failed to fetch XML for guest '%s': %s",
+                          vm.name(), str(e))
+
+    nworkers = min(_xml_fetch_workers, len(vms))
+    if (nworkers <= 1 or
+        not support.support_threading() or
+        not is_uri_remote(conn.getURI())):
+        for idx in range(len(vms)):
+            fetch(idx)
+    else:
+        lock = threading.Lock()
+        pending = range(len(vms))
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if not pending:
+                        return
+                    idx = pending.pop()
+                finally:
+                    lock.release()
+                fetch(idx)
+
+        threads = [threading.Thread(target=worker, name="fetch-xml-%d" % i)
+                   for i in range(nworkers)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+
+    ret = zip(vms, xmls)
+    nactive = len(active)
+    return ([r for r in ret[:nactive] if r[1] is not None],
+            [r for r in ret[nactive:] if r[1] is not None])
+
+class AggregateMeter(object):
+    """
+    Merge the progress of several concurrent operations into a single
+    urlgrabber meter. Each operation reports to its own meter returned
+    by new_child(), which may be updated from any thread. Only update()
+    and end() touch the real meter, and must be called from one thread.
+    """
+    def __init__(self, meter, size, text=None):
+        self.meter = meter
+        self.size = size
+        self._children = []
+
+        self.meter.start(size=size, text=text)
+
+    def new_child(self, size):
+        child = _ChildMeter(size)
+        self._children.append(child)
+        return child
+
+    def get_done(self):
+        return sum([child.done for child in self._children])
+
+    def update(self):
+        done = self.get_done()
+        if done < self.size:
+            self.meter.update(done)
+
+    def end(self):
+        self.meter.end(self.size)
+
+class _ChildMeter(object):
+    """
+    Minimal urlgrabber meter that just records progress for an
+    AggregateMeter
+    """
+    def __init__(self, size):
+        self.size = size or 0
+        self.text = None
+        self.done = 0
+
+    def _set_done(self, amount_read):
+        self.done = max(0, min(amount_read or 0, self.size))
+
+    def start(self, filename=None, url=None, basename=None,
+              size=None, now=None, text=None):
+        ignore = filename, url, basename, size, now
+        self.text = text
+        self.done = 0
+
+    def update(self, amount_read, now=None):
+        ignore = now
+        self._set_done(amount_read)
+
+    def end(self, amount_read, now=None):
+        ignore = amount_read, now
+        self.done = self.size
+
 def log_exception(msg=""):
     """
     Log the most recent backtrace at the DEBUG level, rather than the
@@ -261,6 +430,13 @@ def set_xml_path(xml, path, newval):
     return result
 
 
+def _name_candidates(base, suffix, start_num, sep, force_num):
+    for i in range(start_num, start_num + 100000):
+        tryname = base
+        if i != 0 or force_num:
+            tryname += ("%s%d" % (sep, i))
+        yield tryname + suffix
+
 def generate_name(base, collision_cb, suffix="", lib_collision=True,
                   start_num=0, sep="-", force_num=False, collidelist=None):
     """
@@ -276,6 +452,9 @@ def generate_name(base, collision_cb, suffix="", lib_collision=True,
 
     output = "foobar-2.img"
 
+    Each candidate costs a call to collision_cb. If the existing names can
+    be listed up front, generate_names is much cheaper.
+
     @param base: The base string to use for the name (e.g. "my-orig-vm-clone")
     @param collision_cb: A callback function to check for collision,
                          receives the generated name as its only arg
@@ -297,17 +476,72 @@ def generate_name(base, collision_cb, suffix="", lib_collision=True,
         else:
             return collision_cb(tryname)
 
-    for i in range(start_num, start_num + 100000):
-        tryname = base
-        if i != 0 or force_num:
-            tryname += ("%s%d" % (sep, i))
-        tryname += suffix
-
+    for tryname in _name_candidates(base, suffix, start_num, sep, force_num):
         if not collide(tryname):
             return tryname
 
     raise ValueError(_("Name generation range exceeded."))
 
+def generate_names(base, existing, count=1, suffix="", start_num=0, sep="-",
+                   force_num=False):
+    """
+    Generate count new names from the passed base string, in the same
+    form as generate_name, that aren't in the passed list of existing
+    names. Candidates are checked against a set, so this doesn't cost
+    anything per collision. Use the list_*_names helpers to fetch the
+    existing names once.
+
+    @param existing: Names already in use
+    @param count: Number of names to reserve
+    @returns: List of count free names, in increasing order
+    """
+    existing = set(existing)
+    ret = []
+    if count <= 0:
+        return ret
+
+    for tryname in _name_candidates(base, suffix, start_num, sep, force_num):
+        if tryname in existing:
+            continue
+        ret.append(tryname)
+        if len(ret) == count:
+            return ret
+
+    raise ValueError(_("Name generation range exceeded."))
+
+def list_guest_names(conn):
+    """
+    Return the names of all running and defined guests
+    """
+    active, inactive = fetch_all_guests(conn)
+    return [vm.name() for vm in active + inactive]
+
+def list_guest_uuids(conn):
+    """
+    Return the UUID strings of all running and defined guests
+    """
+    active, inactive = fetch_all_guests(conn)
+    return [vm.UUIDString() for vm in active + inactive]
+
+def list_pool_names(conn):
+    """
+    Return the names of all running and defined storage pools
+    """
+    return conn.listStoragePools() + conn.listDefinedStoragePools()
+
+def list_volume_names(pool):
+    """
+    Refresh the passed pool object, and return the names of its volumes
+    """
+    pool.refresh(0)
+    return pool.listVolumes()
+
+def list_interface_names(conn):
+    """
+    Return the names of all running and defined host interfaces
+    """
+    return conn.listInterfaces() + conn.listDefinedInterfaces()
+
 # Selinux helpers
 def have_selinux():
     return bool(selinux) and bool(selinux.is_selinux_enabled())
@@ -35,6 +35,7 @@ import libvirt
 
 import virtinst
 from virtinst import _util
+from virtinst import _domainwait
 from _util import log_exception
 from _util import listify
 from virtinst import _gettext as _
@@ -339,6 +340,10 @@ def open_connection(uri):
     authcb = do_creds
     authcb_data = None
 
+    # Must be running before the connection is opened for it to
+    # deliver domain lifecycle events
+    _domainwait.start_event_loop()
+
     return libvirt.openAuth(uri, [valid_auth_options, authcb, authcb_data],
                             open_flags)
 
@@ -1459,7 +1464,8 @@ def parse_security(guest, security):
 # --disk parsing #
 ##################
 
-def _parse_disk_source(guest, path, pool, vol, size, fmt, sparse):
+def _parse_disk_source(guest, path, pool, vol, size, fmt, sparse,
+                       upload=None):
     abspath = None
     volinst = None
     volobj = None
@@ -1474,6 +1480,9 @@ def _parse_disk_source(guest, path, pool, vol, size, fmt, sparse):
             build_default_pool(guest)
 
     elif pool:
+        if not size and upload and os.path.isfile(upload):
+            # Size the volume to fit the uploaded image
+            size = os.path.getsize(upload) / (1024.0 ** 3)
         if not size:
             raise ValueError(_("Size must be specified with all 'pool='"))
         if pool == DEFAULT_POOL_NAME:
@@ -1543,16 +1552,20 @@ def parse_disk(guest, optstr, dev=None):
 
     def parse_sparse(val):
         sparse = True
+        prealloc = None
         if val is not None:
             val = str(val).lower()
             if val in ["true", "yes"]:
                 sparse = True
             elif val in ["false", "no"]:
                 sparse = False
+            elif val in virtinst.VirtualDisk.prealloc_modes:
+                sparse = False
+                prealloc = val
             else:
                 fail(_("Unknown '%s' value '%s'") % ("sparse", val))
 
-        return sparse
+        return sparse, prealloc
 
     def opt_get(key):
         val = None
@@ -1572,12 +1585,13 @@ def parse_disk(guest, optstr, dev=None):
     vol = opt_get("vol")
     size = parse_size(opt_get("size"))
     fmt = opt_get("format")
-    sparse = parse_sparse(opt_get("sparse"))
+    sparse, prealloc = parse_sparse(opt_get("sparse"))
     ro, shared = parse_perms(opt_get("perms"))
     device = opt_get("device")
+    upload = opt_get("upload")
 
     abspath, volinst, volobj = _parse_disk_source(guest, path, pool, vol,
-                                                  size, fmt, sparse)
+                                                  size, fmt, sparse, upload)
 
     if not dev:
         # Build a stub device that should always validate cleanly
@@ -1599,9 +1613,11 @@ def parse_disk(guest, optstr, dev=None):
     set_param("size", "size", size)
     set_param("format", "format", fmt)
     set_param("sparse", "sparse", sparse)
+    set_param("preallocation", "sparse", prealloc)
     set_param("read_only", "perms", ro)
     set_param("shareable", "perms", shared)
     set_param("device", "device", device)
+    set_param("upload_path", "upload", upload)
 
     set_param("bus", "bus")
     set_param("driver_cache", "cache")
@@ -19,6 +19,9 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301 USA.
 
+import threading
+import weakref
+
 import libvirt
 import _util
 
@@ -35,6 +38,7 @@ SUPPORT_CONN_NETWORK = 7
 SUPPORT_CONN_INTERFACE = 8
 SUPPORT_CONN_MAXVCPUS_XML = 9
 SUPPORT_CONN_STREAM = 10
+SUPPORT_CONN_LISTALLDOMAINS = 11
 
 # Flags for check_domain_support
 SUPPORT_DOMAIN_GETVCPUS = 1000
@@ -68,6 +72,7 @@ SUPPORT_CONN_HV_FILESYSTEM = 5007
 
 # Flags for check_stream_support
 SUPPORT_STREAM_UPLOAD = 6000
+SUPPORT_STREAM_SPARSE = 6001
 
 """
 Possible keys:
@@ -154,6 +159,12 @@ _support_dict = {
     },
 
 
+    SUPPORT_CONN_LISTALLDOMAINS : {
+        "function" : "virConnect.listAllDomains",
+        "args" : (),
+    },
+
+
     # Domain checks
     SUPPORT_DOMAIN_GETVCPUS : {
         "function" : "virDomain.vcpus",
@@ -272,6 +283,13 @@ _support_dict = {
         # for URL installs, want to be sure it works
         "version" : 9004,
     },
+
+    SUPPORT_STREAM_SPARSE : {
+        "function" : "virStream.sendHole",
+        "flag" : "VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM",
+        "version" : 3004000,
+        "force_version" : True,
+    },
 }
 
 # XXX: RHEL6 has lots of feature backports, and since libvirt doesn't
@@ -338,7 +356,8 @@ def _local_lib_ver():
     return libvirt.getVersion()
 
 # Version of libvirt library/daemon on the connection (could be remote)
-def _daemon_lib_ver(conn, uri, force_version, minimum_libvirt_version):
+def _daemon_lib_ver(conn, uri, force_version, minimum_libvirt_version,
+                    cache):
     # Always force the required version if it's after the version which
     # has getLibVersion
     if force_version or minimum_libvirt_version >= 7004:
@@ -349,11 +368,18 @@ def _daemon_lib_ver(conn, uri, force_version, minimum_libvirt_version):
     if not _util.is_uri_remote(uri):
         return _local_lib_ver()
 
-    if not _has_command("getLibVersion", obj=conn):
+    ret = cache.get_daemon_ver(conn)
+    if ret is None:
         return default_ret
+    return ret
+
+# Ask the daemon for its version, None if it can't tell us
+def _fetch_daemon_lib_ver(conn):
+    if not _has_command("getLibVersion", obj=conn):
+        return None
 
     if not _try_command(getattr(conn, "getLibVersion"), ()):
-        return default_ret
+        return None
 
     return conn.getLibVersion()
 
@@ -382,6 +408,67 @@ def _hv_ver(conn, uri):
 
     return ret
 
+class _SupportCache(object):
+    """
+    Per connection cache of the versions needed by _check_support, and
+    of every support check result. Versions are fetched from the
+    connection at most once, on first use.
+    """
+    def __init__(self, conn):
+        self.uri = conn.getURI()
+        self.results = {}
+
+        self._lock = threading.Lock()
+        self._daemon_ver = None
+        self._daemon_ver_fetched = False
+        self._hv_ver = None
+
+    def get_daemon_ver(self, conn):
+        self._lock.acquire()
+        try:
+            if not self._daemon_ver_fetched:
+                self._daemon_ver = _fetch_daemon_lib_ver(conn)
+                self._daemon_ver_fetched = True
+            return self._daemon_ver
+        finally:
+            self._lock.release()
+
+    def get_hv_ver(self, conn):
+        self._lock.acquire()
+        try:
+            if self._hv_ver is None:
+                self._hv_ver = _hv_ver(conn, self.uri)
+            return self._hv_ver
+        finally:
+            self._lock.release()
+
+_support_caches = weakref.WeakKeyDictionary()
+_support_caches_lock = threading.Lock()
+
+def _get_support_cache(conn):
+    _support_caches_lock.acquire()
+    try:
+        try:
+            cache = _support_caches.get(conn)
+            if not cache:
+                cache = _SupportCache(conn)
+                _support_caches[conn] = cache
+            return cache
+        except TypeError:
+            # Connection object doesn't support weak references
+            return _SupportCache(conn)
+    finally:
+        _support_caches_lock.release()
+
+def _data_key(data):
+    """
+    Support results only depend on the type of the passed libvirt object,
+    or on the value of a passed hv name
+    """
+    if data is None or isinstance(data, basestring):
+        return data
+    return type(data).__name__
+
 def _split_function_name(function):
     if not function:
         return (None, None)
@@ -407,18 +494,30 @@ def _check_support(conn, feature, data=None):
 
     @returns: True if feature is supported, False otherwise
     """
-    support_info = _support_dict[feature]
-    key_list = support_info.keys()
-
     if not isinstance(conn, libvirt.virConnect):
         raise ValueError(_("'conn' must be a virConnect instance."))
 
+    cache = _get_support_cache(conn)
+
+    # The local library version and the rhel6 flag can be changed
+    # behind our back, so they are part of the key
+    key = (feature, _data_key(data), _local_lib_ver(), _get_rhel6())
+    ret = cache.results.get(key)
+    if ret is None:
+        ret = _check_support_uncached(conn, cache, feature, data)
+        cache.results[key] = ret
+    return ret
+
+def _check_support_uncached(conn, cache, feature, data):
+    support_info = _support_dict[feature]
+    key_list = support_info.keys()
+
     def get_value(key):
         if key in key_list:
             key_list.remove(key)
         return support_info.get(key)
 
-    uri = conn.getURI()
+    uri = cache.uri
     drv_type = _util.get_uri_driver(uri)
     is_rhel6 = _get_rhel6()
     force_version = get_value("force_version") or False
@@ -442,8 +541,8 @@ def _check_support(conn, feature, data=None):
 
     actual_lib_ver = _local_lib_ver()
     actual_daemon_ver = _daemon_lib_ver(conn, uri, force_version,
-                                        minimum_libvirt_version)
-    actual_drv_ver = _hv_ver(conn, uri)
+                                        minimum_libvirt_version, cache)
+    actual_drv_ver = cache.get_hv_ver(conn)
 
     # Make sure there are no keys left in the key_list. This will
     # ensure we didn't mistype anything above, or in the support_dict
@@ -594,3 +693,49 @@ def check_interface_support(nodedev, feature):
 def check_stream_support(conn, feature):
     return (check_conn_support(conn, SUPPORT_CONN_STREAM) and
             _check_support(conn, feature, conn))
+
+def _feature_names():
+    ret = {}
+    for name, val in globals().items():
+        if name.startswith("SUPPORT_"):
+            ret[val] = name
+    return ret
+
+def dump_support_matrix(conn, hvs=None):
+    """
+    Run every connection level support check for the passed connection,
+    plus the hypervisor checks for each name in hvs. Results are cached,
+    so this is also a way to precompute the whole matrix in one go.
+    Checks against other libvirt objects can't be run without an
+    object, so only their already cached results are reported.
+
+    @param conn: Libvirt connection to check features on
+    @type  conn: virConnect
+    @param hvs: Optional list of hypervisor names, e.g. ['kvm', 'qemu']
+    @type  hvs: list of str
+
+    @returns: sorted list of (feature name, data, supported) tuples.
+              data is None for connection checks, the hv name for
+              hypervisor checks, or the libvirt object type name.
+    """
+    names = _feature_names()
+    ret = {}
+
+    for feature in _support_dict:
+        name = names[feature]
+        if name.startswith("SUPPORT_CONN_HV_"):
+            for hv in (hvs or []):
+                ret[(name, hv)] = _check_support(conn, feature, hv)
+        elif (name.startswith("SUPPORT_CONN_") or
+              name.startswith("SUPPORT_STREAM_")):
+            ret[(name, None)] = _check_support(conn, feature, conn)
+
+    cache = _get_support_cache(conn)
+    libver = _local_lib_ver()
+    for key, val in cache.results.items():
+        feature, datakey, keylibver, ignore = key
+        if keylibver != libver or datakey == "virConnect":
+            continue
+        ret.setdefault((names[feature], datakey), val)
+
+    return sorted([(name, data, val) for (name, data), val in ret.items()])